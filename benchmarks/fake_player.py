@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+    Stands in for the player in benchmarks. Reads stdin until end of
+    file and keeps a JSON report of what it got in the file given as
+    the first argument. The report is written when the first byte
+    arrives, every second and at the end, since the player may be
+    killed without warning.
+"""
+
+import json
+import os
+import sys
+import time
+
+CHUNK = 65536
+
+def report(path, stats):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(stats, f)
+    os.rename(tmp, path)
+
+def main():
+    path = sys.argv[1]
+    stdin = sys.stdin.fileno()
+
+    stats = dict(started=time.time(), first_byte=None, last_byte=None, bytes=0, done=False)
+    written = 0
+
+    while True:
+        data = os.read(stdin, CHUNK)
+        if not data:
+            break
+
+        now = time.time()
+        stats["bytes"] += len(data)
+        stats["last_byte"] = now
+
+        if stats["first_byte"] is None:
+            stats["first_byte"] = now
+            report(path, stats)
+        elif now - written >= 1:
+            written = now
+            report(path, stats)
+
+    stats["done"] = True
+    report(path, stats)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+    Stands in for rtmpdump in benchmarks. Writes an FLV stream to stdout
+    until killed, the rate comes from the RTMP URL:
+
+        rtmp://bench/max        as fast as possible
+        rtmp://bench/2000       2000 kbit/s
+        rtmp://bench/2000/fail  exits with an error instead
+"""
+
+import argparse
+import errno
+import os
+import struct
+import sys
+import time
+
+FLV_HEADER = b"FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00"
+TAG_SIZE = 4096
+
+HELP = """RTMPDump v2.4 (lsmgr benchmark stand-in)
+--rtmp|-r url           URL (e.g. rtmp://host[:port]/path)
+--live|-v               Save a live stream, no --resume (seeking) of live streams possible
+--flv|-o string         FLV output file name, if the file name is - print stream to stdout
+--jtv|-j JSON           Authentication token for Justin.tv legacy servers
+--swfVfy|-W url         URL to player swf file, compute hash/size automatically
+--help|-h               Prints this help screen.
+"""
+
+def flv_tag(timestamp, payload):
+    # Video tag, 24 bit size, 24 bit timestamp plus 8 bit extension, stream ID 0
+    header = b"\x09" + struct.pack(">I", len(payload))[1:]
+    header += struct.pack(">I", timestamp & 0xffffff)[1:] + struct.pack(">B", (timestamp >> 24) & 0xff)
+    header += b"\x00\x00\x00"
+
+    return header + payload + struct.pack(">I", len(header) + len(payload))
+
+def write(data):
+    try:
+        os.write(1, data)
+    except OSError as err:
+        if err.errno == errno.EPIPE:
+            sys.exit(0)
+        raise
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-h", "--help", action="store_true")
+    parser.add_argument("-r", "--rtmp", default="rtmp://bench/max")
+    args, unknown = parser.parse_known_args()
+
+    if args.help:
+        sys.stderr.write(HELP)
+        return 0
+
+    parts = args.rtmp.split("/")[3:]
+    rate = parts and parts[0] or "max"
+
+    if "fail" in parts:
+        sys.stderr.write("ERROR: RTMP_Connect0, failed to connect socket. 111 (Connection refused)\n")
+        return 1
+
+    payload = b"\x17" + b"\x00" * (TAG_SIZE - 1)
+
+    # Seconds of stream in each tag, streams sent as fast as
+    # possible are timestamped as 2000 kbit/s.
+    tag_time = TAG_SIZE * 8 / (float(rate != "max" and rate or 2000) * 1000)
+
+    write(FLV_HEADER)
+
+    start = time.time()
+    sent = 0
+
+    while True:
+        write(flv_tag(int(sent * tag_time * 1000), payload))
+        sent += 1
+
+        if rate != "max":
+            delay = start + sent * tag_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,20 @@
+from livestreamer.plugin import Plugin
+from lsmgr.stream import RTMPStream
+
+class Bench(Plugin):
+    """
+        Resolves bench://<rate> URLs without touching the network, the
+        stream is played with rtmpdump so --rtmpdump picks the source.
+        <rate> is passed on to fake_rtmpdump.py, e.g. bench://2000.
+    """
+
+    @classmethod
+    def can_handle_url(cls, url):
+        return url.startswith("bench://")
+
+    def _get_streams(self):
+        rate = self.url[len("bench://"):]
+
+        return {"live": RTMPStream(self.session, {"rtmp": "rtmp://bench/" + rate, "live": True})}
+
+__plugin__ = Bench
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+    Measures how fast lsmgr relays streams and how quickly they start,
+    with fake_rtmpdump.py as the source and fake_player.py as the player
+    so no network or real player is needed.
+
+        $ PYTHONPATH=src python benchmarks/run.py --output results.json
+
+    Results are written as JSON so runs of different releases can be
+    compared. CPU time is read from /proc and is only reported on Linux.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from lsmgr import Lsmgr
+from lsmgr.cli import parser as lsmgr_parser
+from lsmgr.stream import StreamThread
+from lsmgr.engine import StreamEngine
+from lsmgr.pool import WorkerPool
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def cpu_time(pid):
+    """
+        Returns the user and system CPU seconds used by process *pid*.
+    """
+    try:
+        with open("/proc/{0}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (IOError, OSError):
+        return None
+
+    # utime and stime are fields 14 and 15, the split starts at field 3
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=HERE,
+                                       stderr=open(os.devnull, "w")).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Run(object):
+    """
+        A stream started by the benchmark and the report of its player.
+    """
+
+    def __init__(self, stream, report, started):
+        self.stream = stream
+        self.report = report
+        self.started = started
+
+    def read_report(self):
+        try:
+            with open(self.report) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def wait_report(self, key, timeout):
+        deadline = time.time() + timeout
+
+        while True:
+            report = self.read_report()
+            if (report and report[key]) or time.time() >= deadline:
+                return report
+
+            time.sleep(0.01)
+
+class Bench(object):
+    def __init__(self, options):
+        self.options = options
+        self.dir = tempfile.mkdtemp(prefix="lsmgr-bench")
+        self.ids = 0
+
+        self.args = lsmgr_parser.parse_args(["--loglevel", options.loglevel,
+                                             "--rtmpdump", os.path.join(HERE, "fake_rtmpdump.py"),
+                                             "--plugin-dirs", os.path.join(HERE, "plugins"),
+                                             "--prebuffer", options.prebuffer,
+                                             "--timeshift", options.timeshift])
+
+        self.lsmgr = Lsmgr()
+        self.lsmgr.set_loglevel(self.args.loglevel)
+
+        self.engine = None
+        self.pool = None
+
+        if options.engine == "shared":
+            self.engine = StreamEngine(self.lsmgr, self.args)
+        elif options.pool_size > 0:
+            self.pool = WorkerPool(self.lsmgr, self.args, options.pool_size)
+
+            # Let the pool load its sessions before anything is timed
+            time.sleep(2)
+
+    def close(self):
+        if self.engine:
+            self.engine.shutdown()
+
+        if self.pool:
+            self.pool.shutdown()
+
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def start(self, rate):
+        """
+            Starts a stream the way the stream command does.
+        """
+        self.ids += 1
+        report = os.path.join(self.dir, "player-{0}.json".format(self.ids))
+
+        args = argparse.Namespace(**vars(self.args))
+        args.id = self.ids
+        args.url = "bench://{0}".format(rate)
+        args.stream = "live"
+        args.player = " ".join(quote(arg) for arg in
+                               [sys.executable, os.path.join(HERE, "fake_player.py"), report])
+        args.port = None
+        args.output = None
+        args.force = False
+        args.cached = None
+        args.timeshift_file = args.timeshift and os.path.join(self.dir, "stream-{0}.timeshift".format(self.ids))
+
+        started = time.time()
+        if self.engine:
+            stream = self.engine.start_stream(args.id, args)
+        else:
+            stream = StreamThread(args.id, self.lsmgr, args, None, self.pool)
+
+        return Run(stream, report, started)
+
+    def stop(self, runs):
+        for run in runs:
+            run.stream.kill_stream()
+
+        for run in runs:
+            run.stream.join_stream()
+
+        # Players write their last report when their input closes
+        return [run.wait_report("done", 5) for run in runs]
+
+    def cpu_time(self, runs):
+        if self.engine:
+            pids = set([self.engine.process.pid])
+        else:
+            pids = set(run.stream.process.pid for run in runs)
+
+        times = [cpu_time(pid) for pid in pids]
+        if None in times:
+            return None
+
+        return sum(times)
+
+    def measure(self, count, rate, seconds):
+        """
+            Plays *count* streams at *rate* for *seconds* at once.
+        """
+        runs = [self.start(rate) for i in range(count)]
+        for run in runs:
+            run.wait_report("first_byte", 10)
+
+        cpu_start = self.cpu_time(runs)
+        time.sleep(seconds)
+        cpu_end = self.cpu_time(runs)
+
+        reports = self.stop(runs)
+
+        first_bytes = []
+        rates = []
+        total = 0
+
+        for run, report in zip(runs, reports):
+            if not report or not report["first_byte"]:
+                continue
+
+            first_bytes.append(report["first_byte"] - run.started)
+            total += report["bytes"]
+
+            elapsed = report["last_byte"] - report["first_byte"]
+            if elapsed > 0:
+                rates.append(report["bytes"] * 8 / elapsed / 1000000)
+
+        result = dict(streams=count, rate=rate, seconds=seconds, playing=len(first_bytes),
+                      total_mbit=total * 8 / 1000000.0,
+                      mbit_per_stream=dict(min=rates and min(rates) or None, median=median(rates),
+                                           max=rates and max(rates) or None),
+                      first_byte_seconds=dict(median=median(first_bytes),
+                                              max=first_bytes and max(first_bytes) or None),
+                      cpu_seconds=None, cpu_seconds_per_mbit=None)
+
+        if cpu_start is not None and cpu_end is not None:
+            result["cpu_seconds"] = cpu_end - cpu_start
+
+            # Only what was relayed while CPU time was counted
+            mbit = sum(rates) * seconds
+            if mbit > 0:
+                result["cpu_seconds_per_mbit"] = result["cpu_seconds"] / mbit
+
+        return result
+
+    def throughput(self):
+        return self.measure(1, "max", self.options.seconds)
+
+    def startup(self):
+        """
+            Starts streams one after another and times each from the
+            stream command to the first byte at the player.
+        """
+        times = []
+
+        for i in range(self.options.startup_runs):
+            run = self.start(self.options.rate)
+            report = run.wait_report("first_byte", 10)
+            self.stop([run])
+
+            if report and report["first_byte"]:
+                times.append(report["first_byte"] - run.started)
+
+        return dict(runs=self.options.startup_runs, first_byte_seconds=times,
+                    median=median(times), max=times and max(times) or None)
+
+    def scaling(self):
+        return [self.measure(count, self.options.rate, self.options.seconds)
+                for count in self.options.scale]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark stream relaying and startup with stand-in binaries")
+    parser.add_argument("--engine", choices=["process", "shared"], default="process",
+                        help="How streams are hosted, as lsmgr's --engine (default: process)")
+    parser.add_argument("--pool-size", type=int, default=0,
+                        help="Idle worker processes to keep, as lsmgr's --pool-size (default: 0)")
+    parser.add_argument("--prebuffer", default="8K",
+                        help="Data to buffer before starting the player (default: 8K)")
+    parser.add_argument("--timeshift", metavar="size", default="0",
+                        help="Keep this much of each stream in a timeshift file, as lsmgr's --timeshift (default: 0)")
+    parser.add_argument("--seconds", type=float, default=10,
+                        help="How long each throughput and scaling run lasts (default: 10)")
+    parser.add_argument("--rate", default="2000",
+                        help="Bitrate in kbit/s of the startup and scaling streams (default: 2000)")
+    parser.add_argument("--scale", default="1,10,50,100",
+                        help="Numbers of concurrent streams to run (default: 1,10,50,100)")
+    parser.add_argument("--startup-runs", type=int, default=10,
+                        help="Number of streams to time the startup of (default: 10)")
+    parser.add_argument("--only", metavar="benchmarks", default="throughput,startup,scaling",
+                        help="Benchmarks to run (default: throughput,startup,scaling)")
+    parser.add_argument("-l", "--loglevel", default="none",
+                        help="Log level of the streams, as lsmgr's --loglevel (default: none)")
+    parser.add_argument("-o", "--output", metavar="filename",
+                        help="Write the results to this file instead of stdout")
+
+    options = parser.parse_args()
+    options.scale = [int(count) for count in options.scale.split(",")]
+
+    results = dict(revision=revision(), time=time.time(), python=platform.python_version(),
+                   platform=platform.platform(), engine=options.engine, pool_size=options.pool_size,
+                   prebuffer=options.prebuffer, timeshift=options.timeshift)
+
+    bench = Bench(options)
+    try:
+        for name in options.only.split(","):
+            sys.stderr.write("Running {0} benchmark\n".format(name))
+            results[name] = getattr(bench, name)()
+    finally:
+        bench.close()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
+import sys
+
+# Started before anything else is imported so all of it is timed
+if "--profile-startup" in sys.argv:
+    from .startup import profiler
+    profiler.start()
+
 from .logger import Logger
 from .options import Options
-from .stream import StreamError
-from livestreamer import Livestreamer
-
-import pkgutil
-import imp
 
 class Lsmgr(object):
     """
@@ -30,4 +32,12 @@ object with a write method.
 """
         self.logger.set_output(output)
 
+    def set_logcollector(self, collector):
+        """
+Write the log records of this process and every
+process started after it with *collector*.
+"""
+        self.logger.set_output(collector)
+        self.logger.set_channel(collector.channel)
+
 __all__ = ["Lsmgr"]
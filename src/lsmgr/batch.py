@@ -0,0 +1,98 @@
+from .compat import queue
+from .cache import describe_streams
+from .stream import StreamError, load_livestreamer
+
+import sys
+import threading
+
+# Streams started or channels probed at the same time
+CONCURRENCY = 8
+
+def read_batch(path):
+    """
+        Returns the (line number, line) of every stream in the batch
+        file at *path*, one "url quality [options]" per line. Blank
+        lines and lines starting with # are skipped. "-" reads from
+        stdin up to a blank line, so commands can follow it.
+    """
+    if path == "-":
+        fd = sys.stdin
+    else:
+        fd = open(path)
+
+    lines = []
+
+    try:
+        for number, line in enumerate(iter(fd.readline, ""), 1):
+            line = line.strip()
+
+            if not line:
+                if fd is sys.stdin:
+                    break
+                continue
+
+            if not line.startswith("#"):
+                lines.append((number, line))
+    finally:
+        if fd is not sys.stdin:
+            fd.close()
+
+    return lines
+
+def run_parallel(func, items, concurrency=CONCURRENCY):
+    """
+        Calls *func* with each of *items* from up to *concurrency*
+        threads. Returns the results in the order of *items*, with the
+        exception raised in place of the result of a call that failed.
+    """
+    results = [None] * len(items)
+    pending = queue.Queue()
+
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def work():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                results[index] = func(item)
+            except Exception as err:
+                results[index] = err
+
+    threads = [threading.Thread(target=work) for i in range(min(max(concurrency, 1), len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Wait in steps so a keyboard interrupt is not swallowed
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
+
+    return results
+
+def probe(session, url):
+    """
+        Resolves *url* without opening any of its streams. Returns a
+        description of them as made by describe_streams, raises
+        StreamError if the channel can't be resolved.
+    """
+    livestreamer = load_livestreamer()
+
+    try:
+        channel = session.resolve_url(url)
+    except livestreamer.NoPluginError:
+        raise StreamError("No plugin can handle URL: {0}".format(url))
+
+    try:
+        streams = channel.get_streams()
+    except (StreamError, livestreamer.PluginError) as err:
+        raise StreamError(str(err))
+
+    return describe_streams(channel.module, streams)
+
+__all__ = ["CONCURRENCY", "read_batch", "run_parallel", "probe"]
@@ -0,0 +1,305 @@
+import io
+import os
+import errno
+import struct
+import threading
+
+FLV_HEADER_SIZE = 13
+FLV_TAG_HEADER_SIZE = 11
+FLV_TAG_TYPES = (8, 9, 18)
+FLV_AUDIO = 8
+FLV_VIDEO = 9
+FLV_SCRIPT = 18
+
+# Codecs whose configuration is sent in a tag of its own, AVC and AAC
+FLV_AVC = 7
+FLV_AAC = 10
+
+class BufferPool(object):
+    """
+        Keeps released buffers around so reconnecting streams (or
+        streams in the shared engine) reuse memory instead of
+        allocating new buffers.
+    """
+
+    def __init__(self, limit=8):
+        self.limit = limit
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def get(self, size):
+        with self.lock:
+            free = self.buffers.get(size)
+            if free:
+                return free.pop()
+
+        return bytearray(size)
+
+    def release(self, buffer):
+        with self.lock:
+            free = self.buffers.setdefault(len(buffer), [])
+            if len(free) < self.limit:
+                free.append(buffer)
+
+pool = BufferPool()
+
+class RingBuffer(object):
+    """
+        A fixed size buffer streams are read into. Reads always go into
+        contiguous space, wrapping to the start when there is not enough
+        room left, and the most recent data is kept until overwritten.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = pool.get(size)
+        self.view = memoryview(self.buffer)
+
+        self.pos = 0
+        self.end = 0
+        self.written = 0
+
+        # Raw descriptors are read through a FileIO that leaves them open
+        self.file = None
+
+    def reserve(self, length):
+        """
+            Returns a writable view of *length* bytes (at most the size
+            of the ring) for the next read.
+        """
+        length = min(length, self.size)
+        if self.pos + length > self.size:
+            self.end = self.pos
+            self.pos = 0
+
+        return self.view[self.pos:self.pos + length]
+
+    def commit(self, length):
+        """
+            Marks *length* bytes of the reserved space as filled and
+            returns a view of them.
+        """
+        data = self.view[self.pos:self.pos + length]
+
+        self.pos += length
+        self.end = max(self.end, self.pos)
+        self.written += length
+
+        return data
+
+    def readinto(self, fd, length):
+        """
+            Reads up to *length* bytes from *fd* into the ring, without
+            copying for a raw file descriptor. Returns a view of the data
+            read, raises OSError with EAGAIN if a non-blocking descriptor
+            has none.
+        """
+        view = self.reserve(length)
+
+        if isinstance(fd, int):
+            if self.file is None or self.file.fileno() != fd:
+                self.file = io.FileIO(fd, "r", closefd=False)
+
+            try:
+                read = self.file.readinto(view)
+            except IOError as err:
+                # Python 2 raises IOError where os.read raises OSError
+                raise OSError(err.errno, err.strerror)
+
+            if read is None:
+                raise OSError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        elif hasattr(fd, "readinto"):
+            read = fd.readinto(view)
+        else:
+            data = fd.read(len(view))
+            read = len(data)
+            view[:read] = data
+
+        return self.commit(read or 0)
+
+    def recent(self, length):
+        """
+            Returns up to *length* of the most recently written bytes.
+        """
+        # Data from before the last wrap is only valid past self.pos
+        length = min(length, self.end)
+        if length <= self.pos:
+            return self.view[self.pos - length:self.pos].tobytes()
+
+        head = length - self.pos
+        return self.view[self.end - head:self.end].tobytes() + self.view[:self.pos].tobytes()
+
+    def release(self):
+        self.file = None
+        self.view = None
+        pool.release(self.buffer)
+        self.buffer = None
+
+class FLVClock(object):
+    """
+        Times an FLV stream as it is read. Each call to duration() is
+        given all of the stream read so far and only parses the tags
+        that are new since the last one.
+    """
+
+    def __init__(self):
+        self.offset = FLV_HEADER_SIZE
+        self.first = self.last = None
+
+    def duration(self, data):
+        """
+            Returns the number of seconds covered by the complete FLV
+            tags in the memoryview *data*, or None if it is not an FLV
+            stream.
+        """
+        if len(data) < FLV_HEADER_SIZE or data[:3].tobytes() != b"FLV":
+            return None
+
+        while self.offset + FLV_TAG_HEADER_SIZE <= len(data):
+            header = data[self.offset:self.offset + FLV_TAG_HEADER_SIZE].tobytes()
+            size = struct.unpack(">I", b"\0" + header[1:4])[0]
+            timestamp = struct.unpack(">I", header[7:8] + header[4:7])[0]
+
+            end = self.offset + FLV_TAG_HEADER_SIZE + size + 4
+            if end > len(data):
+                break
+
+            self.offset = end
+            if self.first is None:
+                self.first = timestamp
+            self.last = timestamp
+
+        if self.first is None:
+            return 0.0
+
+        return (self.last - self.first) / 1000.0
+
+def flv_duration(data):
+    """
+        Returns the number of seconds covered by the complete FLV tags
+        in the memoryview *data*, or None if it is not an FLV stream.
+    """
+    return FLVClock().duration(data)
+
+def flv_tags(data, offset):
+    """
+        Yields the offset, type and size of each complete FLV tag in the
+        bytearray *data*, starting with the one at *offset*.
+    """
+    while offset + FLV_TAG_HEADER_SIZE <= len(data):
+        kind = data[offset] & 0x1f
+        size = data[offset + 1] << 16 | data[offset + 2] << 8 | data[offset + 3]
+        end = offset + FLV_TAG_HEADER_SIZE + size + 4
+
+        if kind not in FLV_TAG_TYPES or end > len(data):
+            return
+
+        yield offset, kind, size
+        offset = end
+
+def flv_sync(data):
+    """
+        Returns the offset of the first FLV tag in the bytearray *data*,
+        which may start anywhere in a stream, or None. Only tags followed
+        by their own size are trusted.
+    """
+    for offset in range(len(data) - FLV_TAG_HEADER_SIZE):
+        if data[offset] & 0x1f not in FLV_TAG_TYPES or data[offset + 8:offset + 11] != b"\0\0\0":
+            continue
+
+        size = data[offset + 1] << 16 | data[offset + 2] << 8 | data[offset + 3]
+        end = offset + FLV_TAG_HEADER_SIZE + size
+        if end + 4 > len(data):
+            continue
+
+        if struct.unpack(">I", bytes(data[end:end + 4]))[0] == FLV_TAG_HEADER_SIZE + size:
+            return offset
+
+    return None
+
+def catch_up(header, recent):
+    """
+        Returns what a player started in the middle of a stream is sent
+        first, the *header* the stream started with and the *recent*
+        data from its last keyframe on. FLV data is cut where tags start
+        so the player doesn't have to find its way in, anything else is
+        sent as it is.
+    """
+    if header[:3] != b"FLV":
+        return header + recent
+
+    # The header ends with the prebuffer, most likely in the middle of a tag
+    end = FLV_HEADER_SIZE
+    for offset, kind, size in flv_tags(bytearray(header), FLV_HEADER_SIZE):
+        end = offset + FLV_TAG_HEADER_SIZE + size + 4
+
+    data = bytearray(recent)
+    start = flv_sync(data)
+    if start is None:
+        return header[:end]
+
+    keyframe = start
+    for offset, kind, size in flv_tags(data, start):
+        if kind == FLV_VIDEO and size and data[offset + FLV_TAG_HEADER_SIZE] >> 4 == 1:
+            keyframe = offset
+
+    return header[:end] + recent[keyframe:]
+
+def flv_skip(data, start, keep):
+    """
+        Returns where to cut the bytearray *data*, the unwritten FLV data
+        of an output that fell behind, to leave about *keep* bytes of it:
+        the end of the tag that is partly written, which is past *start*,
+        and where to carry on from, a keyframe if there is one in reach.
+        None if no tags are found.
+    """
+    end = flv_sync(data[start:])
+    if end is None:
+        return None
+    end += start
+
+    first = len(data) - max(keep - end, 0)
+    resume = None
+    boundary = end
+
+    for offset, kind, size in flv_tags(data, end):
+        boundary = offset + FLV_TAG_HEADER_SIZE + size + 4
+        if offset < first:
+            continue
+
+        if kind == FLV_VIDEO and size and data[offset + FLV_TAG_HEADER_SIZE] >> 4 == 1:
+            return end, offset
+        if resume is None:
+            resume = offset
+
+    # The tag that follows the last one is still coming
+    if resume is None:
+        resume = boundary
+
+    return end, resume
+
+def flv_preamble(header):
+    """
+        Returns the FLV header and the tags of the stream's *header* a
+        player needs to start at a keyframe later on: the metadata and
+        the AVC and AAC sequence headers. Empty if it is not FLV.
+    """
+    if header[:3] != b"FLV":
+        return b""
+
+    data = bytearray(header)
+    tags = [header[:FLV_HEADER_SIZE]]
+
+    for offset, kind, size in flv_tags(data, FLV_HEADER_SIZE):
+        body = offset + FLV_TAG_HEADER_SIZE
+        config = size > 1 and data[body + 1] == 0 and (
+            (kind == FLV_VIDEO and data[body] & 0x0f == FLV_AVC) or
+            (kind == FLV_AUDIO and data[body] >> 4 == FLV_AAC))
+
+        if kind == FLV_SCRIPT or config:
+            tags.append(header[offset:body + size + 4])
+
+    return b"".join(tags)
+
+__all__ = ["BufferPool", "FLVClock", "RingBuffer", "catch_up", "flv_duration", "flv_preamble", "flv_skip", "flv_sync",
+           "flv_tags", "pool"]
@@ -0,0 +1,172 @@
+from collections import OrderedDict
+
+import sys
+import copy
+import time
+import pickle
+import threading
+
+class TTLCache(object):
+    """
+        A least recently used cache whose entries expire *ttl* seconds
+        after they were stored. A *ttl* of 0 disables the cache.
+    """
+
+    def __init__(self, ttl=60, size=64):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry[0] < time.time():
+                self.expired += 1
+                self.misses += 1
+                return None
+
+            # Move it to the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+
+            return entry[2]
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+
+        with self.lock:
+            now = time.time()
+            self.entries.pop(key, None)
+            self.entries[key] = (now + self.ttl, now, value)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def flush(self, key=None):
+        """
+            Removes *key*, or every entry if no key is given.
+            Returns the number of entries removed.
+        """
+        with self.lock:
+            if key is None:
+                count = len(self.entries)
+                self.entries.clear()
+                return count
+
+            return self.entries.pop(key, None) is not None and 1 or 0
+
+    def items(self):
+        """
+            Returns (key, age, value) for every entry that has not expired,
+            least recently used first.
+        """
+        now = time.time()
+
+        with self.lock:
+            return [(key, now - stored, value)
+                    for key, (expires, stored, value) in self.entries.items()
+                    if expires >= now]
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+
+        return 100.0 * self.hits / lookups
+
+def process_params(params):
+    # Keys starting with _ are process options (open files etc.)
+    return dict((k, v) for k, v in params.items() if not k.startswith("_"))
+
+def http_args(stream):
+    args = dict(stream.args)
+    url = args.pop("url")
+    args["buffered"] = stream.buffered
+
+    return [url], args
+
+# Stream classes that keep everything they were created with, by module
+# and name, and how to get it back: the arguments that follow the session
+# and the keyword arguments. Other streams are resolved again each time.
+STREAM_ARGS = {
+    ("lsmgr.stream", "RTMPStream"): lambda stream: ([process_params(stream.params)], {}),
+    ("lsmgr.stream", "HTTPStream"): lambda stream: ([stream.url], {}),
+    ("livestreamer.stream.rtmpdump", "RTMPStream"):
+        lambda stream: ([process_params(stream.params)], dict(redirect=stream.redirect)),
+    ("livestreamer.stream.http", "HTTPStream"): http_args,
+    ("livestreamer.stream.hls", "HLSStream"): http_args,
+    ("livestreamer.stream.akamaihd", "AkamaiHDStream"):
+        lambda stream: ([stream.url], dict(swf=stream.swf, seek=stream.seek)),
+}
+
+def describe_stream(stream):
+    """
+        Returns a picklable description of *stream*, its class and the
+        arguments it was created with, or None if it can't be created
+        again from one.
+    """
+    cls = type(stream)
+    key = (cls.__module__, cls.__name__)
+    if key not in STREAM_ARGS:
+        return None
+
+    try:
+        args, kwargs = STREAM_ARGS[key](stream)
+        description = key + (args, kwargs)
+
+        # They go through a queue to the manager
+        pickle.dumps(description, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return None
+
+    return description
+
+def describe_streams(module, streams):
+    """
+        Returns a picklable description of the streams found by a plugin,
+        so they can be created again without asking the plugin. Streams
+        that can't be described are left out, the URL is then resolved
+        again to play them.
+    """
+    described = {}
+
+    for name, stream in streams.items():
+        description = describe_stream(stream)
+        if description is not None:
+            described[name] = description
+
+    qualities = list(streams.keys())
+    qualities.sort()
+
+    return dict(module=module, qualities=qualities, streams=described)
+
+def rebuild_stream(session, description):
+    """
+        Creates a stream from a description made by describe_streams.
+        Returns None if it can't be done.
+    """
+    module, name, args, kwargs = description
+
+    cls = getattr(sys.modules.get(module), name, None)
+    if cls is None:
+        return None
+
+    try:
+        return cls(session, *copy.deepcopy(args), **copy.deepcopy(kwargs))
+    except Exception:
+        return None
+
+__all__ = ["TTLCache", "describe_stream", "describe_streams", "rebuild_stream"]
@@ -3,13 +3,16 @@ import os
 import sys
 import subprocess
 import getpass
+import socket
+import tempfile
 
 
 from lsmgr import *
 from .compat import input, stdout, is_win32
-from .stream import StreamProcess
-from .utils import ArgumentParser, port
-from .manager import Manager
+from .utils import ArgumentParser, port, size, optional_size, prebuffer
+from .control import RemoteShell, SOCKET_FILE
+from .placement import parse_cpus
+from .startup import profiler
 
 exampleusage = """
 example usage:
@@ -36,6 +39,8 @@ parser.add_argument("-h", "--help", action="store_true",
 parser.add_argument("-l", "--loglevel", metavar="level",
                     help="Set log level, valid levels: none, error, warning, info, debug",
                     default="info")
+parser.add_argument("--profile-startup", action="store_true",
+                    help="Show how long lsmgr took to start and its slowest imports")
 parser.add_argument("--min-port", metavar="port", 
                     help="Minimum port in the range to start streams. Must grater than 50000. (default: 50000)", 
                     default=50000, type=port)
@@ -43,12 +48,118 @@ parser.add_argument("--max-port", metavar="port",
                     help="Maximum port in the range to start streams. Must less than 65000. (default: 65000)", 
                     default=65000, type=port)
 
+engineopt = parser.add_argument_group("engine options")
+engineopt.add_argument("--engine", metavar="engine", choices=["process", "shared"],
+                       help="How streams are hosted: 'process' starts a worker process per stream, 'shared' runs every stream in one worker process (default: process)",
+                       default="process")
+engineopt.add_argument("--engine-workers", metavar="count", type=int,
+                       help="Number of threads the shared engine uses to resolve and open streams (default: 4)",
+                       default=4)
+engineopt.add_argument("--pool-size", metavar="count", type=int,
+                       help="Number of idle worker processes kept ready to play streams, 0 starts a new process for every stream (default: 0)",
+                       default=0)
+engineopt.add_argument("--pool-max-jobs", metavar="count", type=int,
+                       help="Number of streams a pooled worker plays before it is replaced, 0 for no limit (default: 20)",
+                       default=20)
+
 playeropt = parser.add_argument_group("player options")
 playeropt.add_argument("-p", "--player", metavar="player",
                        help="Command-line for player, default is 'vlc'",
                        default="default")
 playeropt.add_argument("-x", "--xsplit", action="store_true", 
-                       help="Show XSplit URLS to open with IP Camera plugin and modify the default player")
+                       help="Show XSplit URLS to open with IP Camera plugin and restream streams unless a player is given")
+playeropt.add_argument("--respawn-buffer", metavar="size", type=optional_size,
+                       help="Most recent data a player is restarted with when it exits, the stream carries on meanwhile, and restream clients that connect late start with, 0 reconnects the stream instead (default: 512K)",
+                       default="512K")
+playeropt.add_argument("--standby-players", metavar="count", type=int,
+                       help="Players of each player command started ahead of time, so streams and restarted players don't wait for the player to load (default: 0)",
+                       default=0)
+
+restreamopt = parser.add_argument_group("restream options")
+restreamopt.add_argument("--restream", action="store_true",
+                         help="Serve streams over HTTP on http://127.0.0.1:port/stream/<id> instead of starting a player for each")
+restreamopt.add_argument("--restream-port", metavar="port", type=port,
+                         help="Port the restream server listens on (default: 8090)",
+                         default=8090)
+
+bufferopt = parser.add_argument_group("buffer options")
+bufferopt.add_argument("--prebuffer", metavar="amount", type=prebuffer,
+                       help="Data to buffer before starting the player, in bytes (e.g. 64K, 1M) or seconds (e.g. 2s) (default: 8K)",
+                       default="8K")
+bufferopt.add_argument("--ring-size", metavar="size", type=size,
+                       help="Size of the buffer each stream is read into, also the largest prebuffer (default: 1M)",
+                       default="1M")
+
+timeshiftopt = parser.add_argument_group("timeshift options")
+timeshiftopt.add_argument("--timeshift", metavar="size", type=optional_size,
+                          help="Keep the last this much of each stream (e.g. 200M) in a file on disk, to play it again from some time ago or save the last minutes of it with the rewind and clip commands, 0 keeps nothing (default: 0)",
+                          default="0")
+timeshiftopt.add_argument("--timeshift-dir", metavar="directory",
+                          help="Directory the timeshift files are kept in (default: {0})".format(tempfile.gettempdir()),
+                          default=tempfile.gettempdir())
+
+cacheopt = parser.add_argument_group("cache options")
+cacheopt.add_argument("--cache-ttl", metavar="seconds", type=int,
+                      help="How long resolved stream URLs are cached, 0 disables the cache (default: 60)",
+                      default=60)
+cacheopt.add_argument("--cache-size", metavar="entries", type=int,
+                      help="Maximum number of URLs in the cache, the least recently used are removed first (default: 64)",
+                      default=64)
+
+retryopt = parser.add_argument_group("reconnect options")
+retryopt.add_argument("--retry-max-failures", metavar="count", type=int,
+                      help="Failed opens or lost connections in a row before a stream is given up, 0 for no limit (default: 10)",
+                      default=10)
+retryopt.add_argument("--retry-min", metavar="seconds", type=float,
+                      help="Wait before the first reconnect, doubled after every failure (default: 1)",
+                      default=1)
+retryopt.add_argument("--retry-max", metavar="seconds", type=float,
+                      help="Longest wait between reconnects (default: 60)",
+                      default=60)
+retryopt.add_argument("--stall-timeout", metavar="seconds", type=float,
+                      help="Reconnect streams that send no data for this long, 0 disables (default: 30)",
+                      default=30)
+
+httpopt = parser.add_argument_group("http options")
+httpopt.add_argument("--http-connections", metavar="count", type=int,
+                     help="Idle connections kept open to each host for reuse by HTTP streams and plugins (default: 4)",
+                     default=4)
+httpopt.add_argument("--http-idle-timeout", metavar="seconds", type=float,
+                     help="How long an idle HTTP connection is kept open (default: 60)",
+                     default=60)
+
+daemonopt = parser.add_argument_group("daemon options")
+daemonopt.add_argument("--daemon", action="store_true",
+                       help="Run without a prompt, controlled through a Unix socket with JSON requests")
+daemonopt.add_argument("--connect", action="store_true",
+                       help="Run the prompt against a running daemon instead of starting streams here")
+daemonopt.add_argument("--socket", metavar="path", default=SOCKET_FILE,
+                       help="Socket the daemon listens on (default: {0})".format(SOCKET_FILE))
+
+batchopt = parser.add_argument_group("batch options")
+batchopt.add_argument("--batch", metavar="file",
+                      help="Start the streams listed in a file, one 'url quality [options]' per line, '-' reads them from stdin up to a blank line")
+batchopt.add_argument("--batch-jobs", metavar="count", type=int,
+                      help="Number of streams started or probed at the same time by batches (default: 8)",
+                      default=8)
+batchopt.add_argument("--batch-probe", action="store_true",
+                      help="Only report which channels in the --batch file are live and their qualities")
+
+placementopt = parser.add_argument_group("placement options")
+placementopt.add_argument("--placement", action="store_true",
+                          help="Spread the processes of each stream over the CPUs and give recordings a lower CPU and disk priority than live streams (Linux only)")
+placementopt.add_argument("--placement-cpus", metavar="cpus", type=parse_cpus,
+                          help="CPUs streams are placed on, e.g. 0-3,6 (default: all the CPUs lsmgr may use)")
+placementopt.add_argument("--recording-nice", metavar="value", type=int,
+                          help="Nice value of rtmpdump and other processes of streams written to files, 0 leaves it alone (default: 10)",
+                          default=10)
+placementopt.add_argument("--recording-ionice", metavar="class", choices=["best-effort", "idle", "none"],
+                          help="Disk priority of streams written to files: 'best-effort' is the lowest normal priority, 'idle' only uses the disk when nothing else does, 'none' leaves it alone (default: best-effort)",
+                          default="best-effort")
+
+metricsopt = parser.add_argument_group("metrics options")
+metricsopt.add_argument("--metrics-port", metavar="port", type=port,
+                        help="Serve stream statistics in the Prometheus text format on http://127.0.0.1:port/metrics")
 
 pluginopt = parser.add_argument_group("plugin options")
 pluginopt.add_argument("-c", "--cmdline", action="store_true",
@@ -57,6 +168,11 @@ pluginopt.add_argument("-e", "--errorlog", action="store_true",
                        help="Log possible errors from internal command-line to a temporary file, use when debugging")
 pluginopt.add_argument("-r", "--rtmpdump", metavar="path",
                        help="Specify location of rtmpdump")
+pluginopt.add_argument("--plugin-dirs", metavar="directory", action="append",
+                       help="Load extra Livestreamer plugins from this directory, can be given more than once")
+pluginopt.add_argument("--start-timeout", metavar="seconds", type=float,
+                       help="How long to wait for the first data from rtmpdump before giving up (default: 30)",
+                       default=30)
 pluginopt.add_argument("-j", "--jtv-cookie", metavar="cookie",
                        help="Specify JustinTV cookie to allow access to subscription channels")
 pluginopt.add_argument("--gomtv-cookie", metavar="cookie",
@@ -87,10 +203,25 @@ def main():
         gomtv_password = args.gomtv_password
 
     if args.player == "default" and args.xsplit:
+        # Streams with --no-restream still get a VLC serving RTSP
+        args.restream = True
         args.player = "vlc --sout=#rtp{sdp=rtsp://:{PORT}/} --no-sout-rtp-sap --no-sout-standard-sap --ttl=1 --sout-keep"
     elif args.player == "default":
         args.player = "vlc"
 
+    if args.connect:
+        try:
+            shell = RemoteShell(args.socket)
+        except (socket.error, TypeError) as err:
+            sys.exit("Failed to connect to the daemon on {0}: {1}".format(args.socket, err))
+
+        profiler.report()
+        shell.cmdloop()
+        return
+
+    # The manager needs most of lsmgr, which the client above doesn't
+    from .manager import Manager
+
     lsmgr.set_logoutput(sys.stdout)
     lsmgr.set_loglevel(args.loglevel)
 
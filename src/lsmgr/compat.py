@@ -18,21 +18,65 @@ elif is_py3:
     stdout = sys.stdout.buffer
     str = str
 
+class LazyModule(object):
+    """
+        Stands in for the first of *names* that can be imported, which
+        is imported when one of its attributes is first used.
+    """
+
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            for name in self._names:
+                try:
+                    __import__(name)
+                except ImportError:
+                    continue
+
+                self._module = sys.modules[name]
+                break
+            else:
+                raise ImportError("No module named {0}".format(self._names[0]))
+
+        return getattr(self._module, attr)
+
+# Only streams fetch URLs, so these are loaded by the workers
+urllib = LazyModule("urllib.request", "urllib2")
+httplib = LazyModule("http.client", "httplib")
+
 try:
-    import urllib.request as urllib
+    import queue
 except ImportError:
-	import urllib2 as urllib
+    import Queue as queue
 
 try:
-    import sh as pbs
+    from StringIO import StringIO
 except ImportError:
-    import pbs
+    from io import StringIO
 
 try:
-    from urllib.parse import urlparse, parse_qs, urlencode
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 except ImportError:
-    from urlparse import urlparse, parse_qs
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+try:
+    from urllib.parse import urlparse, urljoin, parse_qs, urlencode
+except ImportError:
+    from urlparse import urlparse, urljoin, parse_qs
     from urllib import urlencode
 
+def load_pbs():
+    # Only rtmpdump streams run commands, so sh is loaded by them
+    try:
+        import sh as pbs
+    except ImportError:
+        import pbs
+
+    return pbs
+
 __all__ = ["is_py2", "is_py3", "is_win32", "input", "stdout", "str",
-           "bytes", "urllib", "urlparse", "parse_qs", "urlencode"]
+           "bytes", "urllib", "httplib", "StringIO", "urlparse", "urljoin", "parse_qs", "urlencode", "queue",
+           "HTTPServer", "BaseHTTPRequestHandler", "load_pbs"]
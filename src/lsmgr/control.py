@@ -0,0 +1,576 @@
+from .compat import is_win32, StringIO, input, queue
+from .metrics import describe_stats
+from .utils import port, size, optional_size, prebuffer
+
+import os
+import sys
+import cmd
+import json
+import errno
+import select
+import socket
+import threading
+
+if is_win32:
+    SOCKET_FILE = None
+else:
+    SOCKET_FILE = os.path.expanduser("~/.lsmgr.sock")
+
+READ_SIZE = 65536
+
+# Longest request line accepted, so a client can't make us buffer forever
+MAX_REQUEST = 1024 * 1024
+
+# Commands that may wait for streams, handled on a thread of their own
+SLOW_COMMANDS = ("kill", "exec")
+
+# Settings the config command can change and how their values are read
+CONFIG_TYPES = {
+    "player": str,
+    "prebuffer": prebuffer,
+    "ring_size": size,
+    "respawn_buffer": optional_size,
+    "timeshift": optional_size,
+    "min_port": port,
+    "max_port": port,
+    "loglevel": str,
+    "start_timeout": float,
+    "retry_max_failures": int,
+    "retry_min": float,
+    "retry_max": float,
+    "stall_timeout": float,
+    "http_connections": int,
+    "http_idle_timeout": float,
+    "batch_jobs": int,
+}
+
+class ControlError(Exception):
+    pass
+
+def captured(func, *args):
+    """
+        Calls *func* with *args* and returns its result and whatever
+        it printed. argparse errors exit, they are returned as False.
+    """
+    output = StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = output
+
+    try:
+        result = func(*args)
+    except SystemExit:
+        result = False
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    return result, output.getvalue()
+
+class ManagerLock(object):
+    """
+        Held while a request uses the manager. Commands that wait for
+        streams let go of it meanwhile, see Manager.waiting.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owner = None
+
+    def acquire(self):
+        self.lock.acquire()
+        self.owner = threading.current_thread()
+
+    def release(self):
+        self.owner = None
+        self.lock.release()
+
+    def held(self):
+        return self.owner is threading.current_thread()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+class Client(object):
+    """
+        A connection to the daemon with the requests read from it and
+        the replies waiting to be sent. A client is busy while one of
+        its requests is handled on a thread, the rest wait for it.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.input = b""
+        self.output = b""
+        self.busy = False
+
+    def next_line(self):
+        while b"\n" in self.input:
+            line, self.input = self.input.split(b"\n", 1)
+            if line.strip():
+                return line
+
+        return None
+
+class ControlServer(object):
+    """
+        Serves the manager on a Unix domain socket. Requests and replies
+        are JSON objects, one per line. Clients are read and written
+        without blocking from one select loop, which handles most
+        requests itself. Those that may wait for streams (SLOW_COMMANDS)
+        are handled on a thread each and answered when they are done,
+        the client's later requests wait for them. The manager is used
+        by one request at a time under a ManagerLock, which is let go
+        while streams are waited for. Streams are relayed by their own
+        processes and don't wait for any of this.
+    """
+
+    def __init__(self, manager, path):
+        self.manager = manager
+        self.path = path
+        self.clients = {}
+        self.running = False
+
+        self.lock = ManagerLock()
+        manager.lock = self.lock
+
+        # Commands run as typed print to a stdout of their own
+        self.exec_lock = threading.Lock()
+
+        # Replies of requests handled on threads
+        self.finished = queue.Queue()
+
+        if is_win32:
+            raise ControlError("The daemon is not supported on Windows")
+
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                # Left behind by a daemon that died
+                os.remove(path)
+            else:
+                raise ControlError("A daemon is already listening on {0}".format(path))
+            finally:
+                probe.close()
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.listener.bind(path)
+        finally:
+            os.umask(old_umask)
+
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+
+        self.wake_r, self.wake_w = os.pipe()
+
+    def serve_forever(self):
+        self.running = True
+
+        while self.running:
+            readers = [self.listener, self.wake_r] + list(self.clients)
+            writers = [sock for sock, client in self.clients.items() if client.output]
+
+            try:
+                r, w, x = select.select(readers, writers, [], 1)
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for sock in r:
+                if sock is self.listener:
+                    self.accept()
+                elif sock == self.wake_r:
+                    self.collect()
+                elif sock in self.clients:
+                    self.read(sock)
+
+            for sock in w:
+                if sock in self.clients:
+                    self.write(sock)
+
+    def close(self):
+        for sock, client in list(self.clients.items()):
+            # Replies to the last requests, to shutdown at least
+            if client.output:
+                try:
+                    sock.settimeout(1)
+                    sock.sendall(client.output)
+                except socket.error:
+                    pass
+
+            self.drop(sock)
+
+        self.listener.close()
+        self.manager.lock = None
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def accept(self):
+        try:
+            sock, addr = self.listener.accept()
+        except socket.error:
+            return
+
+        sock.setblocking(False)
+        self.clients[sock] = Client(sock)
+
+    def drop(self, sock):
+        self.clients.pop(sock, None)
+        sock.close()
+
+    def read(self, sock):
+        client = self.clients[sock]
+
+        try:
+            data = sock.recv(READ_SIZE)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            data = b""
+
+        if not data:
+            self.drop(sock)
+            return
+
+        client.input += data
+        self.handle(client)
+
+        if len(client.input) > MAX_REQUEST:
+            self.drop(sock)
+
+    def handle(self, client):
+        while not client.busy:
+            line = client.next_line()
+            if line is None:
+                return
+
+            request = self.parse(line)
+            if type(request) is not dict:
+                client.output += request
+            elif request.get("cmd") in SLOW_COMMANDS:
+                client.busy = True
+                thread = threading.Thread(target=self.handle_slow, args=(client, request))
+                thread.daemon = True
+                thread.start()
+            else:
+                with self.lock:
+                    client.output += self.reply(request)
+
+    def handle_slow(self, client, request):
+        self.finished.put((client, self.reply(request)))
+        os.write(self.wake_w, b"x")
+
+    def collect(self):
+        os.read(self.wake_r, 512)
+
+        while True:
+            try:
+                client, reply = self.finished.get_nowait()
+            except queue.Empty:
+                return
+
+            client.busy = False
+            if client.sock in self.clients:
+                client.output += reply
+                self.handle(client)
+
+    def write(self, sock):
+        client = self.clients[sock]
+
+        try:
+            sent = sock.send(client.output)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self.drop(sock)
+            return
+
+        client.output = client.output[sent:]
+
+    def parse(self, line):
+        """
+            Returns the request on *line*, or the reply to send if it
+            isn't a valid one.
+        """
+        try:
+            request = json.loads(line.decode("utf8"))
+        except ValueError as err:
+            return self.encode(dict(ok=False, error="Invalid request: {0}".format(err)))
+
+        if type(request) is not dict:
+            return self.encode(dict(ok=False, error="Requests must be JSON objects"))
+
+        return request
+
+    def encode(self, reply, request={}):
+        if "id" in request:
+            reply["id"] = request["id"]
+
+        return json.dumps(reply).encode("utf8") + b"\n"
+
+    def reply(self, request):
+        try:
+            handler = getattr(self, "do_" + str(request.get("cmd")), None)
+            if handler is None:
+                raise ControlError("Unknown command: {0}".format(request.get("cmd")))
+
+            reply = dict(ok=True, result=handler(request))
+        except ControlError as err:
+            reply = dict(ok=False, error=str(err))
+        except Exception as err:
+            reply = dict(ok=False, error="{0}: {1}".format(type(err).__name__, err))
+
+        return self.encode(reply, request)
+
+    def streams(self, request, unknown=None):
+        """
+            Returns the streams in the "ids" of *request*, every stream
+            if there are none or "all" is true. IDs not found are added
+            to *unknown* if it is given, or raise ControlError.
+        """
+        manager = self.manager
+        manager.remove_stale_streams()
+
+        if request.get("all") or "ids" not in request:
+            return list(manager.streamPool.values())
+
+        streams = []
+        for id in request["ids"]:
+            try:
+                streams.append(manager.streamPool[int(id)])
+            except (KeyError, ValueError, TypeError):
+                if unknown is None:
+                    raise ControlError("{0} is not a valid stream ID".format(id))
+                unknown.append(id)
+
+        return streams
+
+    def do_start(self, request):
+        """
+            Starts every stream in "streams", each an object with a
+            "url", a "stream" and any options of the stream command.
+            Returns the ID or error of each.
+        """
+        manager = self.manager
+        parser = manager.stream_parser()
+        results = []
+
+        for spec in request.get("streams", []):
+            options = [spec.get("url") or "", spec.get("stream") or ""]
+
+            for key, value in spec.items():
+                if key in ("url", "stream") or value is None or value is False:
+                    continue
+
+                options.append("--" + key.replace("_", "-"))
+                if value is not True:
+                    options.append(str(value))
+
+            args, output = captured(parser.parse_args, options)
+            if not args:
+                results.append(dict(error=output.strip().splitlines()[-1]))
+                continue
+
+            error = manager.prepare_stream(args)
+            if error:
+                results.append(dict(error=error))
+                continue
+
+            manager.add_stream(manager.launch_stream(args))
+            results.append(dict(id=args.id))
+
+        return results
+
+    def do_kill(self, request):
+        """
+            Kills the streams in "ids", or all of them if "all" is true.
+            IDs of streams that have already exited are returned as
+            unknown. Replies once they have exited.
+        """
+        if not request.get("all") and "ids" not in request:
+            raise ControlError("Give the streams to kill in \"ids\", or \"all\": true")
+
+        unknown = []
+        with self.lock:
+            streams = self.streams(request, unknown)
+            self.manager.kill_streams(streams)
+
+        return dict(killed=[stream.id for stream in streams], unknown=unknown)
+
+    def do_list(self, request):
+        if request.get("exited"):
+            return [dict(id=id, url=url, stream=stream, reason=reason)
+                    for id, url, stream, reason in self.manager.exitedStreams]
+
+        return [self.manager.stream_info(stream) for stream in self.streams(request)]
+
+    def do_stats(self, request):
+        stats = []
+
+        for stream in self.streams(request):
+            values = stream.get_stats()
+            if values is not None:
+                values = describe_stats(values)
+
+            stats.append(dict(id=stream.id, stats=values))
+
+        return stats
+
+    def do_config(self, request):
+        """
+            Changes the settings in "set", returns them all.
+        """
+        manager = self.manager
+
+        for key, value in (request.get("set") or {}).items():
+            if key not in CONFIG_TYPES:
+                raise ControlError("Unknown setting: {0}".format(key))
+
+            try:
+                value = CONFIG_TYPES[key](value)
+            except Exception as err:
+                raise ControlError("Invalid value for {0}: {1}".format(key, err))
+
+            setattr(manager.args, key, value)
+
+            if key == "loglevel":
+                manager.lsmgr.set_loglevel(value)
+            elif key in ("min_port", "max_port"):
+                manager.ports.set_range(manager.args.min_port, manager.args.max_port)
+
+        return dict((key, getattr(manager.args, key)) for key in CONFIG_TYPES)
+
+    def do_exec(self, request):
+        """
+            Runs a command line as typed at the prompt, returns what
+            it printed.
+        """
+        line = request.get("line") or ""
+        if line.split()[:1] in (["e"], ["exit"], ["EOF"]):
+            raise ControlError("The daemon keeps running, use shutdown to stop it")
+
+        manager = self.manager
+
+        with self.exec_lock:
+            with self.lock:
+                stdout = manager.stdout
+                output = StringIO()
+                manager.stdout = output
+
+                try:
+                    result, printed = captured(manager.onecmd, line)
+                finally:
+                    manager.stdout = stdout
+
+        return dict(output=output.getvalue() + printed)
+
+    def do_shutdown(self, request):
+        self.manager.killAllStreams()
+        self.running = False
+
+class ControlClient(object):
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.file = self.sock.makefile("rb")
+
+    def request(self, command, **params):
+        """
+            Sends a request and returns its result, raises ControlError
+            with the error of a failed one.
+        """
+        params["cmd"] = command
+        self.sock.sendall(json.dumps(params).encode("utf8") + b"\n")
+
+        line = self.file.readline()
+        if not line:
+            raise ControlError("The daemon closed the connection")
+
+        reply = json.loads(line.decode("utf8"))
+        if not reply["ok"]:
+            raise ControlError(reply["error"])
+
+        return reply["result"]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+class RemoteShell(cmd.Cmd):
+    """
+        The prompt of the manager, with every command run by a daemon.
+    """
+    prompt = "lsmgr$ "
+
+    def __init__(self, path):
+        cmd.Cmd.__init__(self)
+        self.client = ControlClient(path)
+
+    def run(self, line):
+        try:
+            result = self.client.request("exec", line=line)
+        except ControlError as err:
+            print(err)
+            return
+
+        sys.stdout.write(result["output"])
+
+    def confirm(self, msg):
+        while True:
+            answer = input(msg).lower()
+            if "y" in answer:
+                return True
+            elif "n" in answer:
+                return False
+
+    def default(self, line):
+        self.run(line)
+
+    def do_help(self, args):
+        self.run("help " + args)
+
+    def do_k(self, args):
+        return self.do_kill(args)
+
+    def do_kill(self, args):
+        words = args.split()
+        if "-h" in words or "--help" in words or "-y" in words or "--yes" in words:
+            self.run("kill " + args)
+            return
+
+        if words and self.confirm("Are you sure you want to kill {0}? (y/n) ".format(" ".join(words))):
+            self.run("kill -y " + args)
+        elif not words:
+            self.run("kill")
+
+    def do_shutdown(self, args):
+        "Kill every stream and stop the daemon"
+        if self.confirm("Are you sure you want to stop the daemon and its streams? (y/n) "):
+            try:
+                self.client.request("shutdown")
+            except ControlError as err:
+                print(err)
+                return False
+            return True
+
+    def do_e(self, args):
+        return True
+
+    def do_exit(self, args):
+        "Leave the daemon running and exit"
+        return True
+
+    def do_EOF(self, args):
+        print("")
+        return True
+
+__all__ = ["ControlServer", "ControlClient", "ControlError", "RemoteShell", "SOCKET_FILE"]
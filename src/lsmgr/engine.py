@@ -0,0 +1,634 @@
+from .compat import queue, stdout
+from .relay import Relay, RelayError, OutputError, is_fifo
+from .hub import Sink, StreamHub
+from .stream import StreamHandler, StreamThread, new_session, set_session_options
+from .metrics import STATS_INTERVAL
+from .players import PlayerPool, standby_command
+from .reaper import reaper
+
+import os
+import time
+import select
+import threading
+import multiprocessing
+
+class Executor(object):
+    """
+        A fixed number of threads that run blocking calls (plugin
+        resolution, opening streams and players) off the event loop.
+    """
+
+    def __init__(self, workers, logger):
+        self.jobs = queue.Queue()
+        self.logger = logger
+
+        for i in range(max(workers, 1)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, func, *args):
+        self.jobs.put((func, args))
+
+    def _work(self):
+        while True:
+            func, args = self.jobs.get()
+            try:
+                func(*args)
+            except Exception as err:
+                self.logger.error("Unhandled error in engine job: {0}", err)
+
+class EngineChannel(object):
+    """
+        Stands in for the queue of a StreamThread for streams
+        hosted by the engine.
+    """
+
+    def __init__(self, engine, id):
+        self.engine = engine
+        self.id = id
+        self.commands = queue.Queue()
+
+    def put(self, data):
+        # Replies about attached outputs already carry their stream ID
+        if type(data) is tuple and data[0] not in ("resolved", "phase", "pids"):
+            self.engine.status.put(data)
+        else:
+            self.engine.status.put((self.id, data))
+
+    def get(self, block=None, timeout=None):
+        if self.id in self.engine.killed:
+            return "kill"
+
+        return self.commands.get(block, timeout)
+
+    def put_stats(self, values):
+        self.engine.stats[self.id] = values
+
+class Engine(object):
+    """
+        Runs every stream in a single process. Data from rtmpdump is moved
+        to the outputs by a select() loop, everything that may block is
+        pushed to an Executor.
+
+        Streams share one Livestreamer session, whose options are set
+        from the arguments of each stream before it is found. Plugins and
+        streams read them as they are created, so session_lock is held
+        from setting them until the stream is found, and URLs that are not
+        cached are resolved one at a time. Streams are opened and relayed
+        concurrently.
+    """
+
+    def __init__(self, lsmgr, args, commands, status):
+        self.lsmgr = lsmgr
+        self.logger = lsmgr.logger.new_module("engine")
+        self.commands = commands
+        self.status = status
+
+        self.session = new_session(args)
+        self.session_lock = threading.Lock()
+        self.executor = Executor(args.engine_workers, self.logger)
+
+        self.standby = None
+        if args.standby_players:
+            self.standby = PlayerPool(args.standby_players, lsmgr.logger.new_module("players"),
+                                      standby_command(args))
+
+        # Only changed from the event loop, other threads hand
+        # their changes to it with call()
+        self.outputs = {}
+        self.running = False
+
+        self.handlers = {}
+        self.channels = {}
+        self.owners = {}
+        self.threaded = set()
+        self.killed = set()
+
+        # Timers of streams waiting to reconnect
+        self.retries = {}
+
+        self.calls = queue.Queue()
+        self.wake_r, self.wake_w = os.pipe()
+
+        # Stats of every stream, sent to the manager together
+        self.stats = {}
+        self.stats_sent = 0
+        self.stall_checked = 0
+
+    def run(self):
+        control = threading.Thread(target=self._control)
+        control.daemon = True
+        control.start()
+
+        self.running = True
+        while self.running:
+            self._poll()
+
+    def call(self, func, *args):
+        """
+            Runs *func* on the event loop, can be called from any thread.
+        """
+        self.calls.put((func, args))
+        os.write(self.wake_w, b"x")
+
+    def _control(self):
+        while True:
+            command = self.commands.get()
+
+            if command[0] == "start":
+                self.call(self._register, command[1], command[2])
+            elif command[0] == "attach":
+                self.call(self._route_attach, *command[1:])
+            elif command[0] == "kill":
+                self.call(self._kill, command[1])
+            elif command[0] == "exit":
+                self.call(self._exit)
+                return
+
+    def _poll(self):
+        readers = {self.wake_r: None}
+        writers = {}
+
+        for id, (handler, stream, output, player) in self.outputs.items():
+            if isinstance(output, StreamHub):
+                readers.update((fd, id) for fd in output.readers())
+                writers.update((fd, id) for fd in output.writers())
+            elif output.wants_write():
+                writers[output.out.fileno()] = id
+            else:
+                readers[output.fd.fileno()] = id
+
+        # Wakes up to send stats of streams relayed on their own threads
+        r, w, x = select.select(list(readers), list(writers), [], STATS_INTERVAL)
+
+        ready = set(readers[fd] for fd in r if fd != self.wake_r)
+        ready.update(writers[fd] for fd in w)
+
+        for id in ready:
+            self._pump(id, r, w)
+
+        if self.wake_r in r:
+            os.read(self.wake_r, 512)
+            while not self.calls.empty():
+                func, args = self.calls.get()
+                func(*args)
+
+        now = time.time()
+        if self.stats and now - self.stats_sent >= STATS_INTERVAL:
+            stats, self.stats = self.stats, {}
+            self.stats_sent = now
+            self.status.put((None, ("stats", stats)))
+
+        if now - self.stall_checked >= STATS_INTERVAL:
+            self.stall_checked = now
+            self._check_stalls(now)
+
+    def _check_stalls(self, now):
+        for id, (handler, stream, output, player) in list(self.outputs.items()):
+            if handler.supervisor.stalled(output.fd, now):
+                handler.stall(stream)
+                self._finish(id)
+
+    def _pump(self, id, readable, writable):
+        if id not in self.outputs:
+            return
+
+        handler, stream, output, player = self.outputs[id]
+        try:
+            if isinstance(output, StreamHub):
+                length = output.pump_ready(readable, writable)
+
+                for sink in output.take_failed():
+                    sink.close()
+                    self.executor.submit(self._reopen_sink, id, sink.id)
+
+                if length:
+                    handler.stats.received(length, output.take_written())
+            else:
+                length = output.pump_nonblocking()
+
+                if length:
+                    handler.stats.received(length)
+        except OutputError as err:
+            if isinstance(output, Relay) and player is not None:
+                # Restarted off the loop, the stream waits in its pipe
+                del self.outputs[id]
+                self.executor.submit(self._respawn, id, handler, stream, output, player, err)
+                return
+
+            self.logger.error(str(err))
+            length = 0
+        except RelayError as err:
+            self.logger.error(str(err))
+            length = 0
+
+        if length == 0:
+            self._finish(id)
+
+    def _finish(self, id):
+        handler, stream, output, player = self.outputs.pop(id)
+
+        if id in self.killed or not handler.sinks or (isinstance(output, StreamHub) and not output.sinks):
+            handler.close_output(output, player)
+            self._exited(id)
+        else:
+            handler.release_output(output, player, False)
+            self._retry(id, handler, stream)
+
+    def _retry(self, id, handler, stream):
+        """
+            Reconnects the stream when its Supervisor says so.
+        """
+        delay = handler.supervisor.failed()
+        if delay is None:
+            handler.logger.error("Giving up on stream after {0} failures in a row", handler.supervisor.failures)
+            handler.close_kept()
+            self._exited(id)
+            return
+
+        handler.logger.info("Reconnecting in {0:.1f} seconds", delay)
+        handler.set_phase("reconnecting")
+
+        timer = threading.Timer(delay, self.call, (self._retry_due, id, handler, stream))
+        timer.daemon = True
+        self.retries[id] = timer
+        timer.start()
+
+    def _retry_due(self, id, handler, stream):
+        # Gone if the stream was killed while waiting
+        if self.retries.pop(id, None):
+            self.executor.submit(self._open, id, handler, stream)
+
+    def _exited(self, owner):
+        ids = set([owner])
+
+        handler = self.handlers.pop(owner, None)
+        if handler:
+            ids.update(handler.sinks)
+            handler.close_timeshift()
+
+        for id, owner_ in list(self.owners.items()):
+            if owner_ == owner:
+                ids.add(id)
+                del self.owners[id]
+
+        self.channels.pop(owner, None)
+        self.threaded.discard(owner)
+
+        for id in ids:
+            self.status.put((id, "exited"))
+
+    def _register(self, id, args):
+        channel = EngineChannel(self, id)
+        handler = StreamHandler(self.lsmgr, args, channel, self.session, self.standby)
+
+        self.handlers[id] = handler
+        self.channels[id] = channel
+        self.executor.submit(self._start, id, handler, args)
+
+    def _route_attach(self, owner, id, args):
+        self.owners[id] = owner
+
+        if owner in self.threaded:
+            self.channels[owner].commands.put(("attach", id, args))
+        else:
+            self.executor.submit(self._attach, owner, id, args)
+
+    def _start(self, id, handler, args):
+        with self.session_lock:
+            set_session_options(self.session, args)
+
+            try:
+                stream = handler.find_stream()
+            except Exception as err:
+                self.logger.error("Failed to find stream: {0}", err)
+                stream = None
+
+        if stream is None:
+            self.call(self._exited, id)
+            return
+
+        self._open(id, handler, stream)
+
+    def _open(self, id, handler, stream):
+        if id in self.killed or not handler.sinks:
+            handler.close_kept()
+            self.call(self._exited, id)
+            return
+
+        try:
+            opened = handler.open_output(stream)
+        except Exception as err:
+            self.logger.error("Failed to open stream: {0}", err)
+            opened = False
+
+        if not opened:
+            self.call(self._retry, id, handler, stream)
+            return
+
+        output, player, progress = opened
+
+        if isinstance(output, StreamHub):
+            hosted = output.fifo
+        else:
+            hosted = is_fifo(output.fd) and output.out is not stdout
+
+        if hosted:
+            if isinstance(output, Relay):
+                output.set_nonblocking()
+            self.call(self._add, id, handler, stream, output, player)
+        else:
+            # Not a raw pipe, relay it with blocking calls on its own thread.
+            self.call(self._add_threaded, id, handler, stream, output, player, progress)
+
+    def _add_threaded(self, id, handler, stream, output, player, progress):
+        self.threaded.add(id)
+
+        thread = threading.Thread(target=self._relay,
+                                  args=(id, handler, stream, output, player, progress))
+        thread.daemon = True
+        thread.start()
+
+    def _relay(self, id, handler, stream, output, player, progress):
+        if handler.relay_output(output, player, progress, stream=stream):
+            self.call(self._retry, id, handler, stream)
+        else:
+            self.call(self._exited, id)
+
+    def _add(self, id, handler, stream, output, player, failed=False):
+        self.outputs[id] = (handler, stream, output, player)
+
+        if failed or id in self.killed:
+            self._finish(id)
+
+    def _respawn(self, id, handler, stream, output, player, err):
+        respawned = handler.respawn_player(output, player)
+        if respawned is None:
+            handler.logger.error(str(err))
+            self.call(self._add, id, handler, stream, output, player, True)
+            return
+
+        player, data = respawned
+        output.set_nonblocking()
+        output.pending = data
+        self.call(self._add, id, handler, stream, output, player)
+
+    def _attach(self, owner, id, args):
+        handler = self.handlers.get(owner)
+        if handler is None or owner in self.killed or not handler.prepare_output(args):
+            self.call(self._sink_failed, id)
+            return
+
+        handler.sinks[id] = args
+        opened = handler.open_sink(args)
+        if not opened:
+            handler.sinks.pop(id, None)
+            self.call(self._sink_failed, id)
+            return
+
+        self.call(self._add_sink, owner, Sink(id, opened[0], opened[1]))
+
+    def _reopen_sink(self, owner, id):
+        handler = self.handlers.get(owner)
+        if handler is None or id not in handler.sinks:
+            return
+
+        opened = handler.open_sink(handler.sinks[id])
+        if opened:
+            self.call(self._add_sink, owner, Sink(id, opened[0], opened[1]), True)
+        else:
+            handler.sinks.pop(id, None)
+            self.call(self._sink_failed, id, False)
+
+    def _sink_failed(self, id, failed=True):
+        self.owners.pop(id, None)
+
+        if failed:
+            self.status.put((id, "failed"))
+        self.status.put((id, "exited"))
+
+    def _add_sink(self, owner, sink, restarted=False):
+        if owner not in self.outputs:
+            # The stream is reconnecting, the sink is opened
+            # again with the rest of its outputs.
+            sink.close()
+            return
+
+        handler, stream, output, player = self.outputs[owner]
+        if isinstance(output, Relay):
+            output = handler.start_hub(output, player)
+            self.outputs[owner] = (handler, stream, output, None)
+
+        # Sinks that failed carry on from the most recent data, as new ones do
+        output.add(sink)
+
+        if not restarted:
+            handler.logger.info("Attached stream {0} to {1}", sink.id, handler.args.url)
+            self.status.put((sink.id, "started"))
+
+    def _kill(self, id):
+        owner = self.owners.pop(id, id)
+        handler = self.handlers.get(owner)
+
+        if handler and set(handler.sinks) - set([id]):
+            # Other outputs still use the stream, only detach this one
+            handler.sinks.pop(id, None)
+
+            if owner in self.retries:
+                if isinstance(handler.kept, StreamHub):
+                    sink = handler.kept.remove(id)
+                    if sink:
+                        sink.close()
+            elif owner in self.threaded:
+                self.channels[owner].commands.put(("detach", id))
+            elif owner in self.outputs:
+                output = self.outputs[owner][2]
+                if isinstance(output, StreamHub):
+                    sink = output.remove(id)
+                    if sink:
+                        sink.close()
+
+            self.status.put((id, "exited"))
+            return
+
+        self.killed.add(owner)
+
+        # Wakes a stream waiting for commands
+        channel = self.channels.get(owner)
+        if channel:
+            channel.commands.put("kill")
+
+        timer = self.retries.pop(owner, None)
+        if timer:
+            timer.cancel()
+            handler.logger.info("Closing stream")
+            handler.close_kept()
+            self._exited(owner)
+        elif owner in self.outputs:
+            self.outputs[owner][0].logger.info("Closing stream")
+            self._finish(owner)
+
+    def _exit(self):
+        for id in list(self.outputs):
+            self.killed.add(id)
+            self._finish(id)
+
+        for id, timer in list(self.retries.items()):
+            timer.cancel()
+            self.handlers[id].close_kept()
+
+        if self.standby:
+            self.standby.close()
+
+        self.running = False
+
+def run_engine(lsmgr, args, commands, status):
+    try:
+        Engine(lsmgr, args, commands, status).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        lsmgr.logger.flush()
+
+class EngineStream(StreamThread):
+    """
+        A stream hosted by the engine. Has the same interface as
+        StreamThread so the manager can list and kill it.
+    """
+
+    def __init__(self, engine, id, args, owner=None):
+        self.engine = engine
+        self.id = id
+        self.args = args
+        self.owner = owner or self
+        self.sinks = set([id])
+        self.stats = None
+        self.exit_reason = None
+        self.phase = owner and "attaching" or "starting"
+        self.started = threading.Event()
+        self.exited = threading.Event()
+        self.pids = []
+
+    def on_status(self, msg):
+        if type(msg) is tuple and msg[0] == "phase":
+            self.phase = msg[1]
+        elif type(msg) is tuple and msg[0] == "pids":
+            self.pids = msg[1]
+        elif msg == "started":
+            self.phase = "running"
+            self.started.set()
+        elif msg == "failed":
+            self.phase = "failed"
+        elif msg == "exited":
+            self.owner.sinks.discard(self.id)
+            self.exit_reason = "finished"
+            self.exited.set()
+
+            # Not a process of its own, but exits are reported the same
+            reaper.notify(self)
+
+    def running(self):
+        return not self.exited.is_set() and self.engine.is_alive()
+
+    def kill_stream(self):
+        self.owner.sinks.discard(self.id)
+        self.engine.commands.put(("kill", self.id))
+
+    def join_stream(self):
+        while not self.exited.is_set() and self.engine.is_alive():
+            self.exited.wait(0.1)
+
+    def is_alive(self):
+        return not self.exited.is_set() and self.engine.is_alive()
+
+    def hub_open(self):
+        return len(self.owner.sinks) > 0 and self.engine.is_alive()
+
+    def get_pids(self):
+        # The engine process plays every stream, only children are this one's
+        return None, list(self.pids)
+
+    def get_stats(self):
+        return self.owner.stats
+
+    def attach(self, id, args):
+        owner = self.owner
+        stream = EngineStream(self.engine, id, args, owner)
+
+        owner.sinks.add(id)
+        self.engine.streams[id] = stream
+        self.engine.commands.put(("attach", owner.id, id, args))
+
+        return stream
+
+class StreamEngine(object):
+    """
+        Manager side of the engine. The worker process is started
+        with the first stream.
+    """
+
+    def __init__(self, lsmgr, args, cache=None):
+        self.lsmgr = lsmgr
+        self.args = args
+        self.cache = cache
+        self.streams = {}
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.commands = multiprocessing.Queue()
+        self.status = multiprocessing.Queue()
+
+        self.process = multiprocessing.Process(target=run_engine,
+                                               args=(self.lsmgr, self.args, self.commands, self.status))
+        self.process.daemon = True
+        self.process.start()
+
+        dispatcher = threading.Thread(target=self._dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start_stream(self, id, args):
+        # Batches start streams from several threads
+        with self.lock:
+            if self.process is None:
+                self.start()
+
+        stream = EngineStream(self, id, args)
+        self.streams[id] = stream
+        self.commands.put(("start", id, args))
+
+        return stream
+
+    def shutdown(self):
+        if not self.is_alive():
+            return
+
+        self.commands.put(("exit",))
+        self.process.join(5)
+
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def _dispatch(self):
+        while True:
+            try:
+                id, msg = self.status.get()
+            except (EOFError, IOError):
+                return
+
+            if type(msg) is tuple and msg[0] == "resolved":
+                if self.cache is not None:
+                    self.cache.set(msg[1], msg[2])
+            elif type(msg) is tuple and msg[0] == "stats":
+                for id, values in msg[1].items():
+                    if id in self.streams:
+                        self.streams[id].stats = values
+            elif id in self.streams:
+                self.streams[id].on_status(msg)
+
+__all__ = ["Engine", "EngineStream", "StreamEngine", "run_engine"]
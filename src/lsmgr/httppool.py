@@ -0,0 +1,321 @@
+from .compat import httplib, urllib, urlparse, urljoin
+
+import io
+import time
+import socket
+import threading
+
+# Idle connections kept open to each host
+MAX_CONNECTIONS = 4
+
+# Idle connections older than this are closed
+IDLE_TIMEOUT = 60
+
+# Reads from HTTP streams that wait longer than this are retried
+STREAM_TIMEOUT = 30
+
+# Times a stream is resumed in a row without getting any data
+RESUME_ATTEMPTS = 3
+
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+class ConnectionPool(object):
+    """
+        Keeps HTTP connections open after a request so the next request
+        to the same host can skip the TCP and TLS handshakes. Up to
+        max_connections idle connections are kept per host, requests
+        beyond that get a connection that is closed when done.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def configure(self, max_connections, idle_timeout):
+        with self.lock:
+            self.max_connections = max_connections
+            self.idle_timeout = idle_timeout
+            self._evict(time.time())
+
+    def acquire(self, key, timeout):
+        """
+            Returns an idle connection to the (scheme, host, port) *key*
+            or a new one, and whether it was reused.
+        """
+        with self.lock:
+            self._evict(time.time())
+
+            idle = self.idle.get(key)
+            if idle:
+                conn, released = idle.pop()
+
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+
+                return conn, True
+
+        return self.connect(key, timeout), False
+
+    def connect(self, key, timeout):
+        scheme, host, port = key
+
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, port, timeout=timeout)
+
+        return httplib.HTTPConnection(host, port, timeout=timeout)
+
+    def release(self, key, conn):
+        with self.lock:
+            now = time.time()
+            self._evict(now)
+
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_connections:
+                idle.append((conn, now))
+                return
+
+        conn.close()
+
+    def _evict(self, now):
+        for key, idle in list(self.idle.items()):
+            for conn, released in idle:
+                if now - released >= self.idle_timeout:
+                    conn.close()
+
+            idle[:] = [(conn, released) for conn, released in idle
+                       if now - released < self.idle_timeout]
+
+            if not idle:
+                del self.idle[key]
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, released in idle:
+                    conn.close()
+
+            self.idle = {}
+
+    def request(self, url, data=None, headers={}, timeout=None):
+        """
+            Requests *url* and returns a PooledResponse once the headers
+            are read, redirects are followed. Errors are raised as
+            urllib.HTTPError and urllib.URLError like urlopen does.
+        """
+        headers = dict(headers)
+
+        for i in range(MAX_REDIRECTS + 1):
+            response = self._request(url, data, headers, timeout)
+            status = response.getcode()
+
+            if status in REDIRECT_CODES and response.info().get("Location"):
+                response.read()
+                response.close()
+
+                url = urljoin(url, response.info().get("Location"))
+
+                # Only these keep the method and body
+                if status not in (307, 308):
+                    data = None
+
+                continue
+
+            if status >= 300:
+                body = io.BytesIO(response.read())
+                response.close()
+
+                raise urllib.HTTPError(url, status, response.response.reason,
+                                       response.info(), body)
+
+            return response
+
+        raise urllib.URLError("Too many redirects")
+
+    def _request(self, url, data, headers, timeout):
+        parsed = urlparse(url)
+        scheme = parsed.scheme.lower()
+        key = (scheme, parsed.hostname, parsed.port or DEFAULT_PORTS[scheme])
+
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+
+        method = data is None and "GET" or "POST"
+        conn, reused = self.acquire(key, timeout)
+
+        while True:
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as err:
+                conn.close()
+
+                # The server may have closed an idle connection
+                # without us noticing, try once more on a new one.
+                if reused:
+                    conn, reused = self.connect(key, timeout), False
+                    continue
+
+                raise urllib.URLError(err)
+
+            return PooledResponse(self, key, conn, response, url)
+
+class PooledResponse(object):
+    """
+        File-like response that hands its connection back to the pool
+        once the body has been read.
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+
+    def read(self, size=-1):
+        if self.conn is None:
+            return b""
+
+        try:
+            if size is None or size < 0:
+                data = self.response.read()
+            else:
+                data = self.response.read(size)
+        except httplib.HTTPException as err:
+            self.close()
+            raise IOError(err)
+
+        if self.response.isclosed():
+            self._finish()
+
+        return data
+
+    def _finish(self):
+        # Python 2 ends a body cut short as if it was all there
+        if self.response.will_close or self.response.length:
+            self.conn.close()
+        else:
+            self.pool.release(self.key, self.conn)
+
+        self.conn = None
+
+    def close(self):
+        if self.conn is None:
+            return
+
+        # A connection with unread data left can't be used again
+        if not self.response.isclosed():
+            self.response.close()
+            self.conn.close()
+            self.conn = None
+        else:
+            self._finish()
+
+    def fileno(self):
+        return self.conn.sock.fileno()
+
+    def info(self):
+        return self.response.msg
+
+    @property
+    def headers(self):
+        return self.response.msg
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.response.status
+
+class ResumableResponse(object):
+    """
+        Reads an HTTP stream and, when the connection drops before
+        the end, requests the rest with a Range header if the server
+        supports it.
+    """
+
+    def __init__(self, pool, url, headers={}, timeout=STREAM_TIMEOUT):
+        self.pool = pool
+        self.url = url
+        self.headers = dict(headers)
+        self.timeout = timeout
+        self.fd = pool.request(url, headers=headers, timeout=timeout)
+        self.offset = 0
+        self.attempts = 0
+
+        info = self.fd.info()
+        length = info.get("Content-Length")
+
+        self.length = length and int(length)
+        self.resumable = self.length is not None and info.get("Accept-Ranges") == "bytes"
+
+    def read(self, size=-1):
+        while True:
+            try:
+                data = self.fd.read(size)
+            except (IOError, OSError) as err:
+                self._resume(err)
+                continue
+
+            if data:
+                self.offset += len(data)
+                self.attempts = 0
+                return data
+
+            if self.length is None or self.offset >= self.length:
+                return data
+
+            self._resume("connection closed after {0} of {1} bytes".format(self.offset, self.length))
+
+    def _resume(self, reason):
+        if not self.resumable or self.attempts >= RESUME_ATTEMPTS:
+            raise IOError("Lost connection to stream: {0}".format(reason))
+
+        self.attempts += 1
+        self.fd.close()
+
+        headers = dict(self.headers)
+        headers["Range"] = "bytes={0}-".format(self.offset)
+
+        try:
+            fd = self.pool.request(self.url, headers=headers, timeout=self.timeout)
+        except (IOError, OSError) as err:
+            raise IOError("Lost connection to stream: {0}".format(err))
+
+        if fd.getcode() != 206:
+            fd.close()
+            raise IOError("Lost connection to stream and the server did not resume it")
+
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd.fileno()
+
+    def info(self):
+        return self.fd.info()
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        self.fd.close()
+
+def is_pooled(url):
+    """
+        Returns whether *url* can be requested through the pool, proxied
+        and non-HTTP URLs are left to urllib.
+    """
+    scheme = urlparse(url).scheme.lower()
+
+    return scheme in DEFAULT_PORTS and scheme not in urllib.getproxies()
+
+# Shared by everything in this process
+pool = ConnectionPool()
+
+__all__ = ["ConnectionPool", "PooledResponse", "ResumableResponse", "is_pooled", "pool"]
@@ -0,0 +1,303 @@
+from .compat import urlparse, stdout
+from .buffer import catch_up, flv_skip, flv_sync
+from .relay import RelayError, OutputError, is_fifo, set_nonblocking
+
+from collections import deque
+
+import os
+import errno
+
+SINK_BUFFER = 2 * 1024 * 1024
+HUB_CHUNK = 65536
+
+def hub_key(url, stream):
+    """
+        Returns the key streams are shared on, URLs that only differ
+        by scheme, "www." or a trailing slash are the same channel.
+    """
+    if "://" not in url:
+        url = "http://" + url
+
+    parsed = urlparse(url)
+    host = parsed.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+
+    return (host + parsed.path.rstrip("/"), stream)
+
+class Sink(object):
+    """
+        An output attached to a StreamHub. Data waiting to be written is
+        kept in a bounded buffer, a slow sink loses its oldest data
+        instead of holding up the others. What is left of an FLV stream
+        (*flv*) is cut where tags start, from a keyframe if possible.
+    """
+
+    def __init__(self, id, out, player=None, limit=SINK_BUFFER, flv=False):
+        self.id = id
+        self.out = out
+        self.player = player
+        self.limit = limit
+        self.flv = flv
+
+        self.chunks = deque()
+        self.buffered = 0
+        self.dropped = 0
+        self.written = 0
+        self.waiting = False
+
+        # Unwritten bytes that are never dropped, the start of what the
+        # sink is sent and the rest of a chunk that is partly written
+        self.pinned = 0
+        self.partial = 0
+
+    def push(self, data, pin=False):
+        """
+            Adds *data* to the buffer. Data that is pinned, with what is
+            already in the buffer, is written whatever it takes.
+        """
+        self.chunks.append(data)
+        self.buffered += len(data)
+
+        if pin:
+            self.pinned = self.buffered
+
+        if self.buffered > self.limit:
+            self.skip()
+
+    def skip(self):
+        """
+            Drops the oldest data that can go, leaving half the limit.
+        """
+        data = b"".join(self.chunks)
+        start = max(self.pinned, self.partial)
+        keep = self.limit // 2
+
+        cut = None
+        if self.flv:
+            cut = flv_skip(bytearray(data), start, keep)
+
+        if cut is None:
+            cut = (start, max(start, len(data) - keep))
+
+        end, resume = cut
+        self.chunks = deque(chunk for chunk in (data[:end], data[resume:]) if chunk)
+        self.buffered = len(data) - (resume - end)
+        self.dropped += 1
+
+    def wants_write(self):
+        return self.buffered > 0
+
+    def flush(self):
+        """
+            Writes as much of the buffer as the output takes.
+            Returns the number of bytes written.
+        """
+        total = 0
+
+        while self.chunks:
+            chunk = self.chunks[0]
+
+            try:
+                written = os.write(self.out.fileno(), chunk)
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    break
+                raise OutputError("Error when writing to output: {0}".format(err))
+
+            total += written
+            self.buffered -= written
+            if written < len(chunk):
+                self.chunks[0] = chunk[written:]
+                self.partial = len(chunk) - written
+                break
+
+            self.chunks.popleft()
+            self.partial = 0
+
+        self.pinned = max(self.pinned - total, 0)
+        self.written += total
+
+        return total
+
+    def close(self):
+        if self.out is not stdout:
+            try:
+                self.out.close()
+            except:
+                pass
+
+        if self.player:
+            try:
+                self.player.kill()
+            except:
+                pass
+
+class StreamHub(object):
+    """
+        Reads a stream once and tees it to any number of sinks. The first
+        chunk of the stream (the FLV header) is kept and sent to sinks
+        that attach later or are restarted, with up to *keep* bytes of
+        the most recent data. *recent* is what was read after the header
+        before the hub took over the stream, None if nothing was. What is
+        read is also written to *tap*, if there is one.
+    """
+
+    def __init__(self, fd, header=b"", keep=0, tap=None, recent=None):
+        self.fd = fd
+        self.header = header
+        self.tap = tap
+        self.sinks = {}
+        self.failed = []
+        self.fifo = is_fifo(fd)
+        self.written = 0
+
+        self.keep = keep
+        self.recent = deque()
+        self.kept = 0
+
+        # Nothing has been read past the header, it runs on into the stream
+        self.fresh = recent is None
+        if recent and keep:
+            self._keep(recent)
+
+    def set_source(self, fd, header=b""):
+        """
+            Reads from *fd* from now on, used when the
+            stream reconnects to keep the sinks running.
+        """
+        self.fd = fd
+        self.header = header
+        self.fifo = is_fifo(fd)
+        self.recent.clear()
+        self.kept = 0
+        self.fresh = True
+
+    def catch_up(self):
+        """
+            Returns the data a sink that starts now is sent first.
+        """
+        if self.fresh:
+            return self.header
+
+        return catch_up(self.header, b"".join(self.recent))
+
+    def add(self, sink, header=True):
+        """
+            Attaches *sink*, which starts with the header and the most
+            recent data unless *header* is False, for an output that
+            has been sent the stream so far.
+        """
+        if sink.out is not stdout:
+            set_nonblocking(sink.out)
+
+        sink.flv = self.header[:3] == b"FLV"
+        if header and self.header:
+            if self.fresh or self.recent:
+                sink.push(self.catch_up(), pin=True)
+            else:
+                # Nothing recent is kept, it starts with what is read next
+                sink.waiting = True
+
+        self.sinks[sink.id] = sink
+
+    def remove(self, id):
+        return self.sinks.pop(id, None)
+
+    def take_failed(self):
+        failed, self.failed = self.failed, []
+        return failed
+
+    def take_written(self):
+        """
+            Returns the bytes written to all sinks since the last call.
+        """
+        written, self.written = self.written, 0
+        return written
+
+    def readers(self):
+        if self.fifo:
+            return [self.fd.fileno()]
+
+        return []
+
+    def writers(self):
+        return [sink.out.fileno() for sink in self.sinks.values() if sink.wants_write()]
+
+    def pump_ready(self, readable, writable):
+        """
+            Writes to the sinks in *writable* and reads from the stream if
+            it is in *readable*. Streams that are not raw pipes are always
+            read. Returns the number of bytes read, 0 at end of stream and
+            None if nothing was read. Sinks that fail are removed and can
+            be collected with take_failed.
+        """
+        for sink in list(self.sinks.values()):
+            if sink.out.fileno() in writable:
+                self._flush(sink)
+
+        if self.fifo and self.fd.fileno() not in readable:
+            return None
+
+        try:
+            if self.fifo:
+                data = os.read(self.fd.fileno(), HUB_CHUNK)
+            else:
+                data = self.fd.read(HUB_CHUNK)
+        except (IOError, OSError) as err:
+            raise RelayError("Error when reading from stream: {0}".format(err))
+
+        if len(data) == 0:
+            return 0
+
+        self.fresh = False
+        if self.keep:
+            self._keep(data)
+
+        if self.tap is not None:
+            self.tap.write(data)
+
+        for sink in list(self.sinks.values()):
+            if sink.waiting:
+                self._start(sink, data)
+            else:
+                sink.push(data)
+            self._flush(sink)
+
+        return len(data)
+
+    def _start(self, sink, data):
+        # FLV sinks wait for data with a whole tag in it to start from
+        if sink.flv and flv_sync(bytearray(data)) is None:
+            return
+
+        sink.waiting = False
+        sink.push(catch_up(self.header, data), pin=True)
+
+    def _keep(self, data):
+        self.recent.append(data)
+        self.kept += len(data)
+
+        while self.kept - len(self.recent[0]) >= self.keep:
+            self.kept -= len(self.recent.popleft())
+
+    def _flush(self, sink):
+        try:
+            self.written += sink.flush()
+        except RelayError:
+            self.remove(sink.id)
+            self.failed.append(sink)
+
+    def close(self):
+        try:
+            self.fd.close()
+        except:
+            pass
+
+        for sink in self.sinks.values():
+            sink.close()
+
+        for sink in self.take_failed():
+            sink.close()
+
+__all__ = ["Sink", "StreamHub", "hub_key"]
@@ -1,4 +1,10 @@
+import os
 import sys
+import threading
+import multiprocessing
+
+# Records of other processes are sent to the collector this often
+BATCH_TIME = 0.1
 
 class Logger(object):
     Levels = ["none", "error", "warning", "info", "debug"]
@@ -8,6 +14,26 @@ class Logger(object):
         self.output = sys.stdout
         self.level = 0
 
+        # Set when a LogCollector writes the records of every process
+        self.channel = None
+        self.pid = os.getpid()
+        self._reset_batch()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("lock", "pending", "sender"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.sender = None
+
     def new_module(self, module):
         return LoggerModule(self, module)
 
@@ -22,22 +48,69 @@ class Logger(object):
     def set_output(self, output):
         self.output = output
 
+    def set_channel(self, channel):
+        self.channel = channel
+        self.pid = os.getpid()
+
+    def enabled(self, level):
+        return level <= self.level
+
     def msg(self, module, level, msg, *args):
         if self.level < level or level > len(Logger.Levels):
             return
 
-        msg = msg.format(*args)
+        if args:
+            msg = msg.format(*args)
+
+        line = Logger.Format.format(module=module, level=Logger.Levels[level], msg=msg)
+
+        if self.channel is not None and os.getpid() != self.pid:
+            self.send(line)
+        else:
+            self.output.write(line)
+            self.output.flush()
 
-        self.output.write(Logger.Format.format(module=module,
-                                               level=Logger.Levels[level],
-                                               msg=msg))
-        self.output.flush()
+    def send(self, line):
+        """
+            Queues *line* to be sent to the collector with the next batch.
+        """
+        with self.lock:
+            self.pending.append(line)
+
+            # Threads don't survive a fork, start one in this process
+            if self.sender is None or self.sender[0] != os.getpid():
+                thread = threading.Thread(target=self._send_batches)
+                thread.daemon = True
+                self.sender = (os.getpid(), thread)
+                thread.start()
+
+    def _send_batches(self):
+        event = threading.Event()
+        while True:
+            event.wait(BATCH_TIME)
+            self.flush()
+
+    def flush(self):
+        """
+            Sends the records waiting in this process, called before it exits.
+        """
+        if self.channel is None:
+            return
+
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        if pending:
+            self.channel.put(pending)
 
 class LoggerModule(object):
     def __init__(self, manager, module):
         self.manager = manager
         self.module = module
 
+    def enabled(self, level):
+        return self.manager.enabled(level)
+
     def error(self, msg, *args):
         self.manager.msg(self.module, 1, msg, *args)
 
@@ -50,4 +123,72 @@ class LoggerModule(object):
     def debug(self, msg, *args):
         self.manager.msg(self.module, 4, msg, *args)
 
-__all__ = ["Logger"]
+class LogCollector(object):
+    """
+        Writes the log records of the manager and every stream process
+        from a background thread. Other processes send their records in
+        batches over one channel. If *prompt* returns the prompt line
+        being edited, it is drawn again below the records so they don't
+        clobber it.
+    """
+
+    def __init__(self, output, prompt=None):
+        self.output = output
+        self.prompt = prompt
+        self.channel = multiprocessing.Queue()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        self.channel.put([data])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.channel.put(None)
+        self.thread.join(1)
+
+    def _run(self):
+        while True:
+            try:
+                batch = self.channel.get()
+            except (EOFError, IOError):
+                return
+
+            if batch is None:
+                return
+
+            lines = list(batch)
+
+            # Take whatever else has arrived, written in one go
+            while True:
+                try:
+                    batch = self.channel.get_nowait()
+                except Exception:
+                    break
+
+                if batch is None:
+                    self._write(lines)
+                    return
+
+                lines.extend(batch)
+
+            self._write(lines)
+
+    def _write(self, lines):
+        text = "".join(lines)
+
+        prompt = self.prompt and self.prompt()
+        if prompt is not None:
+            text = "\r\033[K" + text + prompt
+
+        try:
+            self.output.write(text)
+            self.output.flush()
+        except (IOError, ValueError):
+            pass
+
+__all__ = ["Logger", "LogCollector"]
@@ -1,29 +1,184 @@
-import livestreamer
 from .compat import input, stdout, is_win32
-from .logger import Logger
-from .stream import StreamThread
-from .utils import next_port, check_port, get_password, port, manager_args, port
-
-import sys, os, argparse, subprocess, cmd, getpass
-import prettytable
+from .logger import Logger, LogCollector
+from .stream import StreamThread, new_session, set_session_options
+from .engine import StreamEngine
+from .pool import WorkerPool
+from .hub import hub_key
+from .batch import read_batch, run_parallel, probe
+from .control import ControlServer, ControlError
+from .cache import TTLCache
+from .restream import RestreamServer, restream_url
+from .placement import Placement, available_cpus, is_linux
+from .metrics import MetricsServer, describe_stats, format_rate, format_retry, format_size
+from .ports import PortAllocator
+from .reaper import reaper
+from .startup import profiler
+from .timeshift import TimeshiftReader, TimeshiftOutput, TimeshiftError, remove_timeshift, timeshift_path
+from .utils import check_port, get_password, port, manager_args, port, size, optional_size, prebuffer
+
+import sys, os, time, argparse, subprocess, cmd, getpass, signal, socket
+
+from collections import deque
 
 #logger = livestreamermanager.logger.new_module("manager")
 
+def new_table(fields):
+    # Loaded with the first table rather than at startup
+    import prettytable
+
+    return prettytable.PrettyTable(fields)
+
 class Manager(cmd.Cmd):
     prompt = "lsmgr$ "
     streamPool = dict()
     streamIndex = 0
+    hubs = dict()
+    exitedStreams = deque(maxlen=20)
     def __init__(self, lsmgr, args):
         cmd.Cmd.__init__(self)
         self.args = args
         self.lsmgr = lsmgr
+
+        # Logs of every process are written from one thread, which
+        # draws the prompt again after them
+        self.at_prompt = False
+        self.logs = LogCollector(sys.stdout, self.prompt_line)
+        lsmgr.set_logcollector(self.logs)
+
+        self.cache = TTLCache(args.cache_ttl, args.cache_size)
+        self.ports = PortAllocator(args.min_port, args.max_port)
+        reaper.on_exit(self.stream_exited)
+
+        self.metrics = None
+        if args.metrics_port:
+            try:
+                self.metrics = MetricsServer(self, args.metrics_port)
+            except Exception as err:
+                print "Failed to start the metrics server on port {0}: {1}".format(args.metrics_port, err)
+
+        self.restream = None
+        if args.restream:
+            try:
+                self.restream = RestreamServer(args.restream_port, keep=args.respawn_buffer)
+            except socket.error as err:
+                print "Failed to start the restream server on port {0}: {1}".format(args.restream_port, err)
+
+        self.placement = None
+        if args.placement:
+            if is_linux:
+                self.placement = Placement(self, args.placement_cpus or available_cpus(),
+                                           args.recording_nice, args.recording_ionice)
+            else:
+                print "Placing streams on CPUs is only supported on Linux."
+
+        self.engine = None
+        self.pool = None
+        if args.engine == "shared":
+            if is_win32:
+                print "The shared engine is not supported on Windows, using a process per stream."
+            else:
+                self.engine = StreamEngine(lsmgr, args, self.cache)
+
+        if not self.engine and args.pool_size > 0:
+            self.pool = WorkerPool(lsmgr, args, args.pool_size, args.pool_max_jobs)
+
+        # Livestreamer session used to probe channels, loaded when needed
+        self.session = None
+
+        # Set by the daemon while it serves, see ControlServer
+        self.lock = None
+
         try:
-            self.cmdloop()
+            if args.batch:
+                self.run_batch(args.batch, args.batch_jobs, args.batch_probe)
+
+            if args.daemon:
+                self.serve(args.socket)
+            else:
+                self.cmdloop()
         except KeyboardInterrupt:
             print ""
             print "Caught keyboard interupted. Killing all streams."
             self.killAllStreams()
 
+        if self.engine:
+            self.engine.shutdown()
+
+        if self.pool:
+            self.pool.shutdown()
+
+        if self.metrics:
+            self.metrics.shutdown()
+
+        if self.restream:
+            self.restream.close()
+
+        if self.placement:
+            self.placement.shutdown()
+
+        self.logs.close()
+        lsmgr.set_logoutput(sys.stdout)
+
+    def serve(self, path):
+        """
+            Runs the manager without a prompt, controlled by clients
+            of a socket at *path*, until one of them shuts it down.
+        """
+        try:
+            server = ControlServer(self, path)
+        except (ControlError, socket.error) as err:
+            print "Failed to start the daemon: {0}".format(err)
+            return
+
+        # Stopped like a keyboard interrupt, so the streams are killed
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, terminate)
+        print "Listening on {0}".format(path)
+        profiler.report()
+        self.fill_pool()
+
+        try:
+            server.serve_forever()
+        finally:
+            server.close()
+
+    def preloop(self):
+        profiler.report()
+        self.fill_pool()
+        self.at_prompt = True
+
+    def fill_pool(self):
+        # Workers are started in the background once we are ready
+        # for commands, streams started before then start their own
+        if self.pool:
+            self.pool.top_up()
+
+    def precmd(self, line):
+        self.at_prompt = False
+        return line
+
+    def postcmd(self, stop, line):
+        self.at_prompt = not stop
+        return stop
+
+    def prompt_line(self):
+        """
+            Returns the prompt and what has been typed after it while
+            waiting for a command, None otherwise.
+        """
+        if not self.at_prompt or is_win32 or not sys.stdin.isatty():
+            return None
+
+        try:
+            import readline
+            typed = readline.get_line_buffer()
+        except ImportError:
+            typed = ""
+
+        return self.prompt + typed
+
     def get_stream_id(self):
         self.streamIndex = self.streamIndex + 1
         return self.streamIndex
@@ -31,22 +186,113 @@ class Manager(cmd.Cmd):
     def stream_table(self, streams):
         if type(streams) is not list: streams = [ streams ]
 
-        table = prettytable.PrettyTable(["ID", "URL", "Stream", "Port"])
+        fields = ["ID", "URL", "Stream", "Port", "State", "Bitrate", "Received", "Stalls", "Idle"]
+        if self.placement:
+            fields.append("CPUs")
+
+        table = new_table(fields)
         for stream in streams:
-            table.add_row(stream.get_info())
+            info = stream.get_info()
+            info.append(stream.phase)
+            values = stream.get_stats()
+
+            if values is None:
+                info.extend(["N/A"] * 4)
+            else:
+                stats = describe_stats(values)
+                info.extend([format_rate(stats["bitrate"]), format_size(stats["bytes_in"]),
+                             "{0:.0f}".format(stats["stalls"]), "{0:.1f}s".format(stats["idle"])])
+
+            if self.placement:
+                info.append(self.placement.describe(stream))
+
+            table.add_row(info)
         return table
 
     def killAllStreams(self):
-        for stream in self.streamPool.values():
+        self.kill_streams(self.streamPool.values())
+
+    def kill_streams(self, streams):
+        # All are told first so they exit together
+        for stream in streams:
             stream.kill_stream()
-        for stream in self.streamPool.values():
+        self.waiting(self.join_streams, streams)
+
+    def join_streams(self, streams):
+        for stream in streams:
             stream.join_stream()
 
+    def waiting(self, func, *args):
+        """
+            Calls *func*, which waits for streams, letting the daemon
+            serve other requests meanwhile.
+        """
+        lock = self.lock
+        if lock is None or not lock.held():
+            return func(*args)
+
+        lock.release()
+        try:
+            return func(*args)
+        finally:
+            lock.acquire()
+
+    def locked(self, func, *args):
+        # For threads started while the daemon's lock is let go
+        lock = self.lock
+        if lock is None or lock.held():
+            return func(*args)
+
+        with lock:
+            return func(*args)
+
+    def stream_info(self, stream):
+        id, url, name, port = stream.get_info()
+        values = stream.get_stats()
+
+        restream = None
+        if self.restream and self.restreamed(stream.args):
+            restream = restream_url(self.restream.port, id)
+
+        placement = None
+        if self.placement:
+            placement = self.placement.describe(stream)
+
+        return dict(id=id, url=url, stream=name, port=port, state=stream.phase,
+                    restream=restream, placement=placement, stats=values and describe_stats(values))
+
+    def stream_exited(self, stream):
+        # Ports are free again as soon as their streams exit, the
+        # rest is cleaned up by remove_stale_streams
+        self.ports.release(stream.id)
+        for id in list(getattr(stream, "attached", ())):
+            self.ports.release(id)
+
     def remove_stale_streams(self):
-        for id, stream in self.streamPool.items():    
-            stream.process.join(timeout=0.1)
-            if not stream.process.is_alive():
+        # Exits are noticed by the reaper, so this doesn't wait on anything
+        removed = False
+        for id, stream in self.streamPool.items():
+            if not stream.is_alive():
+                removed = True
                 del self.streamPool[id]
+                self.ports.release(id)
+                if self.restream:
+                    self.restream.remove(id)
+
+                # Left behind if the stream's process was killed
+                path = getattr(stream.args, "timeshift_file", None)
+                if path and not stream.running():
+                    remove_timeshift(path)
+
+                info = stream.get_info()[:3]
+                if stream.phase == "failed":
+                    info.append("failed")
+                else:
+                    info.append(stream.exit_reason or "killed")
+                self.exitedStreams.append(info)
+
+        if removed and self.placement:
+            self.placement.rebalance()
 
     def are_running_streams(self):
         self.remove_stale_streams()
@@ -73,6 +319,7 @@ class Manager(cmd.Cmd):
         'Kill running streams'
         parser = argparse.ArgumentParser(description='Kill running streams')
         parser.add_argument('streamid', metavar='id', help='the stream id or "all" to kill all streams', nargs="+")
+        parser.add_argument("-y", "--yes", action="store_true", help="Kill them without asking")
 
         args = manager_args(parser, args)
         if not args:
@@ -96,6 +343,10 @@ class Manager(cmd.Cmd):
                 print "Use the list command to list all streams"
                 return False
 
+        if args.yes:
+            self.kill_streams(streams)
+            return False
+
         print self.stream_table(streams)
         while True:
             msg = "Are you sure you want to kill {0}? (y/n) "
@@ -106,9 +357,7 @@ class Manager(cmd.Cmd):
                 
             a = raw_input(msg).lower()
             if "y" in a:
-                for stream in streams:
-                    stream.kill_stream()
-                    stream.join_stream()
+                self.kill_streams(streams)
                 return False
             elif "n" in a:
                 return False
@@ -131,14 +380,201 @@ class Manager(cmd.Cmd):
 
     def do_list(self, args):
         'List streams currently running'
+        parser = argparse.ArgumentParser(description="List streams currently running")
+        parser.add_argument("-e", "--exited", action="store_true",
+                            help="List recently exited streams and why they exited")
+
+        args = manager_args(parser, args)
+        if not args:
+            return False
+
         self.remove_stale_streams()
 
+        if args.exited:
+            if len(self.exitedStreams) == 0:
+                print "No streams have exited"
+                return False
+
+            table = new_table(["ID", "URL", "Stream", "Reason"])
+            for info in self.exitedStreams:
+                table.add_row(info)
+            print table
+            return False
+
         if len(self.streamPool) == 0:
             print "There are no streams running"
             return False
         
         print self.stream_table(self.streamPool.values())
 
+    def do_stats(self, args):
+        'Show throughput statistics of running streams'
+        self.remove_stale_streams()
+
+        if len(self.streamPool) == 0:
+            print "There are no streams running"
+            return False
+
+        table = new_table(["ID", "URL", "Stream", "Bitrate", "Average", "Received", "Sent",
+                           "Stalls", "Stalled", "Reconnects", "Idle", "First byte", "Retry"])
+        for stream in self.streamPool.values():
+            info = stream.get_info()[:3]
+            values = stream.get_stats()
+
+            if values is None:
+                info.extend(["N/A"] * 10)
+            else:
+                stats = describe_stats(values)
+                info.extend([format_rate(stats["bitrate"]), format_rate(stats["average"]),
+                             format_size(stats["bytes_in"]), format_size(stats["bytes_out"]),
+                             "{0:.0f}".format(stats["stalls"]), "{0:.1f}s".format(stats["stall_time"]),
+                             "{0:.0f}".format(stats["reconnects"]), "{0:.1f}s".format(stats["idle"]),
+                             "{0:.2f}s".format(stats["first_byte"]), format_retry(stats)])
+
+            table.add_row(info)
+        print table
+
+    def do_wait(self, args):
+        "Wait for starting streams to run"
+        parser = argparse.ArgumentParser(description="Wait for starting streams to run")
+        parser.add_argument("streamid", metavar="id", nargs="*",
+                            help="the stream IDs to wait for, all starting streams if none are given")
+        parser.add_argument("-t", "--timeout", metavar="seconds", type=float,
+                            help="Give up waiting after this many seconds")
+
+        args = manager_args(parser, args)
+        if not args:
+            return False
+
+        if args.streamid:
+            streams = []
+            for id in args.streamid:
+                try:
+                    streams.append(self.streamPool[int(id)])
+                except (KeyError, ValueError):
+                    print "{0} is not a valit stream ID.".format(id)
+                    print "Use the list command to list all streams"
+                    return False
+        else:
+            streams = [stream for stream in self.streamPool.values() if not stream.started.is_set()]
+
+        deadline = args.timeout is not None and time.time() + args.timeout
+
+        try:
+            self.waiting(self.wait_started, streams, deadline)
+        except KeyboardInterrupt:
+            # Don't let it reach cmdloop, which kills every stream
+            print ""
+
+        self.remove_stale_streams()
+
+        if len(streams) == 0:
+            print "There are no streams starting"
+            return False
+
+        print self.stream_table(streams)
+
+    def do_rewind(self, args):
+        "Play a stream from some seconds ago, or record it from then on"
+        parser = argparse.ArgumentParser(description="Play a stream kept with --timeshift from some seconds ago, or record it from then on, without opening it again")
+        parser.add_argument("streamid", metavar="id", help="ID of the stream")
+        parser.add_argument("seconds", type=float, help="How many seconds behind live to start")
+        parser.add_argument("-p", "--player", metavar="player", default=self.args.player,
+                            help="Command-line for player, default is the player of new streams")
+        parser.add_argument("-o", "--output", metavar="filename",
+                            help="Record the stream to this file instead of playing it")
+        parser.add_argument("-f", "--force", action="store_true",
+                            help="Always write to file even if it already exists")
+
+        args = manager_args(parser, args)
+        if not args:
+            return False
+
+        if not args.output and "{PORT}" in args.player:
+            print "Players that need a port can't play a rewound stream"
+            return False
+
+        if args.output and os.path.exists(args.output) and not args.force:
+            print "File {0} already exists, use -f to overwrite it".format(args.output)
+            return False
+
+        owner, reader = self.timeshift_reader(args.streamid)
+        if reader is None:
+            return False
+
+        rewound = argparse.Namespace(url=owner.args.url, stream=owner.args.stream, player=args.player,
+                                     output=args.output, port=None, restream=False)
+        rewound.id = self.get_stream_id()
+
+        stream = TimeshiftOutput(rewound.id, rewound, owner, reader, args.seconds,
+                                 self.lsmgr.logger.new_module("timeshift"))
+        self.streamPool[stream.id] = stream
+
+        if self.placement:
+            self.placement.rebalance()
+
+    def do_clip(self, args):
+        "Save the last seconds of a stream to a file"
+        parser = argparse.ArgumentParser(description="Save the last seconds of a stream kept with --timeshift to a file, without opening it again")
+        parser.add_argument("streamid", metavar="id", help="ID of the stream")
+        parser.add_argument("seconds", type=float, help="How many seconds of the stream to save")
+        parser.add_argument("file", help="File to save them to")
+        parser.add_argument("-f", "--force", action="store_true",
+                            help="Overwrite the file if it already exists")
+
+        args = manager_args(parser, args)
+        if not args:
+            return False
+
+        if os.path.exists(args.file) and not args.force:
+            print "File {0} already exists, use -f to overwrite it".format(args.file)
+            return False
+
+        owner, reader = self.timeshift_reader(args.streamid)
+        if reader is None:
+            return False
+
+        try:
+            with open(args.file, "wb") as out:
+                written = reader.save(time.time() - args.seconds, out)
+        except (IOError, OSError) as err:
+            print "Failed to write {0}: {1}".format(args.file, err)
+            return False
+        except TimeshiftError as err:
+            print "Failed to save stream {0}: {1}".format(owner.id, err)
+            return False
+        finally:
+            reader.close()
+
+        print "Saved {0} of stream {1} to {2}".format(format_size(written), owner.id, args.file)
+
+    def timeshift_reader(self, id):
+        """
+            Returns the stream that keeps the timeshift file of stream
+            *id* and a reader of it, or prints why there is none.
+        """
+        self.remove_stale_streams()
+
+        try:
+            stream = self.streamPool[int(id)]
+        except (KeyError, ValueError):
+            print "{0} is not a valit stream ID.".format(id)
+            print "Use the list command to list all streams"
+            return None, None
+
+        # Outputs sharing a stream are kept in the file of its first
+        owner = getattr(stream, "owner", stream)
+        path = getattr(owner.args, "timeshift_file", None)
+        if not path:
+            print "Stream {0} isn't kept on disk, start it with --timeshift".format(id)
+            return None, None
+
+        try:
+            return owner, TimeshiftReader(path)
+        except TimeshiftError as err:
+            print "Stream {0} can't be rewound yet: {1}".format(id, err)
+            return None, None
+
     def do_s(self, args):
         'Start a new stream'
         return self.do_stream(args)
@@ -153,6 +589,22 @@ $ stream twitch.tv/onemoregametv 720p
 
 Stream now playbacks in player (default is VLC).
 """
+        args = manager_args(self.stream_parser(), args)
+        if not args:
+            return False
+    
+        if not args.url:
+            print exampleusage
+            return False
+
+        error = self.prepare_stream(args)
+        if error:
+            print error
+            return False
+
+        self.add_stream(self.launch_stream(args))
+
+    def stream_parser(self):
         parser = argparse.ArgumentParser(description='Start a new stream')
         parser.add_argument("url", help="URL to stream", nargs="?")
         parser.add_argument("stream", 
@@ -163,41 +615,320 @@ Stream now playbacks in player (default is VLC).
         playeropt.add_argument("-p", "--player", metavar="player", 
             help="Command-line for player, default is 'vlc'", default=self.args.player)
         playeropt.add_argument("-Q", "--port", metavar="port", type=port,
-            help="The port to use if the player command contains '{PORT}'", default=next_port(self.args))
+            help="The port to use if the player command contains '{PORT}'")
+        playeropt.add_argument("-R", "--restream", action="store_true", default=self.args.restream,
+            help="Serve the stream from lsmgr's restream server instead of starting a player")
+        playeropt.add_argument("--no-restream", action="store_false", dest="restream",
+            help="Start the player even if streams are restreamed by default")
+        playeropt.add_argument("--respawn-buffer", metavar="size", type=optional_size, default=self.args.respawn_buffer,
+            help="Most recent data the player is restarted with when it exits")
+
+        bufferopt = parser.add_argument_group("buffer options")
+        bufferopt.add_argument("--prebuffer", metavar="amount", type=prebuffer, default=self.args.prebuffer,
+            help="Data to buffer before starting the player, in bytes (e.g. 64K, 1M) or seconds (e.g. 2s)")
+        bufferopt.add_argument("--ring-size", metavar="size", type=size, default=self.args.ring_size,
+            help="Size of the buffer the stream is read into, also the largest prebuffer")
+        bufferopt.add_argument("--timeshift", metavar="size", type=optional_size, default=self.args.timeshift,
+            help="Keep the last this much of the stream on disk for the rewind and clip commands, 0 keeps nothing")
 
         outputopt = parser.add_argument_group("file output options")
         outputopt.add_argument("-o", "--output", metavar="filename", 
             help="Write stream to file instead of playing it")
         outputopt.add_argument("-f", "--force", action="store_true", 
             help="Always write to file even if it already exists")
+        outputopt.add_argument("--segment-size", metavar="size", type=size,
+            help="Split the file into numbered segments of this size (e.g. 500M)")
+        outputopt.add_argument("--segment-time", metavar="seconds", type=float,
+            help="Split the file into numbered segments of this many seconds")
+        outputopt.add_argument("--preallocate", metavar="size", type=size,
+            help="Reserve disk space for the file this much at a time (e.g. 64M)")
 
         pluginopt = parser.add_argument_group("plugin options")
         pluginopt.add_argument("-c", "--cmdline", action="store_true", default=self.args.cmdline,
             help="Print command-line used internally to play stream, this may not be available on all streams")
-            
 
-        args = manager_args(parser, args)
-        if not args:
-            return False
-    
-        if not args.url:
-            print exampleusage
-            return False
+        return parser
 
-        
+    def prepare_stream(self, args):
+        """
+            Fills in the global options, the stream ID and the port of a
+            stream about to start. Returns why it can't start, if so.
+        """
         # Copy usable args
         args.loglevel = self.args.loglevel
         args.errorlog = self.args.errorlog
         args.rtmpdump = self.args.rtmpdump
+        args.start_timeout = self.args.start_timeout
+        args.retry_max_failures = self.args.retry_max_failures
+        args.retry_min = self.args.retry_min
+        args.retry_max = self.args.retry_max
+        args.stall_timeout = self.args.stall_timeout
+        args.http_connections = self.args.http_connections
+        args.http_idle_timeout = self.args.http_idle_timeout
+        args.plugin_dirs = self.args.plugin_dirs
         args.xsplit = self.args.xsplit
+        args.standby_players = self.args.standby_players
+        args.restream_port = self.args.restream_port
+        args.restream_key = self.restream and self.restream.key
         args.jtv_cookie = self.args.jtv_cookie
         args.gomtv_cookie = self.args.gomtv_cookie
         args.gomtv_username = self.args.gomtv_username
         args.gomtv_password = self.args.gomtv_password
-    
-        stream = StreamThread(self.get_stream_id(), self.lsmgr, args)
+
+        # Answer from the cache of resolved URLs where we can
+        cached = self.cache.get(args.url)
+        if cached:
+            validstreams = (", ").join(cached["qualities"])
+
+            if not args.stream:
+                return "Found streams: {0}".format(validstreams)
+            elif args.stream not in cached["qualities"]:
+                return "Invalid stream quality: {0}\nValid streams: {1}".format(args.stream, validstreams)
+
+        args.cached = cached
+        args.id = self.get_stream_id()
+        args.timeshift_file = args.timeshift and timeshift_path(self.args.timeshift_dir, args.id) or None
+
+        # Frees the ports of streams that exited
+        self.remove_stale_streams()
+
+        if "{PORT}" in args.player and not self.restreamed(args):
+            if args.port:
+                if not self.ports.lease_port(args.id, args.port):
+                    return "Port {0} is already used by stream {1}".format(args.port, self.ports.owner(args.port))
+            else:
+                args.port = self.ports.lease(args.id)
+                if args.port is None:
+                    return "There are no free ports between {0} and {1}".format(self.args.min_port, self.args.max_port)
+
+        if self.restreamed(args):
+            if not self.restream:
+                return "The restream server is not running, start lsmgr with --restream"
+            self.restream.add(args.id)
+
+    def restreamed(self, args):
+        return args.restream and not args.output
+
+    def shareable(self, args):
+        return args.stream and not args.cmdline and not is_win32
+
+    def launch_stream(self, args):
+        """
+            Starts a prepared stream, or plays it from a running stream
+            of the same upstream. Returns at once, the stream reports
+            how far it has got in its phase.
+        """
+        owner = self.hubs.get(hub_key(args.url, args.stream))
+
+        if self.shareable(args) and owner and owner.hub_open():
+            return owner.attach(args.id, args)
+        elif self.engine:
+            return self.engine.start_stream(args.id, args)
+        else:
+            return StreamThread(args.id, self.lsmgr, args, self.cache, self.pool)
+
+    def add_stream(self, stream):
+        args = stream.args
+
+        # Play streams that are already open from the same upstream
+        if self.shareable(args) and stream.hub_open():
+            self.hubs[hub_key(args.url, args.stream)] = stream
         self.streamPool[stream.id] = stream
 
+        if self.placement:
+            self.placement.rebalance()
+
+    def do_batch(self, args):
+        "Start the streams listed in a file, or probe them"
+        parser = argparse.ArgumentParser(description="Start the streams listed in a file, one 'url quality [options]' per line")
+        parser.add_argument("file", help="File listing the streams, '-' reads them from the input up to a blank line")
+        parser.add_argument("-j", "--jobs", metavar="count", type=int, default=self.args.batch_jobs,
+                            help="Number of streams started at the same time (default: {0})".format(self.args.batch_jobs))
+        parser.add_argument("-n", "--probe", action="store_true",
+                            help="Only report which channels are live and their qualities, without starting players")
+
+        args = manager_args(parser, args)
+        if not args:
+            return False
+
+        self.run_batch(args.file, args.jobs, args.probe)
+
+    def run_batch(self, path, jobs, probe=False):
+        try:
+            lines = read_batch(path)
+        except IOError as err:
+            print "Failed to read {0}: {1}".format(path, err)
+            return
+
+        if len(lines) == 0:
+            print "There are no streams in {0}".format(path)
+            return
+
+        if probe:
+            urls = []
+            for number, line in lines:
+                url = line.split()[0]
+                if url not in urls:
+                    urls.append(url)
+
+            print self.probe_table(urls, jobs)
+        else:
+            print self.start_batch(lines, jobs)
+
+    def start_batch(self, lines, jobs):
+        """
+            Starts the streams of a batch, up to *jobs* at a time.
+            Returns a table of what became of each of them.
+        """
+        parser = self.stream_parser()
+        rows = []
+        parallel = []
+        serial = []
+        keys = set()
+
+        # IDs and ports are given out before anything starts
+        for number, line in lines:
+            words = line.split()
+            row = [number, "", words[0], len(words) > 1 and words[1] or "", "", ""]
+            rows.append(row)
+
+            args = manager_args(parser, line)
+            if not args or not args.stream:
+                row[5] = "Invalid line, expected: url quality [options]"
+                continue
+
+            error = self.prepare_stream(args)
+            if error:
+                row[5] = error.replace("\n", ", ")
+                continue
+
+            row[1] = args.id
+            row[4] = args.port or "N/A"
+
+            # Duplicates play from the first of them once it's open
+            key = hub_key(args.url, args.stream)
+            owner = self.hubs.get(key)
+            if self.shareable(args) and (key in keys or (owner and owner.hub_open())):
+                serial.append((row, args))
+            else:
+                if self.shareable(args):
+                    keys.add(key)
+                parallel.append((row, args))
+
+        results = self.waiting(run_parallel, self.start_and_wait, [args for row, args in parallel], jobs)
+        for (row, args), stream in zip(parallel, results):
+            self.batch_started(row, args, stream)
+
+        for row, args in serial:
+            try:
+                stream = self.start_and_wait(args)
+            except Exception as err:
+                stream = err
+
+            self.batch_started(row, args, stream)
+
+        table = new_table(["Line", "ID", "URL", "Stream", "Port", "Status"])
+        for row in rows:
+            table.add_row(row)
+        return table
+
+    def wait_started(self, streams, deadline):
+        for stream in streams:
+            timeout = None
+            if deadline:
+                timeout = max(deadline - time.time(), 0)
+
+            stream.wait_started(timeout)
+
+    def start_and_wait(self, args):
+        # Only this many streams of a batch start at the same time
+        stream = self.locked(self.launch_stream, args)
+        self.waiting(stream.wait_started)
+
+        return stream
+
+    def batch_started(self, row, args, stream):
+        if isinstance(stream, Exception):
+            row[5] = "Failed to start: {0}".format(stream)
+            self.ports.release(args.id)
+            return
+
+        row[5] = stream.is_alive() and stream.phase == "running" and "Started" or "Failed"
+        self.add_stream(stream)
+
+    def do_probe(self, args):
+        "Show which channels are live and the qualities they offer"
+        parser = argparse.ArgumentParser(description="Show which channels are live and the qualities they offer")
+        parser.add_argument("url", nargs="+", help="URLs to probe")
+        parser.add_argument("-j", "--jobs", metavar="count", type=int, default=self.args.batch_jobs,
+                            help="Number of URLs probed at the same time (default: {0})".format(self.args.batch_jobs))
+
+        args = manager_args(parser, args)
+        if not args:
+            return False
+
+        print self.probe_table(args.url, args.jobs)
+
+    def probe_table(self, urls, jobs):
+        """
+            Resolves *urls*, up to *jobs* at a time, without opening any
+            streams. What is found is cached for the streams started next.
+        """
+        if self.session is None:
+            self.session = new_session(self.args)
+        else:
+            set_session_options(self.session, self.args)
+
+        session = self.session
+        results = run_parallel(lambda url: probe(session, url), urls, jobs)
+
+        table = new_table(["URL", "Live", "Plugin", "Streams"])
+        for url, result in zip(urls, results):
+            if isinstance(result, Exception):
+                table.add_row([url, "no", "", str(result)])
+            elif len(result["qualities"]) == 0:
+                table.add_row([url, "no", result["module"], ""])
+            else:
+                self.cache.set(url, result)
+                table.add_row([url, "yes", result["module"], (", ").join(result["qualities"])])
+
+        return table
+
+    def do_cache(self, args):
+        "Show or flush the cache of resolved stream URLs"
+        parser = argparse.ArgumentParser(description="Show or flush the cache of resolved stream URLs")
+        parser.add_argument("-f", "--flush", action="store_true",
+                            help="Remove the given URLs from the cache, or every entry if no URL is given")
+        parser.add_argument("url", nargs="*", help="URLs to flush")
+
+        args = manager_args(parser, args)
+        if not args:
+            return False
+
+        cache = self.cache
+
+        if args.flush:
+            if args.url:
+                count = sum(cache.flush(url) for url in args.url)
+            else:
+                count = cache.flush()
+
+            print "Flushed {0} cache entries".format(count)
+            return False
+
+        print "Hits: {0}, misses: {1} ({2} expired), evictions: {3}, hit rate: {4:.1f}%".format(
+            cache.hits, cache.misses, cache.expired, cache.evictions, cache.hit_rate())
+
+        entries = cache.items()
+        if len(entries) == 0:
+            print "The cache is empty"
+            return False
+
+        table = new_table(["URL", "Plugin", "Streams", "Age"])
+        for url, age, entry in entries:
+            table.add_row([url, entry["module"], (", ").join(entry["qualities"]), "{0:.0f}s".format(age)])
+        print table
+
     def do_jtvauth(self, args):
         "Specify JustinTV authentication with cookie to allow access to subscription channels"
         parser = argparse.ArgumentParser(description="Specify JustinTV authentication with cookie to allow access to subscription channels")
@@ -267,3 +998,5 @@ Stream now playbacks in player (default is VLC).
                self.args.min_port = args.min
             if args.max:
                self.args.max_port = args.max
+
+            self.ports.set_range(self.args.min_port, self.args.max_port)
@@ -0,0 +1,208 @@
+from .compat import HTTPServer, BaseHTTPRequestHandler
+
+import time
+import threading
+
+# Counters are sent to the manager at most this often
+STATS_INTERVAL = 1.0
+
+# A gap this long between two reads counts as a stall
+STALL_TIME = 1.0
+
+STAT_FIELDS = ["id", "started", "bytes_in", "bytes_out", "bitrate", "stalls",
+               "stall_time", "reconnects", "last_byte", "first_byte", "failures", "next_retry"]
+
+class StreamStats(object):
+    """
+        Throughput counters of one stream. They are kept in the worker
+        and handed to *publish* as a list of STAT_FIELDS at most once
+        every STATS_INTERVAL, so counting a chunk is only arithmetic.
+    """
+
+    def __init__(self, id, publish=None):
+        self.id = id
+        self.publish = publish
+        self.started = time.time()
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.bitrate = 0.0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.opens = 0
+        self.last_byte = 0
+        self.first_byte = 0
+
+        # Set by the stream's Supervisor
+        self.failures = 0
+        self.next_retry = 0
+
+        self.flushed = self.started
+        self.flushed_bytes = 0
+
+    def opened(self, first_byte):
+        self.opens += 1
+        self.first_byte = first_byte or 0
+
+    def received(self, length, sent=None):
+        """
+            Counts *length* bytes read from the stream and *sent* bytes
+            written to its outputs (the same as read if not given).
+        """
+        now = time.time()
+
+        if self.last_byte and now - self.last_byte >= STALL_TIME:
+            self.stalls += 1
+            self.stall_time += now - self.last_byte
+
+        self.last_byte = now
+        self.bytes_in += length
+        self.bytes_out += length if sent is None else sent
+
+        if now - self.flushed >= STATS_INTERVAL:
+            self.flush(now)
+
+    def flush(self, now=None):
+        now = now or time.time()
+        elapsed = now - self.flushed
+
+        if elapsed > 0:
+            self.bitrate = (self.bytes_in - self.flushed_bytes) / elapsed
+
+        self.flushed = now
+        self.flushed_bytes = self.bytes_in
+
+        if self.publish:
+            self.publish(self.values())
+
+    def values(self):
+        return [self.id, self.started, self.bytes_in, self.bytes_out, self.bitrate, self.stalls,
+                self.stall_time, max(self.opens - 1, 0), self.last_byte, self.first_byte,
+                self.failures, self.next_retry]
+
+def describe_stats(values):
+    """
+        Returns a dict of the published *values* of a stream, with its
+        average bitrate, time since the last byte and time to the next
+        reconnect attempt.
+    """
+    stats = dict(zip(STAT_FIELDS, values))
+    now = time.time()
+
+    stats["average"] = stats["bytes_in"] / max(now - stats["started"], 1)
+
+    idle = now - (stats["last_byte"] or stats["started"])
+
+    # Counters are sent when data arrives at most every STATS_INTERVAL,
+    # and batched again by the engine, so a flowing stream can look
+    # up to two intervals behind.
+    if idle > 2 * STATS_INTERVAL:
+        stats["idle"] = idle
+        stats["bitrate"] = 0.0
+    else:
+        stats["idle"] = 0.0
+
+    stats["retry_in"] = stats["next_retry"] and max(stats["next_retry"] - now, 0.0)
+
+    return stats
+
+def format_size(value):
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024:
+            break
+        value /= 1024.0
+
+    return "{0:.1f} {1}".format(value, unit)
+
+def format_rate(value):
+    return "{0:.0f} kbit/s".format(value * 8 / 1000)
+
+def format_retry(stats):
+    if not stats["next_retry"]:
+        return "-"
+
+    return "in {0:.0f}s (failed {1:.0f}x)".format(stats["retry_in"], stats["failures"])
+
+def prometheus_text(streams):
+    """
+        Returns the stats of *streams* in the Prometheus text format.
+    """
+    metrics = [
+        ("lsmgr_stream_received_bytes_total", "counter", "Bytes read from the stream", "bytes_in"),
+        ("lsmgr_stream_sent_bytes_total", "counter", "Bytes written to the outputs", "bytes_out"),
+        ("lsmgr_stream_bitrate_bytes", "gauge", "Current bitrate in bytes per second", "bitrate"),
+        ("lsmgr_stream_average_bitrate_bytes", "gauge", "Average bitrate in bytes per second", "average"),
+        ("lsmgr_stream_stalls_total", "counter", "Reads that waited longer than a second", "stalls"),
+        ("lsmgr_stream_stall_seconds_total", "counter", "Time spent waiting in stalled reads", "stall_time"),
+        ("lsmgr_stream_reconnects_total", "counter", "Times the stream was opened again", "reconnects"),
+        ("lsmgr_stream_idle_seconds", "gauge", "Time since the last byte was read", "idle"),
+        ("lsmgr_stream_first_byte_seconds", "gauge", "Time to the first byte when last opened", "first_byte"),
+        ("lsmgr_stream_failures", "gauge", "Failed opens and lost connections in a row", "failures"),
+        ("lsmgr_stream_retry_seconds", "gauge", "Time until the stream is reconnected, 0 when connected", "retry_in"),
+    ]
+
+    rows = []
+    for stream in streams:
+        values = stream.get_stats()
+        if values is None:
+            continue
+
+        labels = dict(id=stream.id, url=stream.args.url, stream=stream.args.stream)
+        labels = ",".join('{0}="{1}"'.format(key, escape_label(value))
+                          for key, value in sorted(labels.items()))
+
+        rows.append((labels, describe_stats(values)))
+
+    lines = []
+    for name, kind, help, field in metrics:
+        lines.append("# HELP {0} {1}".format(name, help))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+
+        for labels, stats in rows:
+            lines.append("{0}{{{1}}} {2}".format(name, labels, stats[field]))
+
+    return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    value = "{0}".format(value)
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+class MetricsServer(object):
+    """
+        Serves the stats of the manager's streams on
+        http://127.0.0.1:port/metrics from a background thread.
+    """
+
+    def __init__(self, manager, port):
+        self.manager = manager
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = prometheus_text(list(server.manager.streamPool.values())).encode("utf8")
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(("127.0.0.1", port), Handler)
+
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+__all__ = ["MetricsServer", "StreamStats", "STAT_FIELDS", "describe_stats",
+           "format_rate", "format_retry", "format_size", "prometheus_text"]
@@ -0,0 +1,325 @@
+import os
+import sys
+import argparse
+import threading
+import subprocess
+
+# How often new threads and players are placed between rebalances
+REFRESH = 2.0
+
+# Largest CPU number the ctypes fallback can pin to
+MAX_CPUS = 1024
+
+# I/O class and level given to each role, as passed to ionice
+LIVE_IONICE = ("2", "0")
+RECORDING_IONICE = {
+    "best-effort": ("2", "7"),
+    "idle": ("3", None),
+    "none": None,
+}
+
+is_linux = sys.platform.startswith("linux")
+
+def load_libc():
+    if not is_linux:
+        return None
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except (ImportError, OSError):
+        return None
+
+def load_setaffinity():
+    if hasattr(os, "sched_setaffinity"):
+        return os.sched_setaffinity
+
+    libc = load_libc()
+    if libc is None or not hasattr(libc, "sched_setaffinity"):
+        return None
+
+    import ctypes
+
+    func = libc.sched_setaffinity
+    bits = ctypes.sizeof(ctypes.c_ulong) * 8
+
+    def setaffinity(pid, cpus):
+        mask = (ctypes.c_ulong * (MAX_CPUS // bits))()
+        for cpu in cpus:
+            mask[cpu // bits] |= 1 << (cpu % bits)
+
+        if func(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    return setaffinity
+
+def load_setpriority():
+    if hasattr(os, "setpriority"):
+        return lambda pid, nice: os.setpriority(os.PRIO_PROCESS, pid, nice)
+
+    libc = load_libc()
+    if libc is None:
+        return None
+
+    import ctypes
+
+    def setpriority(pid, nice):
+        # 0 is PRIO_PROCESS, which on Linux is a single thread
+        if libc.setpriority(0, pid, nice) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    return setpriority
+
+def parse_cpus(string):
+    """
+        Returns the CPUs in a list like "0-3,6" as a sorted list.
+    """
+    cpus = set()
+
+    try:
+        for part in string.split(","):
+            part = part.strip()
+            if not part:
+                continue
+
+            first, sep, last = part.partition("-")
+            cpus.update(range(int(first), int(last or first) + 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r is not a list of CPUs like 0-3,6" % string)
+
+    if not cpus or min(cpus) < 0 or max(cpus) >= MAX_CPUS:
+        raise argparse.ArgumentTypeError("%r is not a list of CPUs like 0-3,6" % string)
+
+    return sorted(cpus)
+
+def format_cpus(cpus):
+    ranges = []
+
+    for cpu in cpus:
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+
+    return ",".join(first == last and str(first) or "{0}-{1}".format(first, last)
+                    for first, last in ranges)
+
+def available_cpus():
+    """
+        Returns the CPUs this process may run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    try:
+        with open("/proc/self/status") as fd:
+            for line in fd:
+                if line.startswith("Cpus_allowed_list:"):
+                    return parse_cpus(line.split(":", 1)[1])
+    except (IOError, argparse.ArgumentTypeError):
+        pass
+
+    import multiprocessing
+    return list(range(multiprocessing.cpu_count()))
+
+def spread(count, cpus):
+    """
+        Splits *cpus* between *count* streams. Each gets a slice of its
+        own while there are enough to go round, then they share them.
+    """
+    if count <= len(cpus):
+        share, extra = divmod(len(cpus), max(count, 1))
+        slices = []
+        start = 0
+
+        for index in range(count):
+            size = share + (index < extra and 1 or 0)
+            slices.append(cpus[start:start + size])
+            start += size
+
+        return slices
+
+    return [[cpus[index % len(cpus)]] for index in range(count)]
+
+def threads(pid, children=True):
+    """
+        Returns the threads of *pid* and of the processes it started,
+        which includes the player behind a "sh -c" of a player command.
+    """
+    try:
+        tids = [int(tid) for tid in os.listdir("/proc/{0}/task".format(pid))]
+    except OSError:
+        return []
+
+    found = list(tids)
+    if not children:
+        return found
+
+    for tid in tids:
+        try:
+            with open("/proc/{0}/task/{1}/children".format(pid, tid)) as fd:
+                pids = fd.read().split()
+        except IOError:
+            continue
+
+        for child in pids:
+            found.extend(threads(int(child)))
+
+    return found
+
+def is_recording(args):
+    return bool(args.output) and args.output != "-"
+
+class Placement(object):
+    """
+        Spreads the processes of the manager's streams over *cpus* and
+        gives recordings a lower CPU and I/O priority than live streams,
+        so they don't hold up playback. Rebalanced when streams start
+        or stop, and applied from a background thread that also places
+        threads and players started since.
+
+        The worker of a stream only gets the CPUs and I/O class of its
+        role. Its nice value is left alone as it can't be raised back
+        without privileges, and pooled workers change roles.
+    """
+
+    def __init__(self, manager, cpus, recording_nice=10, recording_ionice="best-effort"):
+        self.manager = manager
+        self.cpus = cpus
+        self.recording_nice = recording_nice or None
+        self.recording_ionice = RECORDING_IONICE[recording_ionice]
+        self.logger = manager.lsmgr.logger.new_module("placement")
+        self.setaffinity = load_setaffinity()
+        self.setpriority = load_setpriority()
+
+        # CPUs and role of each stream, and what was applied to each thread
+        self.placed = {}
+        self.applied = {}
+        self.ionice = True
+
+        self.running = True
+        self.changed = threading.Event()
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def rebalance(self):
+        self.changed.set()
+
+    def shutdown(self):
+        self.running = False
+        self.changed.set()
+
+    def describe(self, stream):
+        placed = self.placed.get(getattr(stream, "owner", stream).id)
+        if placed is None:
+            return "N/A"
+
+        cpus, role = placed
+        return "{0} {1}".format(format_cpus(cpus), role)
+
+    def _run(self):
+        while self.running:
+            self.changed.wait(REFRESH)
+            self.changed.clear()
+
+            if not self.running:
+                return
+
+            try:
+                self.place(list(self.manager.streamPool.values()))
+            except Exception as err:
+                self.logger.error("Failed to place streams: {0}", err)
+
+    def place(self, streams):
+        # Outputs sharing a stream make it live if any of them plays
+        owners = []
+        live = set()
+        for stream in streams:
+            if not stream.is_alive():
+                continue
+
+            owner = getattr(stream, "owner", stream)
+            if owner is stream:
+                owners.append(stream)
+            elif not is_recording(stream.args):
+                live.add(owner.id)
+
+        owners.sort(key=lambda stream: stream.id)
+
+        placed = {}
+        applied = {}
+        ionice = {}
+
+        for stream, cpus in zip(owners, spread(len(owners), self.cpus)):
+            if is_recording(stream.args) and stream.id not in live:
+                role = "recording"
+                nice, ioprio = self.recording_nice, self.recording_ionice
+            else:
+                role = "live"
+                nice, ioprio = None, LIVE_IONICE
+
+            placed[stream.id] = (cpus, role)
+            worker, children = stream.get_pids()
+
+            # The worker's children are reported in children
+            for pid, pid_nice, descend in [(worker, None, False)] + [(child, nice, True) for child in children]:
+                if pid is None:
+                    continue
+
+                for tid in threads(pid, descend):
+                    wanted = (tuple(cpus), pid_nice, ioprio)
+                    applied[tid] = wanted
+                    if self.applied.get(tid) != wanted:
+                        self._apply(tid, cpus, pid_nice)
+                        if ioprio:
+                            ionice.setdefault(ioprio, []).append(tid)
+
+        for ioprio, tids in ionice.items():
+            self._ionice(ioprio, tids)
+
+        self.placed = placed
+        self.applied = applied
+
+    def _apply(self, tid, cpus, nice):
+        # Threads may exit at any time, so failures are expected
+        if self.setaffinity is not None:
+            try:
+                self.setaffinity(tid, cpus)
+            except OSError:
+                pass
+
+        if nice is not None and self.setpriority is not None:
+            try:
+                self.setpriority(tid, nice)
+            except OSError:
+                pass
+
+    def _ionice(self, ioprio, tids):
+        if not self.ionice:
+            return
+
+        cls, level = ioprio
+        cmd = ["ionice", "-c", cls]
+        if level is not None:
+            cmd.extend(["-n", level])
+
+        devnull = open(os.devnull, "w")
+        try:
+            # ionice stops at the first thread that has exited,
+            # the others are then done one at a time
+            if subprocess.call(cmd + ["-p"] + [str(tid) for tid in tids], stdout=devnull, stderr=devnull) and len(tids) > 1:
+                for tid in tids:
+                    subprocess.call(cmd + ["-p", str(tid)], stdout=devnull, stderr=devnull)
+        except OSError as err:
+            self.logger.warning("Failed to run ionice, I/O priorities are not set: {0}", err)
+            self.ionice = False
+        finally:
+            devnull.close()
+
+__all__ = ["Placement", "available_cpus", "format_cpus", "parse_cpus", "spread", "is_linux"]
@@ -0,0 +1,147 @@
+from .compat import is_win32
+
+import os
+import time
+import threading
+import subprocess
+
+# A player that exits sooner than this after starting is not restarted
+# on its own, the stream is reconnected instead
+RESPAWN_TIME = 5.0
+
+def player_command(args):
+    cmd = args.player
+
+    if "vlc" in args.player:
+        cmd = cmd + " - vlc://quit"
+
+    return cmd
+
+def standby_command(args):
+    """
+        Returns the command of the default player to start ahead of
+        time, None if streams don't start one or each needs its own.
+    """
+    if args.restream or "{PORT}" in args.player:
+        return None
+
+    return player_command(args)
+
+def start_player(cmd, close_fds=False):
+    """
+        Starts the player command *cmd* reading the stream from its
+        stdin. The time it was started is kept on it as started.
+    """
+    pout = open(os.devnull, "w")
+    perr = open(os.devnull, "w")
+
+    try:
+        player = subprocess.Popen(cmd, shell=True, stdout=pout, stderr=perr,
+                                  stdin=subprocess.PIPE, close_fds=close_fds)
+    finally:
+        pout.close()
+        perr.close()
+
+    player.started = time.time()
+
+    return player
+
+def stop_player(player):
+    try:
+        player.stdin.close()
+        player.kill()
+    except:
+        pass
+
+class PlayerPool(object):
+    """
+        Players started ahead of time, *size* of each player command,
+        so a stream or a player that exited can be given one that is
+        already loaded. Commands are added the first time they are
+        taken, or up front with *cmd*, and topped up in the background.
+
+        Standby players read from a pipe of their own and exit with the
+        process that started them, once their stdin is closed.
+    """
+
+    def __init__(self, size, logger, cmd=None):
+        self.size = size
+        self.logger = logger
+        self.players = {}
+        self.filling = set()
+        self.lock = threading.Lock()
+        self.closed = False
+
+        if cmd is not None:
+            self.players[cmd] = []
+            self.top_up(cmd)
+
+    def take(self, cmd):
+        """
+            Returns a standby player of *cmd*, or None if there is none.
+        """
+        with self.lock:
+            standby = self.players.setdefault(cmd, [])
+            player = None
+
+            while standby and player is None:
+                player = standby.pop(0)
+                if player.poll() is not None:
+                    player = None
+
+        self.top_up(cmd)
+
+        if player is not None:
+            player.started = time.time()
+
+        return player
+
+    def top_up(self, cmd):
+        with self.lock:
+            if self.closed or cmd in self.filling:
+                return
+            self.filling.add(cmd)
+
+        thread = threading.Thread(target=self._fill, args=(cmd,))
+        thread.daemon = True
+        thread.start()
+
+    def _fill(self, cmd):
+        try:
+            while True:
+                with self.lock:
+                    standby = self.players[cmd]
+                    standby[:] = [player for player in standby if player.poll() is None]
+                    if self.closed or len(standby) >= self.size:
+                        return
+
+                # A standby may wait a long time, it mustn't keep
+                # the pipes of other players or streams open.
+                try:
+                    player = start_player(cmd, close_fds=not is_win32)
+                except OSError as err:
+                    self.logger.error("Failed to start standby player: {0}", err)
+                    return
+
+                with self.lock:
+                    if not self.closed:
+                        standby.append(player)
+                        continue
+
+                stop_player(player)
+                return
+        finally:
+            with self.lock:
+                self.filling.discard(cmd)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            players = [player for standby in self.players.values() for player in standby]
+            self.players.clear()
+
+        for player in players:
+            stop_player(player)
+
+__all__ = ["PlayerPool", "RESPAWN_TIME", "player_command", "standby_command", "start_player",
+           "stop_player"]
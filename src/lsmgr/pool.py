@@ -0,0 +1,180 @@
+from .stream import StreamHandler, StreamChannel, new_session, set_session_options
+from .players import PlayerPool, standby_command
+from .reaper import reaper
+
+import os
+import threading
+import multiprocessing
+
+def run_worker(lsmgr, args, channel, job, max_jobs, notify):
+    # Kept for every stream the worker plays
+    standby = None
+    if args.standby_players:
+        standby = PlayerPool(args.standby_players, lsmgr.logger.new_module("players"),
+                             standby_command(args))
+
+    try:
+        # Load the plugins before there is anything to play
+        session = new_session(args)
+        jobs = 0
+
+        while not max_jobs or jobs < max_jobs:
+            command = channel.commands.get()
+            if command == "exit":
+                break
+
+            # Anything else is left over from the previous job
+            if type(command) is not tuple or command[0] != "job":
+                continue
+
+            id, args = command[1:]
+            channel.put(("job", id))
+
+            set_session_options(session, args)
+            StreamHandler(lsmgr, args, channel, session, standby).run()
+
+            jobs += 1
+            job.value = 0
+
+            if notify is not None:
+                os.write(notify, "{0}\n".format(id).encode("ascii"))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if standby:
+            standby.close()
+        lsmgr.logger.flush()
+
+class Worker(object):
+    """
+        A worker process with a Livestreamer session already loaded,
+        waiting for a stream to play. *job* is the ID of the stream
+        it plays, 0 when idle.
+    """
+
+    def __init__(self, lsmgr, args, max_jobs=0):
+        self.queue = StreamChannel()
+        self.job = multiprocessing.Value("i", 0)
+        self.jobs = 0
+        self.max_jobs = max_jobs
+
+        # Livestreamer is loaded by the worker once it has forked,
+        # so the manager doesn't have to load it to keep a pool
+        self.process = reaper.start(run_worker, (lsmgr, args, self.queue, self.job, max_jobs),
+                                    daemon=True)
+
+    def idle(self):
+        if self.max_jobs and self.jobs >= self.max_jobs:
+            return False
+
+        return self.job.value == 0 and self.process.is_alive()
+
+    def run(self, id, args):
+        self.job.value = id
+        self.jobs += 1
+        self.queue.commands.put(("job", id, args))
+
+    def running(self, id):
+        return self.job.value == id and self.process.is_alive()
+
+    def stop(self):
+        self.queue.commands.put("exit")
+
+class WorkerPool(object):
+    """
+        Keeps *size* idle workers ready to play streams. Workers are
+        replaced in the background as they are taken and are retired
+        after *max_jobs* streams (0 keeps them forever). None are
+        started until top_up is first called or a stream needs one, so
+        the pool doesn't hold up startup.
+    """
+
+    def __init__(self, lsmgr, args, size, max_jobs=0):
+        self.lsmgr = lsmgr
+        self.args = args
+        self.size = size
+        self.max_jobs = max_jobs
+
+        self.workers = []
+        self.lock = threading.Lock()
+        self.filling = False
+
+    def run(self, id, args):
+        """
+            Starts stream *id* on an idle worker, a new one is started
+            if there are none. Returns the worker.
+        """
+        with self.lock:
+            self._reap()
+
+            idle = [worker for worker in self.workers if worker.idle()]
+            if idle:
+                worker = idle[0]
+            else:
+                worker = Worker(self.lsmgr, self.args, self.max_jobs)
+                self.workers.append(worker)
+
+            worker.run(id, args)
+
+        self.top_up()
+
+        return worker
+
+    def top_up(self):
+        with self.lock:
+            if self.filling:
+                return
+            self.filling = True
+
+        thread = threading.Thread(target=self.fill)
+        thread.daemon = True
+        thread.start()
+
+    def fill(self):
+        try:
+            while True:
+                with self.lock:
+                    self._reap()
+
+                    idle = len([worker for worker in self.workers if worker.idle()])
+                    if idle >= self.size:
+                        return
+
+                    # Started with the lock held so run() does not
+                    # start another one at the same time.
+                    self.workers.append(Worker(self.lsmgr, self.args, self.max_jobs))
+        finally:
+            self.filling = False
+
+    def _reap(self):
+        # Forget workers that were retired or died, and stop idle
+        # workers over the pool size.
+        idle = 0
+        workers = []
+
+        for worker in self.workers:
+            if not worker.process.is_alive():
+                continue
+
+            if worker.idle():
+                idle += 1
+                if idle > self.size:
+                    worker.stop()
+                    continue
+            elif worker.job.value == 0:
+                # Retired after its last job, it is on its way out
+                continue
+
+            workers.append(worker)
+
+        self.workers = workers
+
+    def shutdown(self):
+        with self.lock:
+            for worker in self.workers:
+                if worker.job.value == 0:
+                    worker.stop()
+
+            self.workers = []
+
+__all__ = ["Worker", "WorkerPool", "run_worker"]
@@ -0,0 +1,78 @@
+from .utils import check_port
+
+from collections import deque
+
+import threading
+
+class PortAllocator(object):
+    """
+        Leases ports in [min_port, max_port) to streams. Ports waiting
+        to be handed out are kept in a queue, so only ports none of our
+        streams hold are tried with a bind. Ports that some other program
+        holds go to the back of the queue. Ports are released from the
+        reaper's thread as well, so everything is done under a lock.
+    """
+
+    def __init__(self, min_port, max_port):
+        # Port to stream ID and back
+        self.leases = {}
+        self.leased = {}
+        self.lock = threading.Lock()
+        self.set_range(min_port, max_port)
+
+    def set_range(self, min_port, max_port):
+        with self.lock:
+            self.min_port = min_port
+            self.max_port = max_port
+            self.free = deque(port for port in range(min_port, max_port) if port not in self.leases)
+
+    def lease(self, id):
+        """
+            Leases a free port to stream *id*, returns None if
+            every port in the range is taken.
+        """
+        with self.lock:
+            for i in range(len(self.free)):
+                port = self.free.popleft()
+
+                # Leased with lease_port since it was queued
+                if port in self.leases:
+                    continue
+
+                if check_port(port):
+                    self.leases[port] = id
+                    self.leased[id] = port
+                    return port
+
+                self.free.append(port)
+
+        return None
+
+    def lease_port(self, id, port):
+        """
+            Leases the port asked for by stream *id*. Returns False if
+            another of our streams holds it.
+        """
+        with self.lock:
+            if self.leases.get(port, id) != id:
+                return False
+
+            self.leases[port] = id
+            self.leased[id] = port
+            return True
+
+    def owner(self, port):
+        return self.leases.get(port)
+
+    def release(self, id):
+        # Streams may be released by the reaper and again by a sweep
+        with self.lock:
+            port = self.leased.pop(id, None)
+            if port is None:
+                return
+
+            del self.leases[port]
+            if self.min_port <= port < self.max_port:
+                self.free.append(port)
+
+__all__ = ["PortAllocator"]
@@ -0,0 +1,176 @@
+from .compat import is_win32
+
+import os
+import select
+import weakref
+import threading
+import multiprocessing
+
+if not is_win32:
+    import fcntl
+
+def exit_reason(exitcode):
+    if exitcode is None or exitcode == 0:
+        return "finished"
+    elif exitcode < 0:
+        return "killed by signal {0}".format(-exitcode)
+    else:
+        return "exited with code {0}".format(exitcode)
+
+class Reaper(object):
+    """
+        Notices streams ending from a background thread, without polling.
+        Every worker process holds the write end of a pipe. It writes the
+        ID of each stream it finishes there, and the pipe reaches end of
+        file when the worker dies. Watched streams get their exit_reason
+        set and their exited event fired, and are passed to the functions
+        given to on_exit.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fork_lock = threading.Lock()
+        self.thread = None
+
+        # Read end of the pipe to its process and the data read so far
+        self.pipes = {}
+        self.buffers = {}
+
+        # Watched streams and, by process, what ended before it was
+        # watched. Entries go with the last reference to their process.
+        self.streams = {}
+        self.finished = weakref.WeakKeyDictionary()
+        self.dead = weakref.WeakKeyDictionary()
+
+        self.listeners = []
+
+        if not is_win32:
+            self.wake_r, self.wake_w = os.pipe()
+
+    def start(self, target, args, daemon=False):
+        """
+            Starts a process running *target* with *args* and the write
+            end of its pipe as the last argument.
+        """
+        if is_win32:
+            # No pipes to select on, streams are polled instead
+            process = multiprocessing.Process(target=target, args=args + (None,))
+            process.daemon = daemon
+            process.start()
+            return process
+
+        # Nothing else may fork while we hold the write end, or another
+        # child would keep the pipe open.
+        with self.fork_lock:
+            r, w = os.pipe()
+
+            # Don't pass it on to rtmpdump and the player
+            fcntl.fcntl(w, fcntl.F_SETFD, fcntl.fcntl(w, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+            process = multiprocessing.Process(target=target, args=args + (w,))
+            process.daemon = daemon
+            process.start()
+            os.close(w)
+
+        with self.lock:
+            self.pipes[r] = process
+            self.buffers[r] = b""
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+        os.write(self.wake_w, b"x")
+
+        return process
+
+    def watch(self, id, stream, process):
+        """
+            Sets the exit reason of *stream* and fires its exited event
+            when stream *id* is finished by *process* or it dies.
+        """
+        if is_win32:
+            return
+
+        with self.lock:
+            finished = self.finished.get(process, ())
+            if id in finished:
+                finished.discard(id)
+                reason = "finished"
+            elif process in self.dead:
+                reason = self.dead[process]
+            else:
+                self.streams[id] = (stream, process)
+                return
+
+        self._exited(stream, reason)
+
+    def on_exit(self, func):
+        """
+            Calls *func* with each stream that exits, from the thread
+            that noticed it.
+        """
+        self.listeners.append(func)
+
+    def notify(self, stream):
+        for func in self.listeners:
+            func(stream)
+
+    def _exited(self, stream, reason):
+        stream.exit_reason = reason
+        stream.exited.set()
+        self.notify(stream)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                fds = list(self.pipes)
+
+            r, w, x = select.select(fds + [self.wake_r], [], [])
+
+            if self.wake_r in r:
+                os.read(self.wake_r, 512)
+
+            for fd in r:
+                if fd != self.wake_r:
+                    self._read(fd)
+
+    def _read(self, fd):
+        data = os.read(fd, 512)
+        ended = []
+
+        with self.lock:
+            process = self.pipes[fd]
+
+            if data:
+                lines = (self.buffers[fd] + data).split(b"\n")
+                self.buffers[fd] = lines.pop()
+
+                for line in lines:
+                    id = int(line)
+                    if id in self.streams and self.streams[id][1] is process:
+                        ended.append((self.streams.pop(id)[0], "finished"))
+                    else:
+                        self.finished.setdefault(process, set()).add(id)
+            else:
+                del self.pipes[fd]
+                del self.buffers[fd]
+                os.close(fd)
+
+                # The pipe closes as the process exits, so this is quick
+                process.join()
+                reason = exit_reason(process.exitcode)
+                self.dead[process] = reason
+
+                for id, (stream, process_) in list(self.streams.items()):
+                    if process_ is process:
+                        del self.streams[id]
+                        ended.append((stream, reason))
+
+        for stream, reason in ended:
+            self._exited(stream, reason)
+
+reaper = Reaper()
+
+__all__ = ["Reaper", "exit_reason", "reaper"]
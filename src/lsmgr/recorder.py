@@ -0,0 +1,332 @@
+from .compat import queue, is_win32
+from .buffer import FLV_HEADER_SIZE, FLV_TAG_HEADER_SIZE, FLV_TAG_TYPES
+
+import os
+import sys
+import time
+import select
+import struct
+import threading
+
+if not is_win32:
+    import fcntl
+
+# Data is written to disk in blocks of this size, cut at multiples of
+# ALIGN so file offsets stay aligned, or after FLUSH_TIME at low bitrates
+BLOCK_SIZE = 1024 * 1024
+ALIGN = 4096
+FLUSH_TIME = 1.0
+
+# Blocks waiting for the disk, about 32 MB, before the stream is held up
+QUEUE_BLOCKS = 32
+
+# Size asked for the pipe the recording is written to
+PIPE_SIZE = 1024 * 1024
+F_SETPIPE_SZ = 1031
+
+# Loaded by the first recording that preallocates, False if unavailable
+fallocate = None
+
+def load_fallocate():
+    global fallocate
+    if fallocate is None:
+        fallocate = find_fallocate() or False
+
+    return fallocate
+
+def find_fallocate():
+    if hasattr(os, "posix_fallocate"):
+        return os.posix_fallocate
+
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = libc.posix_fallocate64
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+    def fallocate(fd, offset, length):
+        err = func(fd, offset, length)
+        if err:
+            raise OSError(err, os.strerror(err))
+
+    return fallocate
+
+def segment_path(path, number):
+    base, ext = os.path.splitext(path)
+    return "{0}-{1:03d}{2}".format(base, number, ext)
+
+class FLVTags(object):
+    """
+        Follows the tag boundaries of an FLV stream fed to it in pieces,
+        so segments can be cut where a tag starts.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.next_tag = FLV_HEADER_SIZE
+        self.partial = b""
+        self.synced = True
+
+    def feed(self, data):
+        """
+            Returns the offsets in *data* where tags start.
+        """
+        start = self.offset
+        end = start + len(data)
+        boundaries = []
+
+        while self.synced and self.next_tag < end:
+            # Enough of the tag header to read its type and size
+            needed = 4 - len(self.partial)
+            begin = self.next_tag + len(self.partial) - start
+            self.partial += data[begin:begin + needed]
+
+            if len(self.partial) < 4:
+                break
+
+            kind, size = struct.unpack(">BI", self.partial[:1] + b"\0" + self.partial[1:4])
+            if kind & 0x1f not in FLV_TAG_TYPES:
+                # Lost track, likely a cut short tag before a reconnect
+                self.synced = False
+                break
+
+            if self.next_tag >= start:
+                boundaries.append(self.next_tag - start)
+
+            self.next_tag += FLV_TAG_HEADER_SIZE + size + 4
+            self.partial = b""
+
+        self.offset = end
+
+        return boundaries
+
+class Recorder(object):
+    """
+        Writes a recording to disk from a thread of its own. The stream
+        is written to a pipe like any other output, data read from it is
+        gathered into large blocks and queued for a second thread that
+        writes them out, so a slow disk does not hold up the stream until
+        the queue is full. Recordings can be split into segments by size
+        or time, FLV segments are cut where a tag starts and each one
+        gets the FLV header.
+    """
+
+    def __init__(self, path, segment_size=None, segment_time=None, preallocate=None, logger=None):
+        self.path = path
+        self.logger = logger
+        self.segment_size = segment_size
+        self.segment_time = segment_time
+        self.preallocate = preallocate and load_fallocate() and preallocate
+        self.segments = 0
+        self.written = 0
+        self.error = None
+
+        read_fd, write_fd = os.pipe()
+
+        try:
+            fcntl.fcntl(write_fd, F_SETPIPE_SZ, PIPE_SIZE)
+        except (IOError, OSError):
+            pass
+
+        self.read_fd = read_fd
+        self.pipe = os.fdopen(write_fd, "wb")
+        self.blocks = queue.Queue(QUEUE_BLOCKS)
+
+        # Opened here so errors show up before the stream starts
+        self.file = self.open_segment()
+
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+        self.writer = threading.Thread(target=self._write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def fileno(self):
+        return self.pipe.fileno()
+
+    def write(self, data):
+        self.pipe.write(data)
+
+    def flush(self):
+        self.pipe.flush()
+
+    def close(self):
+        """
+            Closes the pipe and waits for everything in it to be written.
+        """
+        if self.pipe.closed:
+            return
+
+        try:
+            self.pipe.close()
+        except (IOError, OSError):
+            pass
+
+        self.reader.join()
+        self.writer.join()
+
+    def open_segment(self):
+        self.segments += 1
+
+        if self.segment_size or self.segment_time:
+            path = segment_path(self.path, self.segments)
+        else:
+            path = self.path
+
+        return open(path, "wb")
+
+    def _read(self):
+        pending = bytearray()
+        header = None
+        tags = None
+        segment_bytes = 0
+        segment_start = time.time()
+        flushed = time.time()
+
+        while True:
+            timeout = max(flushed + FLUSH_TIME - time.time(), 0)
+            r, w, x = select.select([self.read_fd], [], [], timeout)
+
+            if r:
+                data = os.read(self.read_fd, BLOCK_SIZE)
+                if not data:
+                    break
+
+                if header is None:
+                    header = data[:3] == b"FLV" and data[:FLV_HEADER_SIZE] or b""
+                    tags = header and FLVTags()
+
+                boundaries = tags and tags.feed(data) or []
+
+                cut = self._cut(len(data), tags, boundaries, segment_bytes, segment_start)
+                if cut is not None:
+                    pending += data[:cut]
+                    data = header + data[cut:]
+
+                    self.blocks.put(bytes(pending))
+                    self.blocks.put(None)
+                    pending = bytearray()
+                    segment_bytes = 0
+                    segment_start = time.time()
+
+                pending += data
+                segment_bytes += len(data)
+
+            now = time.time()
+            if len(pending) >= BLOCK_SIZE:
+                size = len(pending) - len(pending) % ALIGN
+                self.blocks.put(bytes(pending[:size]))
+                del pending[:size]
+                flushed = now
+            elif now - flushed >= FLUSH_TIME:
+                if pending:
+                    self.blocks.put(bytes(pending))
+                    pending = bytearray()
+                flushed = now
+
+        if pending:
+            self.blocks.put(bytes(pending))
+
+        # Tells the writer we are done
+        self.blocks.put(False)
+        os.close(self.read_fd)
+
+    def _cut(self, length, tags, boundaries, size, start):
+        """
+            Returns where in the *length* bytes just read the next
+            segment starts, None if the current one goes on. FLV
+            segments wait for a tag to start at *boundaries*.
+        """
+        if self.segment_time and time.time() - start >= self.segment_time:
+            wanted = 0
+        elif self.segment_size and size + length > self.segment_size:
+            wanted = max(self.segment_size - size, 0)
+        else:
+            return None
+
+        if not tags or not tags.synced:
+            return wanted
+
+        for boundary in boundaries:
+            if boundary >= wanted:
+                return boundary
+
+        return None
+
+    def _write(self):
+        allocated = 0
+        size = 0
+
+        while True:
+            block = self.blocks.get()
+
+            if block is False or block is None:
+                self._close_segment(size)
+                if block is False:
+                    return
+
+                allocated = size = 0
+                try:
+                    self.file = self.open_segment()
+                except (IOError, OSError) as err:
+                    self._failed(err)
+                continue
+
+            if self.file is None:
+                # Keep draining the queue so the stream is not held up
+                continue
+
+            fd = self.file.fileno()
+
+            if self.preallocate and size + len(block) > allocated:
+                try:
+                    fallocate(fd, allocated, self.preallocate)
+                    allocated += self.preallocate
+                except OSError:
+                    self.preallocate = None
+
+            try:
+                view = memoryview(block)
+                while view:
+                    written = os.write(fd, view)
+                    view = view[written:]
+            except OSError as err:
+                self._close_segment(size)
+                self._failed(err)
+                continue
+
+            size += len(block)
+            self.written += len(block)
+
+    def _failed(self, err):
+        self.error = err
+        self.file = None
+
+        if self.logger:
+            self.logger.error("Failed to write recording, the rest of it is dropped - {0}", err)
+
+    def _close_segment(self, size):
+        if self.file is None:
+            return
+
+        try:
+            # Give back space preallocated past the end
+            if self.preallocate:
+                os.ftruncate(self.file.fileno(), size)
+            self.file.close()
+        except (IOError, OSError):
+            pass
+
+        self.file = None
+
+__all__ = ["Recorder", "segment_path"]
@@ -0,0 +1,477 @@
+from .compat import is_win32
+from .buffer import RingBuffer, FLVClock
+
+import os
+import sys
+import time
+import errno
+import stat
+import struct
+
+if not is_win32:
+    import fcntl
+    import termios
+
+SPLICE_CHUNK = 65536
+COPY_CHUNK = 8192
+MIN_CHUNK = 4096
+MAX_CHUNK = 262144
+CHUNK_TIME = 0.05
+RING_SIZE = 1024 * 1024
+
+# Flag of splice(2) not to wait for the pipes, os.SPLICE_F_NONBLOCK
+SPLICE_F_NONBLOCK = 2
+
+# Size asked for the pipe the stream is teed to, the largest chunk
+F_SETPIPE_SZ = 1031
+
+# Loaded by the first relay that can splice or tee, False if unavailable
+splice = None
+tee = None
+
+class RelayError(Exception):
+    pass
+
+class OutputError(RelayError):
+    """
+        Raised when the output failed rather than the stream, a player
+        that exited for example.
+    """
+
+def fileno(fd):
+    try:
+        return fd.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+
+def is_fifo(fd):
+    fileno_ = fileno(fd)
+    if fileno_ is None:
+        return False
+
+    try:
+        return stat.S_ISFIFO(os.fstat(fileno_).st_mode)
+    except OSError:
+        return False
+
+def set_nonblocking(fd, nonblocking=True):
+    fileno_ = fileno(fd)
+    flags = fcntl.fcntl(fileno_, fcntl.F_GETFL)
+
+    if nonblocking:
+        flags |= os.O_NONBLOCK
+    else:
+        flags &= ~os.O_NONBLOCK
+
+    fcntl.fcntl(fileno_, fcntl.F_SETFL, flags)
+
+def pending_bytes(fd):
+    """
+        Returns the number of bytes waiting to be read from a pipe.
+    """
+    pending = fcntl.ioctl(fileno(fd), termios.FIONREAD, b"\0\0\0\0")
+    return struct.unpack("I", pending)[0]
+
+def load_splice():
+    global splice
+    if splice is None:
+        splice = find_splice() or False
+
+    return splice
+
+def load_tee():
+    global tee
+    if tee is None:
+        tee = find_tee() or False
+
+    return tee
+
+def load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except (ImportError, OSError):
+        return None
+
+def find_splice():
+    if hasattr(os, "splice"):
+        return os.splice
+
+    # Python 2 has no os.splice, libc's is called instead
+    libc = load_libc()
+    if libc is None or not hasattr(libc, "splice"):
+        return None
+
+    import ctypes
+
+    func = libc.splice
+
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                     ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+
+    def splice(src, dst, count, flags=0):
+        length = func(src, None, dst, None, count, flags)
+        if length < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        return length
+
+    return splice
+
+def find_tee():
+    # There is no os.tee in any version
+    libc = load_libc()
+    if libc is None or not hasattr(libc, "tee"):
+        return None
+
+    import ctypes
+
+    func = libc.tee
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+
+    def tee(src, dst, count, flags=0):
+        length = func(src, dst, count, flags)
+        if length < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        return length
+
+    return tee
+
+def can_splice(fd, out):
+    if is_win32 or not load_splice():
+        return False
+
+    # Only a raw pipe can be spliced from, anything else (urllib responses
+    # for example) may already hold data in a userspace buffer.
+    return is_fifo(fd) and fileno(out) is not None
+
+class Relay(object):
+    """
+        Moves data from a stream to an output. On Linux pipe-to-pipe and
+        pipe-to-file copies are done in the kernel with splice(2), otherwise
+        data is read into a RingBuffer and written from there. The chunk
+        size follows the bitrate measured while relaying. Everything read
+        after the prebuffer is also written to *tap*, if there is one,
+        which means it is never spliced.
+
+        Spliced streams whose recent data is kept are first copied to a
+        pipe of our own with tee(2) and read into the ring from there, as
+        much of it as made it to the output.
+    """
+
+    def __init__(self, fd, out=None, ring_size=RING_SIZE, tap=None):
+        self.fd = fd
+        self.out = None
+        self.mode = None
+        self.fifo = is_fifo(fd)
+        self.ring = RingBuffer(ring_size)
+        self.tap = tap
+        self.chunk_size = COPY_CHUNK
+        self.pending = None
+        self.output_full = False
+        self.side = None
+        self.prebuffered = None
+
+        self.total = 0
+        self.bitrate = 0
+        self.sample_start = time.time()
+        self.sample_bytes = 0
+
+        if out is not None:
+            self.set_output(out)
+
+    def set_output(self, out, keep=False):
+        """
+            Relays to *out* from now on. *keep* puts the stream in the
+            ring as well, teed off where it is spliced, so the most recent
+            data is there to start another output with.
+        """
+        self.out = out
+        self.pending = None
+        self.output_full = False
+
+        if self.tap is None and can_splice(self.fd, out) and (not keep or self._open_side()):
+            self.mode = keep and "tee" or "splice"
+            self.chunk_size = max(self.chunk_size, SPLICE_CHUNK)
+        else:
+            self.mode = "copy"
+
+    def _open_side(self):
+        if self.side is not None:
+            return True
+
+        if not load_tee():
+            return False
+
+        # Left blocking, tee(2) won't wait for the stream otherwise
+        r, w = os.pipe()
+
+        try:
+            fcntl.fcntl(w, F_SETPIPE_SZ, MAX_CHUNK)
+        except (IOError, OSError):
+            pass
+
+        self.side = (r, w)
+
+        return True
+
+    def _source(self):
+        # Raw pipes are read without going through the file object so no
+        # data is left behind in its buffer when switching to splice.
+        if self.fifo:
+            return self.fd.fileno()
+
+        return self.fd
+
+    def prebuffer(self, size=None, seconds=None):
+        """
+            Reads the stream until *size* bytes or *seconds* of it are
+            buffered (or the ring is full). FLV streams are timed by their
+            tag timestamps, anything else by the wall clock.
+            Returns a view of the buffered data, the seconds it covers are
+            left in prebuffered.
+        """
+        limit = min(size or self.ring.size, self.ring.size)
+        start = time.time()
+        clock = FLVClock()
+        filled = 0
+
+        while filled < limit:
+            try:
+                data = self.ring.readinto(self._source(), min(SPLICE_CHUNK, limit - filled))
+            except (IOError, OSError) as err:
+                raise RelayError("Failed to read data from stream: {0}".format(err))
+
+            if len(data) == 0:
+                break
+
+            filled += len(data)
+
+            if seconds is not None:
+                duration = clock.duration(self.ring.view[:filled])
+                if duration is None:
+                    duration = time.time() - start
+
+                self.prebuffered = duration
+                if duration >= seconds:
+                    break
+
+        self._account(filled)
+
+        return self.ring.view[:filled]
+
+    def write(self, data):
+        try:
+            self.out.write(data)
+            self.out.flush()
+        except (IOError, OSError) as err:
+            raise OutputError("Error when writing to output: {0}".format(err))
+
+    def _account(self, length):
+        self.total += length
+        self.sample_bytes += length
+
+        now = time.time()
+        elapsed = now - self.sample_start
+        if elapsed < 1.0:
+            return
+
+        self.bitrate = self.sample_bytes / elapsed
+        self.sample_start = now
+        self.sample_bytes = 0
+
+        # Read about CHUNK_TIME worth of stream at a time
+        chunk = int(self.bitrate * CHUNK_TIME)
+        chunk = max(MIN_CHUNK, min(MAX_CHUNK, chunk - chunk % MIN_CHUNK))
+
+        if self.mode != "copy":
+            chunk = max(chunk, SPLICE_CHUNK)
+
+        self.chunk_size = min(chunk, self.ring.size)
+
+    def pump(self):
+        """
+            Moves one chunk from the stream to the output.
+            Returns the number of bytes moved, 0 on end of stream.
+        """
+        if self.mode == "tee":
+            try:
+                return self._tee()
+            except OSError as err:
+                if err.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise RelayError("Error when relaying stream: {0}".format(err))
+
+            self.mode = "copy"
+
+        if self.mode == "splice":
+            try:
+                length = splice(self.fd.fileno(), self.out.fileno(), self.chunk_size)
+                self._account(length)
+                return length
+            except OSError as err:
+                if err.errno == errno.EPIPE:
+                    raise OutputError("Error when writing to output: {0}".format(err))
+                elif err.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise RelayError("Error when relaying stream: {0}".format(err))
+
+            self.mode = "copy"
+
+        return self._copy()
+
+    def set_nonblocking(self):
+        set_nonblocking(self.fd)
+        set_nonblocking(self.out)
+
+    def wants_write(self):
+        return self.output_full or bool(self.pending)
+
+    def pump_nonblocking(self):
+        """
+            Like pump but for a non-blocking raw pipe, to be called when
+            select reports the stream readable (or the output writable
+            if wants_write). Returns None if nothing could be moved.
+        """
+        if self.pending:
+            self._flush_pending()
+            return None
+
+        if self.mode == "tee":
+            self.output_full = False
+            try:
+                return self._tee(SPLICE_F_NONBLOCK)
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    return None
+                elif err.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise RelayError("Error when relaying stream: {0}".format(err))
+
+            self.mode = "copy"
+
+        if self.mode == "splice":
+            self.output_full = False
+            try:
+                length = splice(self.fd.fileno(), self.out.fileno(),
+                                self.chunk_size, flags=SPLICE_F_NONBLOCK)
+                self._account(length)
+                return length
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    # The stream was readable, so it is the output that is full
+                    self.output_full = True
+                    return None
+                elif err.errno == errno.EPIPE:
+                    raise OutputError("Error when writing to output: {0}".format(err))
+                elif err.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise RelayError("Error when relaying stream: {0}".format(err))
+
+            self.mode = "copy"
+
+        try:
+            data = self.ring.readinto(self.fd.fileno(), self.chunk_size)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return None
+            raise RelayError("Error when reading from stream: {0}".format(err))
+
+        if len(data) == 0:
+            return 0
+
+        self._account(len(data))
+        if self.tap is not None:
+            self.tap.write(data)
+
+        self.pending = data
+        self._flush_pending()
+
+        return len(data)
+
+    def _tee(self, flags=0):
+        # Copied to the side pipe without being taken from the stream
+        length = tee(self.fd.fileno(), self.side[1], self.chunk_size, flags)
+        if length == 0:
+            return 0
+
+        moved = 0
+        try:
+            while moved < length:
+                moved += splice(self.fd.fileno(), self.out.fileno(), length - moved, flags=flags)
+                if flags:
+                    break
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                self.output_full = True
+            elif err.errno == errno.EPIPE:
+                raise OutputError("Error when writing to output: {0}".format(err))
+            else:
+                raise
+        finally:
+            self._drain_side(moved, length)
+
+        if not moved:
+            return None
+
+        self._account(moved)
+
+        return moved
+
+    def _drain_side(self, moved, length):
+        left = moved
+        while left > 0:
+            left -= len(self.ring.readinto(self.side[0], left))
+
+        # What wasn't moved is still in the stream and teed again next time
+        left = length - moved
+        while left > 0:
+            left -= len(os.read(self.side[0], min(left, SPLICE_CHUNK)))
+
+    def _flush_pending(self):
+        try:
+            written = os.write(self.out.fileno(), self.pending)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return
+            raise OutputError("Error when writing to output: {0}".format(err))
+
+        self.pending = self.pending[written:]
+
+    def _copy(self):
+        try:
+            data = self.ring.readinto(self._source(), self.chunk_size)
+        except (IOError, OSError, ValueError) as err:
+            raise RelayError("Error when reading from stream: {0}".format(err))
+
+        if len(data) == 0:
+            return 0
+
+        if self.tap is not None:
+            self.tap.write(data)
+
+        try:
+            self.out.write(data)
+        except (IOError, OSError) as err:
+            raise OutputError("Error when writing to output: {0}".format(err))
+
+        self._account(len(data))
+
+        return len(data)
+
+    def release(self):
+        if self.ring.buffer is not None:
+            self.ring.release()
+
+        if self.side is not None:
+            for fd in self.side:
+                os.close(fd)
+            self.side = None
+
+__all__ = ["RelayError", "OutputError", "Relay", "can_splice", "is_fifo", "pending_bytes", "set_nonblocking"]
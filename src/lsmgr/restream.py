@@ -0,0 +1,397 @@
+from .compat import urlparse
+from .hub import Sink, HUB_CHUNK
+from .relay import RelayError
+from .buffer import catch_up
+
+from collections import deque
+
+import os
+import errno
+import select
+import socket
+import binascii
+import threading
+
+READ_SIZE = 65536
+
+# Longest request head accepted before the connection is dropped
+MAX_HEAD = 8192
+
+# Data kept for a client that falls behind, the oldest is lost beyond it
+CLIENT_BUFFER = 4 * 1024 * 1024
+
+# Recent data of each stream kept for clients that connect later
+KEEP_BUFFER = 512 * 1024
+
+RESPONSES = {
+    200: "OK",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+def restream_url(port, id):
+    return "http://127.0.0.1:{0}/stream/{1}".format(port, id)
+
+def response_head(status, headers=()):
+    lines = ["HTTP/1.0 {0} {1}".format(status, RESPONSES[status])]
+    lines.extend("{0}: {1}".format(name, value) for name, value in headers)
+    lines.extend(["Connection: close", "", ""])
+
+    return "\r\n".join(lines).encode("ascii")
+
+class RestreamOutput(object):
+    """
+        The connection of a stream to the restream server, written
+        to like the stdin of a player.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.sock.close()
+
+def open_source(port, key, id):
+    """
+        Connects to the restream server on *port* to send it stream *id*.
+        Returns the output to write the stream to.
+    """
+    sock = socket.create_connection(("127.0.0.1", port))
+
+    try:
+        sock.sendall(("PUT /stream/{0} HTTP/1.0\r\nX-Restream-Key: {1}\r\n\r\n").format(id, key).encode("ascii"))
+    except socket.error:
+        sock.close()
+        raise
+
+    return RestreamOutput(sock)
+
+class Channel(object):
+    """
+        A stream served by the restream server, with the connection it is
+        received on and the clients it is sent to. The first chunk of each
+        source connection is kept for clients that connect later, with up
+        to *keep* bytes of the most recent data after it.
+    """
+
+    def __init__(self, id, keep=KEEP_BUFFER):
+        self.id = id
+        self.source = None
+        self.header = b""
+        self.clients = {}
+
+        self.keep = keep
+        self.recent = deque()
+        self.kept = 0
+
+    def reset(self):
+        self.header = b""
+        self.recent.clear()
+        self.kept = 0
+
+    def feed(self, data):
+        missing = HUB_CHUNK - len(self.header)
+        if missing > 0:
+            self.header += data[:missing]
+            data = data[missing:]
+
+        if not data or not self.keep:
+            return
+
+        self.recent.append(data)
+        self.kept += len(data)
+
+        while self.kept - len(self.recent[0]) >= self.keep:
+            self.kept -= len(self.recent.popleft())
+
+    def is_flv(self):
+        return self.header[:3] == b"FLV"
+
+    def catch_up(self):
+        """
+            Returns the data a client that connects now is sent first.
+        """
+        # Until there is more than the header it runs on into what follows
+        if not self.recent:
+            return self.header
+
+        return catch_up(self.header, b"".join(self.recent))
+
+class RestreamServer(object):
+    """
+        Serves every stream of the manager over HTTP on one port, at
+        http://127.0.0.1:port/stream/<id>. Stream workers connect to the
+        same port and PUT their stream, which is copied to its clients
+        from one select loop in a background thread. Each client has a
+        bounded buffer, one that falls behind loses its oldest data
+        instead of holding up the stream or the other clients. Clients
+        that connect to a running stream start at its last keyframe in
+        the *keep* bytes of recent data.
+    """
+
+    def __init__(self, port, limit=CLIENT_BUFFER, keep=KEEP_BUFFER):
+        self.port = port
+        self.limit = limit
+        self.keep = keep
+
+        # Only stream workers are let in as sources
+        self.key = binascii.hexlify(os.urandom(16)).decode("ascii")
+
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.requests = {}
+        self.sources = {}
+        self.clients = {}
+        self.running = True
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", port))
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, id):
+        """
+            Starts serving stream *id*, clients can connect to it
+            before its worker does.
+        """
+        with self.lock:
+            if id not in self.channels:
+                self.channels[id] = Channel(id, self.keep)
+
+    def remove(self, id):
+        with self.lock:
+            channel = self.channels.pop(id, None)
+            if channel is None:
+                return
+
+            if channel.source is not None:
+                self._drop_source(channel.source)
+
+            for sock in list(channel.clients):
+                self._drop_client(sock)
+
+    def client_count(self, id):
+        with self.lock:
+            channel = self.channels.get(id)
+            return channel and len(channel.clients) or 0
+
+    def close(self):
+        self.running = False
+        self.thread.join(2)
+
+        with self.lock:
+            for id in list(self.channels):
+                channel = self.channels.pop(id)
+                if channel.source is not None:
+                    self._drop_source(channel.source)
+                for sock in list(channel.clients):
+                    self._drop_client(sock)
+
+            for sock in list(self.requests):
+                self._drop_request(sock)
+
+            self.listener.close()
+
+    def _run(self):
+        while self.running:
+            with self.lock:
+                readers = [self.listener] + list(self.requests) + list(self.sources) + list(self.clients)
+                writers = [sock for sock, channel in self.clients.items()
+                           if channel.clients[sock].wants_write()]
+
+            try:
+                r, w, x = select.select(readers, writers, [], 1)
+            except (select.error, socket.error, ValueError):
+                # Interrupted, or a socket was closed by remove meanwhile
+                continue
+
+            with self.lock:
+                if not self.running:
+                    return
+
+                for sock in r:
+                    if sock is self.listener:
+                        self._accept()
+                    elif sock in self.requests:
+                        self._read_request(sock)
+                    elif sock in self.sources:
+                        self._read_source(sock)
+                    elif sock in self.clients:
+                        self._read_client(sock)
+
+                for sock in w:
+                    channel = self.clients.get(sock)
+                    if channel is not None:
+                        self._flush(channel, sock)
+
+    def _accept(self):
+        try:
+            sock, addr = self.listener.accept()
+        except socket.error:
+            return
+
+        sock.setblocking(False)
+        self.requests[sock] = b""
+
+    def _recv(self, sock):
+        """
+            Returns what could be read from *sock*, None if nothing
+            and an empty string once it is closed.
+        """
+        try:
+            return sock.recv(READ_SIZE)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                return None
+            return b""
+
+    def _reply(self, sock, status):
+        try:
+            sock.send(response_head(status, [("Content-Length", 0)]))
+        except socket.error:
+            pass
+
+        self._drop_request(sock)
+
+    def _read_request(self, sock):
+        data = self._recv(sock)
+        if data is None:
+            return
+        elif not data:
+            self._drop_request(sock)
+            return
+
+        head = self.requests[sock] + data
+        self.requests[sock] = head
+
+        if b"\r\n\r\n" not in head:
+            if len(head) > MAX_HEAD:
+                self._drop_request(sock)
+            return
+
+        head, body = head.split(b"\r\n\r\n", 1)
+        lines = head.decode("latin-1").split("\r\n")
+
+        try:
+            method, path, version = lines[0].split()
+            id = int(urlparse(path).path.rstrip("/").split("/stream/", 1)[1])
+        except (ValueError, IndexError):
+            self._reply(sock, 404)
+            return
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        channel = self.channels.get(id)
+        if channel is None:
+            self._reply(sock, 404)
+        elif method == "GET":
+            self._add_client(channel, sock)
+        elif method == "PUT":
+            if headers.get("x-restream-key") != self.key:
+                self._reply(sock, 403)
+                return
+
+            self._set_source(channel, sock)
+            if body:
+                self._feed(channel, body)
+        else:
+            self._reply(sock, 405)
+
+    def _add_client(self, channel, sock):
+        del self.requests[sock]
+
+        sink = Sink(sock.fileno(), sock, limit=self.limit, flv=channel.is_flv())
+        sink.push(response_head(200, [("Content-Type", "application/octet-stream"),
+                                      ("Cache-Control", "no-cache")]), pin=True)
+        if channel.header:
+            sink.push(channel.catch_up(), pin=True)
+
+        channel.clients[sock] = sink
+        self.clients[sock] = channel
+        self._flush(channel, sock)
+
+    def _set_source(self, channel, sock):
+        del self.requests[sock]
+
+        # A stream reconnecting replaces its old connection
+        if channel.source is not None:
+            self._drop_source(channel.source)
+
+        channel.source = sock
+        channel.reset()
+        self.sources[sock] = channel
+
+    def _read_source(self, sock):
+        channel = self.sources[sock]
+
+        data = self._recv(sock)
+        if data is None:
+            return
+        elif not data:
+            self._drop_source(sock)
+            return
+
+        self._feed(channel, data)
+
+    def _feed(self, channel, data):
+        started = len(channel.header) < 3
+        channel.feed(data)
+
+        for sock, sink in list(channel.clients.items()):
+            if started:
+                sink.flv = channel.is_flv()
+            sink.push(data)
+            self._flush(channel, sock)
+
+    def _read_client(self, sock):
+        # Clients have nothing more to say, this is how they hang up
+        data = self._recv(sock)
+        if data is not None and not data:
+            self._drop_client(sock)
+
+    def _flush(self, channel, sock):
+        try:
+            channel.clients[sock].flush()
+        except RelayError:
+            self._drop_client(sock)
+
+    def _drop_request(self, sock):
+        self.requests.pop(sock, None)
+        sock.close()
+
+    def _drop_source(self, sock):
+        channel = self.sources.pop(sock, None)
+        if channel is not None and channel.source is sock:
+            channel.source = None
+
+        sock.close()
+
+    def _drop_client(self, sock):
+        channel = self.clients.pop(sock, None)
+        if channel is not None:
+            sink = channel.clients.pop(sock, None)
+            if sink is not None:
+                sink.close()
+                return
+
+        sock.close()
+
+__all__ = ["RestreamServer", "RestreamOutput", "open_source", "restream_url"]
@@ -0,0 +1,95 @@
+from .compat import str, is_win32
+
+import os
+import re
+import json
+import tempfile
+import threading
+
+if is_win32:
+    CACHE_FILE = os.path.join(os.environ["APPDATA"], "livestreamer-manager", "rtmpdump.json")
+else:
+    CACHE_FILE = os.path.expanduser("~/.lsmgr-rtmpdump.json")
+
+# Probe results by binary path, loaded from CACHE_FILE on first use
+probes = None
+lock = threading.Lock()
+
+def parse_help(text):
+    """
+        Returns the version and the long options listed
+        in the output of rtmpdump --help.
+    """
+    match = re.search(r"RTMPDump (\S+)", text)
+    flags = set()
+
+    for line in text.split("\n"):
+        line = line.strip()
+        if line[:2] == "--":
+            flags.add(line.split()[0].split("|")[0])
+
+    return dict(version=match and match.group(1), flags=sorted(flags))
+
+def load():
+    try:
+        with open(CACHE_FILE) as f:
+            cached = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    if type(cached) is not dict:
+        return {}
+
+    return cached
+
+def save():
+    # Entries written by other processes since we loaded are kept
+    cached = load()
+    cached.update(probes)
+
+    try:
+        fd, tmp = tempfile.mkstemp(prefix="rtmpdump", dir=os.path.dirname(CACHE_FILE))
+        with os.fdopen(fd, "w") as f:
+            json.dump(cached, f)
+
+        if is_win32 and os.path.exists(CACHE_FILE):
+            os.remove(CACHE_FILE)
+        os.rename(tmp, CACHE_FILE)
+    except (IOError, OSError):
+        pass
+
+def probe(cmd):
+    """
+        Returns the version and options of the rtmpdump command *cmd*.
+        Results are cached in memory and in CACHE_FILE by the path of
+        the binary and are used until its size or mtime changes.
+    """
+    global probes
+
+    try:
+        path = os.path.realpath(cmd._path)
+        stat = os.stat(path)
+    except (AttributeError, OSError):
+        path = stat = None
+
+    with lock:
+        if probes is None:
+            probes = load()
+
+        entry = path and probes.get(path)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            return entry
+
+    help = cmd(help=True, _err_to_out=True)
+    entry = parse_help(str(help))
+
+    if path:
+        entry.update(mtime=stat.st_mtime, size=stat.st_size)
+
+        with lock:
+            probes[path] = entry
+            save()
+
+    return entry
+
+__all__ = ["CACHE_FILE", "parse_help", "probe"]
@@ -0,0 +1,128 @@
+import sys
+import time
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+# Slowest imports listed by the report
+REPORT_SIZE = 25
+
+# Python 2 tries imports relative to the package first
+DEFAULT_LEVEL = sys.version_info[0] == 2 and -1 or 0
+
+class ImportProfiler(object):
+    """
+        Times every import that loads a module, from when it is started
+        until the report. Total times include the modules an import
+        loads in turn, self times don't.
+    """
+
+    def __init__(self):
+        self.started = None
+        self.original = None
+        self.imports = []
+        self.stack = []
+
+    def start(self):
+        if self.original is not None:
+            return
+
+        self.started = time.time()
+        self.original = builtins.__import__
+        builtins.__import__ = self._import
+
+    def stop(self):
+        if self.original is not None:
+            builtins.__import__ = self.original
+            self.original = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=DEFAULT_LEVEL):
+        names = self._candidates(name, globals, level)
+        if self._loaded(names, fromlist):
+            return self.original(name, globals, locals, fromlist, level)
+
+        for module in list(names):
+            names.extend(module + "." + item for item in fromlist or () if item != "*")
+        missing = [module for module in names if sys.modules.get(module) is None]
+
+        self.stack.append(0.0)
+        start = time.time()
+
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            nested = self.stack.pop()
+
+            loaded = [module for module in missing if sys.modules.get(module) is not None]
+            if loaded:
+                self.imports.append((", ".join(loaded), elapsed, elapsed - nested))
+
+            # Imports that loaded nothing themselves pass on what they caused
+            if self.stack:
+                self.stack[-1] += loaded and elapsed or nested
+
+    def _loaded(self, names, fromlist):
+        """
+            Returns whether importing one of *names* with *fromlist*
+            would find everything already loaded.
+        """
+        for name in names:
+            if name not in sys.modules:
+                return False
+
+            # Python 2 leaves a None where a relative import found nothing
+            module = sys.modules[name]
+            if module is not None:
+                return all(hasattr(module, item) for item in fromlist or () if item != "*")
+
+        return False
+
+    def _candidates(self, name, globals, level):
+        """
+            Returns the names *name* may be imported as.
+        """
+        if level == 0 or not globals:
+            return [name]
+
+        package = globals.get("__package__")
+        if not package:
+            package = globals.get("__name__", "")
+            if "__path__" not in globals:
+                package = package.rpartition(".")[0]
+
+        if level > 1:
+            package = package.rsplit(".", level - 1)[0]
+
+        relative = name and package + "." + name or package
+        if level > 0:
+            return [relative]
+
+        return [relative, name]
+
+    def report(self, output=None):
+        """
+            Writes the time taken since the profiler was started and the
+            slowest imports to *output*, stderr if not given.
+        """
+        if self.started is None:
+            return
+
+        output = output or sys.stderr
+        total = time.time() - self.started
+        self.started = None
+        self.stop()
+
+        modules = len([module for module in sys.modules.values() if module is not None])
+        output.write("Startup took {0:.3f}s, {1:.3f}s of it importing. {2} modules are loaded.\n".format(
+                     total, sum(own for name, elapsed, own in self.imports), modules))
+        output.write("{0:>10} {1:>10}  {2}\n".format("Total", "Self", "Module"))
+
+        for name, elapsed, own in sorted(self.imports, key=lambda entry: -entry[1])[:REPORT_SIZE]:
+            output.write("{0:>8.1f}ms {1:>8.1f}ms  {2}\n".format(elapsed * 1000, own * 1000, name))
+
+profiler = ImportProfiler()
+
+__all__ = ["ImportProfiler", "profiler"]
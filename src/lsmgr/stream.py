@@ -1,14 +1,39 @@
-from .utils import urlopen, check_port
-from .compat import str, is_win32, pbs
-import livestreamer
+from .utils import check_port
+from .compat import str, stdout, is_win32, load_pbs, queue
+from .relay import Relay, RelayError, OutputError, fileno, pending_bytes, set_nonblocking
+from .buffer import FLV_HEADER_SIZE, catch_up
+from .hub import Sink, StreamHub
+from .cache import describe_streams, rebuild_stream
+from .reaper import reaper
+from .metrics import StreamStats, STAT_FIELDS, format_size
+from .supervisor import Supervisor
+from .recorder import Recorder, segment_path
+from .restream import open_source, restream_url
+from .players import PlayerPool, RESPAWN_TIME, player_command, start_player, stop_player
+from .timeshift import TimeshiftBuffer
+from . import rtmpdump, httppool
 
 import os
 import time
+import select
+import socket
+import threading
 import tempfile
 import multiprocessing
 import subprocess
 import sys
 
+from collections import deque
+
+START_TIMEOUT = 30
+STDERR_LINES = 20
+
+# How often relays on their own thread are checked for stalls
+STALL_CHECK = 1
+
+# How often the bytes written to a file are shown
+PROGRESS_INTERVAL = 0.5
+
 class StreamError(Exception):
     pass
 
@@ -21,6 +46,14 @@ class Stream(object):
     def __init__(self, session):
         self.session = session
 
+    @classmethod
+    def shortname(cls):
+        """
+            Name of the stream type, newer livestreamer
+            versions sort the streams of a plugin by it.
+        """
+        return cls.__name__[:-len("Stream")].lower()
+
     def open(self):
         """
             Opens a connection to the stream.
@@ -36,41 +69,157 @@ class StreamProcess(Stream):
         self.params = params
         self.params["_bg"] = True
         self.params["_err"] = open(os.devnull, "w")
-        self.errorlog = self.session.options.get("errorlog")
+        self.errorlog = self.session.get_option("errorlog")
+        self.timeout = self.session.get_option("start_timeout") or START_TIMEOUT
+        self.first_byte = None
+        self.process = None
+        self.stderr = deque(maxlen=STDERR_LINES)
 
     def cmdline(self):
         return str(self.cmd.bake(**self.params))
 
+    def arguments(self):
+        """
+            Returns the arguments to start the process with, options
+            are passed like pbs does: -k value and --key=value.
+        """
+        args = [self.cmd._path]
+
+        for key, value in sorted(self.params.items()):
+            if key.startswith("_") or value is False or value is None:
+                continue
+
+            if len(key) == 1:
+                args.append("-" + key)
+                if value is not True:
+                    args.append(str(value))
+            elif value is True:
+                args.append("--" + key.replace("_", "-"))
+            else:
+                args.append("--{0}={1}".format(key.replace("_", "-"), value))
+
+        return args
+
     def open(self):
         if self.errorlog:
             tmpfile = tempfile.NamedTemporaryFile(prefix="livestreamer",
                                                   suffix=".err", delete=False)
             self.params["_err"] = tmpfile
+        elif not is_win32:
+            self.params["_err"] = subprocess.PIPE
 
-        stream = self.cmd(**self.params)
+        self.stderr.clear()
+        self.first_byte = None
 
-        # Wait 0.5 seconds to see if program exited prematurely
-        time.sleep(0.5)
-        stream.process.poll()
+        # Started directly so we get the pipes, sh keeps the output
+        # of a background command to itself.
+        start = time.time()
+        process = subprocess.Popen(self.arguments(), stdout=subprocess.PIPE,
+                                   stderr=self.params["_err"])
+        self.process = process
 
-        if stream.process.returncode is not None:
+        if is_win32:
+            # Pipes can't be waited on, give it 0.5 seconds to fail
+            time.sleep(0.5)
+            process.poll()
+        else:
+            self._wait_ready(process, start)
+
+        if process.returncode is not None and self.first_byte is None:
             if self.errorlog:
                 raise StreamError(("Error while executing subprocess, error output logged to: {0}").format(tmpfile.name))
+            elif self.stderr:
+                raise StreamError(("Error while executing subprocess: {0}").format(self.stderr[-1]))
             else:
                 raise StreamError("Error while executing subprocess")
 
-        return stream.process.stdout
+        if process.stderr:
+            # Keep reading it so the process never blocks on a full pipe
+            thread = threading.Thread(target=self._read_stderr, args=(process.stderr,))
+            thread.daemon = True
+            thread.start()
+
+        return process.stdout
+
+    def kill(self):
+        """
+            Kills the process of the last open, reading
+            its output ends once the pipe is drained.
+        """
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+
+    def _wait_ready(self, process, start):
+        """
+            Waits until the process has written to stdout or exited,
+            whichever comes first. Raises StreamError if neither
+            happens within the start timeout.
+        """
+        fds = [process.stdout]
+        if process.stderr:
+            fds.append(process.stderr)
+
+        deadline = start + self.timeout
+
+        while process.poll() is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                process.kill()
+                raise StreamError(("No data from subprocess within {0} seconds").format(self.timeout))
+
+            # Exiting is not something we can select on, so once
+            # both pipes are closed we poll for it instead.
+            r, w, x = select.select(fds, [], [], fds and remaining or min(remaining, 0.01))
+
+            if process.stderr in r:
+                if not self._read_lines(process.stderr):
+                    fds.remove(process.stderr)
+
+            if process.stdout in r:
+                if pending_bytes(process.stdout) > 0:
+                    self.first_byte = time.time() - start
+                    return
+
+                # End of stream, the process is on its way out
+                fds.remove(process.stdout)
+
+        if process.stdout in fds and pending_bytes(process.stdout) > 0:
+            # It exited, but not before writing something to play
+            self.first_byte = time.time() - start
+        elif process.stderr in fds:
+            self._read_stderr(process.stderr)
+
+    def _read_lines(self, fd):
+        data = os.read(fd.fileno(), 4096)
+
+        for line in data.replace(b"\r", b"\n").split(b"\n"):
+            line = line.strip()
+            if line:
+                self.stderr.append(line.decode("utf8", "replace"))
+
+        return len(data) > 0
+
+    def _read_stderr(self, fd):
+        try:
+            while self._read_lines(fd):
+                pass
+        except (IOError, OSError, ValueError):
+            pass
 
 class RTMPStream(StreamProcess):
     def __init__(self, session, params):
         StreamProcess.__init__(self, session, params)
 
-        self.rtmpdump = self.session.options.get("rtmpdump") or (is_win32 and "rtmpdump.exe" or "rtmpdump")
+        self.rtmpdump = self.session.get_option("rtmpdump") or (is_win32 and "rtmpdump.exe" or "rtmpdump")
         self.params["flv"] = "-"
 
+        self.pbs = load_pbs()
         try:
-            self.cmd = getattr(pbs, self.rtmpdump)
-        except pbs.CommandNotFound as err:
+            self.cmd = getattr(self.pbs, self.rtmpdump)
+        except self.pbs.CommandNotFound as err:
             raise StreamError(("Unable to find {0} command").format(str(err)))
 
     def open(self):
@@ -81,15 +230,11 @@ class RTMPStream(StreamProcess):
 
     def _has_jtv_support(self):
         try:
-            help = self.cmd(help=True, _err_to_out=True)
-        except pbs.ErrorReturnCode as err:
+            info = rtmpdump.probe(self.cmd)
+        except self.pbs.ErrorReturnCode as err:
             raise StreamError(("Error while checking rtmpdump compatibility: {0}").format(str(err.stdout, "ascii")))
 
-        for line in help.split("\n"):
-            if line[:5] == "--jtv":
-                return True
-
-        return False
+        return "--jtv" in info["flags"]
 
 class HTTPStream(Stream):
     def __init__(self, session, url):
@@ -98,37 +243,229 @@ class HTTPStream(Stream):
         self.url = url
 
     def open(self):
-        return urlopen(self.url)
+        try:
+            return httppool.ResumableResponse(httppool.pool, self.url)
+        except (IOError, OSError) as err:
+            raise StreamError(("Unable to open URL: {0}").format(err))
 
 
+def load_livestreamer():
+    """
+        Imports Livestreamer and its plugins, which takes longer than
+        the rest of lsmgr put together. Done when it's first needed
+        rather than at startup.
+    """
+    import livestreamer
+    import livestreamer.stream
+
+    return livestreamer
+
+def new_session(args):
+    livestreamer = load_livestreamer()
+    session = livestreamer.Livestreamer()
+
+    for path in args.plugin_dirs or []:
+        session.load_plugins(path)
+
+    set_session_options(session, args)
+
+    return session
+
+def set_session_options(session, args):
+    session.set_option("errorlog", args.errorlog)
+    session.set_option("rtmpdump", args.rtmpdump)
+    session.set_option("start_timeout", args.start_timeout)
+    httppool.pool.configure(args.http_connections, args.http_idle_timeout)
+    session.set_plugin_option("justintv", "cookie", args.jtv_cookie)
+    session.set_plugin_option("gomtv", "cookie", args.gomtv_cookie)
+    session.set_plugin_option("gomtv", "username", args.gomtv_username)
+    session.set_plugin_option("gomtv", "password", args.gomtv_password)
+
+def run_stream(lsmgr, args, queue, notify=None):
+    # Standby players of a stream of its own replace its player if it exits
+    standby = None
+    if args.standby_players:
+        standby = PlayerPool(args.standby_players, lsmgr.logger.new_module("players"))
+
+    try:
+        StreamHandler(lsmgr, args, queue, standby=standby).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if standby:
+            standby.close()
+        lsmgr.logger.flush()
+
 class StreamHandler():
-    def __init__(self, lsmgr, args, queue):
+    def __init__(self, lsmgr, args, queue, session=None, standby=None):
+        self.lsmgr = lsmgr
+        self.livestreamer = session or new_session(args)
+        self.standby = standby
+
+        lsmgr.logger.set_output(sys.stdout)
+        self.logger = lsmgr.logger.new_module("stream")
+        self.args = args
+        self.queue = queue
+        self.killed = False
+        self.header = b""
+        self.first_byte = None
+
+        # Sent now so a pooled worker's last stream isn't reported
+        self.stats = StreamStats(args.id, getattr(queue, "put_stats", None))
+        self.stats.flush()
+        self.supervisor = Supervisor(args, self.stats)
+
+        # Outputs left running while the stream reconnects
+        self.kept = None
+
+        # Outputs sharing this stream, keyed by stream ID
+        self.sinks = {getattr(args, "id", None): args}
+
+        # Processes of the stream and its players, reported to the manager
+        self.stream = None
+        self.players = []
+
+        # The file the stream is kept in to be rewound, if it is
+        self.timeshift = None
+
+    def run(self):
+        stream = self.find_stream()
+        if stream is None:
+            return None
+
+        # Removed however the stream ends, a worker may be interrupted
         try:
-            self.lsmgr = lsmgr
-            self.livestreamer = livestreamer.Livestreamer()
-
-            self.livestreamer.set_option("errorlog", args.errorlog)
-            self.livestreamer.set_option("rtmpdump", args.rtmpdump)
-            self.livestreamer.set_plugin_option("justintv", "cookie", args.jtv_cookie)
-            self.livestreamer.set_plugin_option("gomtv", "cookie", args.gomtv_cookie)
-            self.livestreamer.set_plugin_option("gomtv", "username", args.gomtv_username)
-            self.livestreamer.set_plugin_option("gomtv", "password", args.gomtv_password)
-
-            lsmgr.logger.set_output(sys.stdout)
-            self.logger = lsmgr.logger.new_module("stream")
-            self.args = args
-            self.queue = queue
-            
-            if "{PORT}" in args.player:                
-                if not check_port(args.port):
-                    self.logger.error("The port ({0}) is already in use.", args.port)
-                    return None
-
-                # Put the port into the player.
-                args.player = args.player.replace("{PORT}", str(args.port))
-            else:
-                args.port = False
+            while not self.killed and self.sinks:
+                opened = self.open_output(stream)
+                if opened:
+                    self.relay_output(*opened, stream=stream)
+
+                if self.killed or not self.sinks:
+                    break
+
+                delay = self.supervisor.failed()
+                if delay is None:
+                    self.logger.error("Giving up on stream after {0} failures in a row", self.supervisor.failures)
+                    break
+
+                self.logger.info("Reconnecting in {0:.1f} seconds", delay)
+                self.set_phase("reconnecting")
+                self.wait_retry(delay)
+
+            self.close_kept()
+        finally:
+            self.close_timeshift()
+
+    def wait_retry(self, delay):
+        """
+            Waits *delay* seconds before reconnecting, handling
+            commands in the meantime.
+        """
+        deadline = time.time() + delay
+        hub = isinstance(self.kept, StreamHub) and self.kept or None
+
+        while not self.killed and self.sinks:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            command = self.queueGet(True, remaining)
+            if command is not None:
+                self.handle_command(command, hub)
+
+    def handle_command(self, command, output, player=None):
+        """
+            Applies a command from the manager to the running *output*
+            and returns the output to continue with. Attaching a second
+            sink to a relay turns it into a StreamHub.
+        """
+        if command == "kill" or type(command) is not tuple:
+            return output
 
+        if command[0] == "attach":
+            id, args = command[1], command[2]
+            if not self.prepare_output(args):
+                self.queuePut((id, "failed"))
+                return output
+
+            self.sinks[id] = args
+            if output is None:
+                return output
+
+            opened = self.open_sink(args)
+            if not opened:
+                del self.sinks[id]
+                self.queuePut((id, "failed"))
+                return output
+
+            if isinstance(output, Relay):
+                output = self.start_hub(output, player)
+
+            output.add(Sink(id, opened[0], opened[1]))
+            self.logger.info("Attached stream {0} to {1}", id, self.args.url)
+            self.queuePut((id, "started"))
+
+        elif command[0] == "detach":
+            id = command[1]
+            self.sinks.pop(id, None)
+
+            if isinstance(output, StreamHub):
+                sink = output.remove(id)
+                if sink:
+                    sink.close()
+            elif not self.sinks:
+                self.killed = True
+
+        return output
+
+    def start_hub(self, relay, player):
+        # Sinks attached now start from what the relay read after the
+        # header, if it went through the ring rather than being spliced
+        recent = None
+        if relay.total > len(self.header):
+            recent = b""
+            if relay.mode != "splice":
+                recent = relay.ring.recent(min(self.args.respawn_buffer,
+                                               max(relay.ring.written - len(self.header), 0)))
+
+        hub = StreamHub(relay.fd, self.header, self.args.respawn_buffer, self.timeshift, recent)
+
+        sink = Sink(self.single_id, relay.out, player)
+        if relay.pending:
+            sink.push(relay.pending.tobytes())
+        hub.add(sink, header=False)
+
+        return hub
+
+    def prepare_output(self, args):
+        if "{PORT}" in args.player and (args.output or not args.restream):
+            if not check_port(args.port):
+                self.logger.error("The port ({0}) is already in use.", args.port)
+                return False
+
+            # Put the port into the player.
+            args.player = args.player.replace("{PORT}", str(args.port))
+        else:
+            args.port = False
+
+        return True
+
+    def find_stream(self):
+        """
+            Resolves the URL and picks the requested stream quality.
+            Returns None and reports failure if there is nothing to play.
+        """
+        args = self.args
+        livestreamer = load_livestreamer()
+
+        if not self.prepare_output(args):
+            self.queuePut("failed")
+            return None
+
+        self.set_phase("resolving")
+        streams = self.cached_streams(args)
+
+        if streams is None:
             try:
                 channel = self.livestreamer.resolve_url(args.url)
             except livestreamer.NoPluginError:
@@ -149,154 +486,560 @@ class StreamHandler():
                 self.queuePut("failed")
                 return None
 
-            if len(streams) == 0:
-                self.logger.error(("No streams found on this URL: {0}").format(args.url))
-                self.queuePut("failed")
-                return None
+            if len(streams) > 0:
+                self.queuePut(("resolved", args.url, describe_streams(channel.module, streams)))
+
+        if len(streams) == 0:
+            self.logger.error(("No streams found on this URL: {0}").format(args.url))
+            self.queuePut("failed")
+            return None
 
-            keys = list(streams.keys())
-            keys.sort()    
-            validstreams = (", ").join(keys)
-
-            if args.stream:
-                if args.stream in streams:
-                    stream = streams[args.stream]
-
-                    if args.cmdline:
-                        if isinstance(stream, self.livestreamer.stream.StreamProcess):
-                            msg(stream.cmdline())
-                        else:
-                            exit("Stream does not use a command-line")
-                    else:
-                        while self.queueGet(False, 0) != "kill":
-                            self.output_stream(stream)
-                else:
-                    self.logger.error(("Invalid stream quality: {0}").format(args.stream))
-                    self.logger.error(("Valid streams: {0}").format(validstreams))
-                    self.queuePut("failed")
-                    return None
+        keys = list(streams.keys())
+        keys.sort()
+        validstreams = (", ").join(keys)
+
+        if not args.stream:
+            self.logger.error(("Found streams: {0}").format(validstreams))
+            self.queuePut("failed")
+            return None
+
+        if args.stream not in streams:
+            self.logger.error(("Invalid stream quality: {0}").format(args.stream))
+            self.logger.error(("Valid streams: {0}").format(validstreams))
+            self.queuePut("failed")
+            return None
+
+        stream = streams[args.stream]
+
+        if args.cmdline:
+            if isinstance(stream, self.livestreamer.stream.StreamProcess):
+                self.logger.info(stream.cmdline())
             else:
-                self.logger.error(("Found streams: {0}").format(validstreams))
-                if queue is not None:
-                    self.queuePut("failed")
-                return None
-        except KeyboardInterrupt:
-            pass
-        
-    def output_stream(self, stream):
-        progress = False
-        out = None
-        player = None
+                self.logger.error("Stream does not use a command-line")
+            self.queuePut("failed")
+            return None
 
-        args = self.args
+        return stream
+
+    def cached_streams(self, args):
+        """
+            Creates the requested stream from the manager's cache of
+            resolved URLs. Returns None if it is not cached.
+        """
+        cached = getattr(args, "cached", None)
+        if not cached or args.stream not in cached["streams"]:
+            return None
+
+        stream = rebuild_stream(self.livestreamer, cached["streams"][args.stream])
+        if stream is None:
+            return None
+
+        self.logger.info("Using cached {0} streams for URL {1}", cached["module"], args.url)
 
-        self.logger.info("Opening stream {0}", args.stream)
+        return {args.stream: stream}
 
+    def relay_output(self, output, player, progress, stream=None):
+        """
+            Relays the stream until it ends or is killed. Returns True
+            if it should be reconnected, its outputs are then kept.
+        """
+        done = threading.Event()
+
+        if stream is not None and self.supervisor.stall_timeout:
+            thread = threading.Thread(target=self.watch_stall, args=(output.fd, stream, done))
+            thread.daemon = True
+            thread.start()
+
+        if isinstance(output, Relay):
+            output, player = self.write_stream(output, player, progress)
+
+        if isinstance(output, StreamHub):
+            self.write_hub(output)
+            player = None
+
+        done.set()
+
+        if self.killed or not self.sinks:
+            self.close_output(output, player)
+            return False
+
+        self.release_output(output, player, progress)
+        return True
+
+    def watch_stall(self, fd, stream, done):
+        while not done.wait(STALL_CHECK):
+            if self.supervisor.stalled(fd):
+                self.stall(stream)
+                return
+
+    def stall(self, stream):
+        self.logger.error("No data from stream for {0:.0f} seconds, reconnecting", self.supervisor.stall_timeout)
+
+        # Reading ends once the process is gone, other
+        # streams give up on their own with a read timeout.
+        kill = getattr(stream, "kill", None)
+        if kill:
+            kill()
+
+    def open_output(self, stream):
+        """
+            Opens the stream, pre-buffers it and starts the outputs, or
+            carries on with the outputs kept from the last connection.
+            Returns an (output, player, progress) tuple or False, the
+            output is a Relay for one sink and a StreamHub for more.
+        """
+        self.logger.info("Opening stream {0}", self.args.stream)
+        self.set_phase("opening")
+
+        start = time.time()
         try:
             fd = stream.open()
         except StreamError as err:
-            self.logger.error("Could not open stream - {0}").format(err)
+            self.logger.error("Could not open stream - {0}", err)
             self.queuePut("failed")
             return False
 
-        self.logger.debug("Pre-buffering 8192 bytes")
+        self.report_pids(stream)
+
+        # Streams that don't time their first data are timed by open()
+        self.first_byte = getattr(stream, "first_byte", None) or time.time() - start
+        self.logger.debug("Stream opened, first data after {0:.3f} seconds", self.first_byte)
+        self.stats.opened(self.first_byte)
+
+        self.open_timeshift()
+
+        relay = Relay(fd, ring_size=self.args.ring_size, tap=self.timeshift)
+        size, seconds = self.args.prebuffer
+        self.set_phase("prebuffering")
+
+        if seconds is not None:
+            self.logger.debug("Pre-buffering {0} seconds", seconds)
+        else:
+            self.logger.debug("Pre-buffering {0} bytes", size)
+
         try:
-            prebuffer = fd.read(8192)
-        except IOError:
+            prebuffer = relay.prebuffer(size, seconds)
+        except RelayError:
             self.logger.error("Failed to read data from stream")
-            if queue is not None:
+            relay.release()
+            self.queuePut("failed")
+            return False
+
+        if seconds is not None and len(prebuffer) == relay.ring.size and relay.prebuffered < seconds:
+            self.logger.warning("Only {0:.1f} of {1} seconds fit in the {2} ring buffer, "
+                                "raise --ring-size to pre-buffer more",
+                                relay.prebuffered, seconds, format_size(relay.ring.size))
+
+        self.header = prebuffer.tobytes()
+        self.stats.received(len(prebuffer))
+        self.supervisor.opened()
+
+        if self.timeshift:
+            self.timeshift.start_stream(self.header)
+
+        if self.kept is not None:
+            resumed = self.resume_output(relay)
+            if resumed is not None:
+                self.queuePut(resumed and "started" or "failed")
+                return resumed
+
+        self.set_phase("starting player")
+
+        if len(self.sinks) > 1:
+            hub = StreamHub(fd, self.header, self.args.respawn_buffer, self.timeshift)
+            relay.release()
+
+            for id, args in self.sinks.items():
+                opened = self.open_sink(args)
+                if opened:
+                    hub.add(Sink(id, opened[0], opened[1]))
+                    self.queuePut((id, "started"))
+
+            if not hub.sinks:
+                hub.close()
                 self.queuePut("failed")
+                return False
+
+            self.queuePut("started")
+
+            return hub, None, False
+
+        self.single_id, args = list(self.sinks.items())[0]
+
+        opened = self.open_sink(args)
+        if not opened:
+            self.close_output(relay, None)
+            self.queuePut("failed")
             return False
 
+        out, player, progress = opened
+
+        # Kept in the ring for another player if this one exits
+        relay.set_output(out, keep=self.keep_recent(player))
+        self.logger.debug("Writing stream to output ({0} relay)", relay.mode)
+        try:
+            relay.write(prebuffer)
+        except RelayError as err:
+            self.logger.error(str(err))
+            self.close_output(relay, player)
+            self.queuePut("failed")
+            return False
+
+        self.queuePut("started")
+
+        return relay, player, progress
+
+    def resume_output(self, relay):
+        """
+            Sends the stream read by *relay* to the outputs kept from
+            the last connection, so their players keep running.
+            Returns an (output, player, progress) tuple, False if the
+            outputs failed or None if the player has exited and new
+            outputs are needed.
+        """
+        data = self.header
+
+        # The players already have the FLV header
+        if data[:3] == b"FLV":
+            data = data[FLV_HEADER_SIZE:]
+
+        kept, self.kept = self.kept, None
+
+        if isinstance(kept, StreamHub):
+            hub = kept
+            hub.set_source(relay.fd, self.header)
+            relay.release()
+        else:
+            out, player, progress = kept
+            if player is not None and player.poll() is not None:
+                self.kept = kept
+                self.close_kept()
+                return None
+
+            relay.set_output(out, keep=self.keep_recent(player))
+
+            if len(self.sinks) == 1:
+                self.logger.debug("Writing stream to output ({0} relay)", relay.mode)
+                try:
+                    relay.write(data)
+                except RelayError as err:
+                    self.logger.error(str(err))
+                    self.close_output(relay, player)
+                    return False
+
+                return relay, player, progress
+
+            # Outputs were attached while reconnecting
+            hub = self.start_hub(relay, player)
+            relay.release()
+
+        for sink in hub.sinks.values():
+            sink.push(data)
+
+        for id, args in self.sinks.items():
+            if id not in hub.sinks:
+                opened = self.open_sink(args)
+                if opened:
+                    hub.add(Sink(id, opened[0], opened[1]))
+                    self.queuePut((id, "started"))
+
+        if not hub.sinks:
+            hub.close()
+            return False
+
+        return hub, None, False
+
+    def open_timeshift(self):
+        """
+            Opens the file the stream is kept in to be rewound, once for
+            all its connections. The stream plays on without it if that
+            fails.
+        """
+        path = getattr(self.args, "timeshift_file", None)
+        if self.timeshift is not None or not path:
+            return
+
+        try:
+            self.timeshift = TimeshiftBuffer(path, self.args.timeshift)
+        except (IOError, OSError) as err:
+            self.logger.error("Failed to open timeshift file {0}: {1}", path, err)
+            self.args.timeshift_file = None
+            return
+
+        self.logger.debug("Keeping the last {0} bytes of the stream in {1}", self.args.timeshift, path)
+
+    def close_timeshift(self):
+        timeshift, self.timeshift = self.timeshift, None
+        if timeshift is not None:
+            timeshift.close()
+
+    def open_sink(self, args):
+        """
+            Starts the player, opens the output file or connects to the
+            restream server for *args*. Returns an (out, player, progress)
+            tuple or None.
+        """
+        progress = False
+        out = None
+        player = None
+
         self.logger.debug("Checking output")
 
         if args.output:
             if args.output == "-":
                 out = stdout
             else:
-                out = self.check_output(args.output, args.force)
+                out = self.check_output(args)
                 progress = True
-        else:
-            cmd = args.player
+        elif args.restream:
+            url = restream_url(args.restream_port, args.id)
+            self.logger.info("Serving stream on {0}", url)
+            if args.xsplit:
+                self.logger.info("XSplit URL: {0}", url)
 
-            if "vlc" in args.player:
-                cmd = cmd + " - vlc://quit"
-
-            pout = open(os.devnull, "w")
-            perr = open(os.devnull, "w")
+            try:
+                out = open_source(args.restream_port, args.restream_key, args.id)
+            except socket.error as err:
+                self.logger.error("Failed to connect to the restream server: {0}", err)
+        else:
+            cmd = player_command(args)
 
             self.logger.info("Starting player: {0}", args.player)
             if args.port:
                 self.logger.info("Stream port is: {0}", args.port)
                 if args.xsplit:
                     self.logger.info("XSplit URL: rtsp://localhost:{0}/\\\\rtsp_transport:udp".format(args.port))
-            player = subprocess.Popen(cmd, shell=True, stdout=pout, stderr=perr,
-                                      stdin=subprocess.PIPE)
+
+            # Players given a port of their own can't be started ahead
+            if self.standby and not args.port:
+                player = self.standby.take(cmd)
+                if player:
+                    self.logger.debug("Using a standby player")
+
+            if player is None:
+                player = start_player(cmd)
+
             out = player.stdin
 
+            self.players.append(player)
+            self.report_pids()
+
         if not out:
             self.logger.error("Failed to open a valid stream output")
-            self.queuePut("failed")
-            return False
+            return None
 
         if is_win32:
             import msvcrt
             msvcrt.setmode(out.fileno(), os.O_BINARY)
 
-        self.logger.debug("Writing stream to output")
-        out.write(prebuffer)
-
-        self.queuePut("started")
+        return out, player, progress
 
-        self.write_stream(fd, out, progress)
-
-        if player:
-            try:
-                player.kill()
-            except:
-                pass
-
-    def write_stream(self, fd, out, progress):
+    def write_stream(self, relay, player, progress):
         written = 0
         kill = False
+        output = relay
+        reported = 0
 
         while True:
-            if self.queueGet(False, 0) == "kill":
+            command = self.queueGet(False, 0)
+            if command == "kill":
                 kill = True
                 break
-            try:
-                data = fd.read(8192)
-            except:
-                self.logger.error("Error when reading from stream")
-                break
+            elif command is not None:
+                output = self.handle_command(command, relay, player)
+                if output is not relay:
+                    break
 
-            if len(data) == 0:
+            try:
+                length = relay.pump()
+            except OutputError as err:
+                respawned = self.respawn_player(relay, player)
+                if respawned is None:
+                    self.logger.error(str(err))
+                    break
+
+                player, data = respawned
+                try:
+                    relay.write(data)
+                except RelayError as err:
+                    self.logger.error(str(err))
+                    break
+
+                continue
+            except RelayError as err:
+                self.logger.error(str(err))
                 break
 
-            try:
-                out.write(data)
-            except IOError:
-                self.logger.error("Error when writing to output")
+            if length == 0:
                 break
 
-            written += len(data)
+            written += length
+            self.stats.received(length)
 
             if progress:
-                sys.stderr.write(("\rWritten {0} bytes").format(written))
+                now = time.time()
+                if now - reported >= PROGRESS_INTERVAL:
+                    reported = now
+                    sys.stderr.write(("\rWritten {0} bytes").format(written))
 
         if progress and written > 0:
-            sys.stderr.write("\n")
+            sys.stderr.write(("\rWritten {0} bytes\n").format(written))
 
         if kill == True:
             self.logger.info("Closing stream")
-        fd.close()
 
-        if out != sys.stdout:
-            out.close()
+        return output, player
+
+    def keep_recent(self, player):
+        # The most recent data is only needed to restart a player with
+        return player is not None and self.args.respawn_buffer > 0
+
+    def respawn_player(self, relay, player):
+        """
+            Starts the player of the only output again after it exited,
+            leaving the stream open. Returns the new player and the data
+            to send it first, the stream's header and its most recent
+            data, or None if the old player exited too soon after it was
+            started, or no recent data is kept, and the stream should be
+            reconnected instead.
+        """
+        args = self.sinks.get(self.single_id)
+        if args is None or not self.keep_recent(player) or time.time() - player.started < RESPAWN_TIME:
+            return None
+
+        self.logger.info("Player exited, restarting it")
+        stop_player(player)
+
+        opened = self.open_sink(args)
+        if not opened:
+            return None
+
+        out, player, progress = opened
+        relay.set_output(out, keep=self.keep_recent(player))
+
+        # Only what was read after the header is in the ring
+        recent = relay.ring.recent(min(args.respawn_buffer, relay.ring.written - len(self.header)))
+
+        return player, catch_up(self.header, recent)
 
-    def check_output(output, force):
-        if os.path.isfile(output) and not force:
-            sys.stderr.write(("File {0} already exists! Overwrite it? [y/N] ").format(output))
+    def write_hub(self, hub):
+        # Streams that are not raw pipes are read with blocking calls,
+        # so there is no point waiting on the other descriptors.
+        timeout = hub.fifo and 0.1 or 0
+
+        while hub.sinks:
+            command = self.queueGet(False, 0)
+            if command == "kill":
+                self.logger.info("Closing stream")
+                break
+            elif command is not None:
+                self.handle_command(command, hub)
+
+            r, w, x = select.select(hub.readers(), hub.writers(), [], timeout)
+
+            try:
+                length = hub.pump_ready(r, w)
+            except RelayError as err:
+                self.logger.error(str(err))
+                break
+
+            if length == 0:
+                break
+            elif length:
+                self.stats.received(length, hub.take_written())
+
+            for sink in hub.take_failed():
+                self.reopen_sink(hub, sink)
+
+    def reopen_sink(self, hub, sink):
+        sink.close()
+        if sink.id not in self.sinks:
+            return
+
+        self.logger.info("Output of stream {0} failed, restarting it", sink.id)
+        opened = self.open_sink(self.sinks[sink.id])
+        if opened:
+            hub.add(Sink(sink.id, opened[0], opened[1]))
+        else:
+            del self.sinks[sink.id]
+
+    def release_output(self, output, player, progress):
+        """
+            Closes the stream of *output* but leaves its outputs and
+            players running, for open_output to carry on with.
+        """
+        try:
+            output.fd.close()
+        except:
+            pass
+
+        if isinstance(output, StreamHub):
+            self.kept = output
+            return
+
+        output.release()
+
+        # The engine may have made it non-blocking
+        if not is_win32 and output.out is not stdout and fileno(output.out) is not None:
+            set_nonblocking(output.out, False)
+
+        self.kept = (output.out, player, progress)
+
+    def close_kept(self):
+        kept, self.kept = self.kept, None
+        if kept is None:
+            return
+
+        if isinstance(kept, StreamHub):
+            kept.close()
+            return
+
+        out, player, progress = kept
+        if out is not stdout:
+            try:
+                out.close()
+            except:
+                pass
+
+        if player:
+            try:
+                player.kill()
+            except:
+                pass
+
+    def close_output(self, output, player):
+        if isinstance(output, StreamHub):
+            output.close()
+            return
+
+        try:
+            output.fd.close()
+        except:
+            pass
+
+        output.release()
+
+        if output.out is not None and output.out != stdout:
+            try:
+                output.out.close()
+            except:
+                pass
+
+        if player:
+            try:
+                player.kill()
+            except:
+                pass
+
+    def check_output(self, args):
+        output = args.output
+        segmented = args.segment_size or args.segment_time
+
+        # Segments are numbered, only the first is checked
+        first = segmented and segment_path(output, 1) or output
+
+        if os.path.isfile(first) and not args.force:
+            sys.stderr.write(("File {0} already exists! Overwrite it? [y/N] ").format(first))
 
             try:
                 answer = input()
@@ -309,12 +1052,40 @@ class StreamHandler():
                 sys.exit()
 
         try:
-            out = open(output, "wb")
-        except IOError as err:
-            exit(("Failed to open file {0} - ").format(output, err))
+            if is_win32:
+                # The recorder waits on a pipe, which select can't do here
+                out = open(output, "wb")
+            else:
+                out = Recorder(output, args.segment_size, args.segment_time, args.preallocate,
+                               self.logger)
+        except (IOError, OSError) as err:
+            exit(("Failed to open file {0} - {1}").format(first, err))
 
         return out
 
+    def report_pids(self, stream=None):
+        """
+            Tells the manager the processes of the stream and its
+            players, for it to place them on CPUs.
+        """
+        if stream is not None:
+            self.stream = stream
+
+        self.players = [player for player in self.players if player.poll() is None]
+        processes = list(self.players)
+
+        process = getattr(self.stream, "process", None)
+        if process is not None and process.poll() is None:
+            processes.insert(0, process)
+
+        self.queuePut(("pids", [process.pid for process in processes]))
+
+    def set_phase(self, phase):
+        """
+            Tells the manager how far the stream has got.
+        """
+        self.queuePut(("phase", phase))
+
     def queuePut(self, data):
         try:
             if self.queue is not None:
@@ -326,43 +1097,287 @@ class StreamHandler():
         try:
             if self.queue is not None:
                 output = self.queue.get(block, timeout)
-                self.logger.debug("Reading from the queue returned " + output)
+                if output is not None:
+                    self.logger.debug("Reading from the queue returned {0}", output)
+                if output == "kill":
+                    self.killed = True
                 return output
         except:
             return None
 
 
+class StreamChannel(object):
+    """
+        Connects a StreamHandler to its StreamThread. Commands are sent
+        on one queue and replies come back on another, so neither side
+        can read its own messages.
+    """
+
+    def __init__(self):
+        self.commands = multiprocessing.Queue()
+        self.status = multiprocessing.Queue()
+
+        # The latest stats of the stream, shared instead of
+        # queued so nothing piles up when no one reads them.
+        self.stats = multiprocessing.Array("d", len(STAT_FIELDS))
+
+        # The stream the replies are for and the ID of the last
+        # job a pooled worker took
+        self.listener = None
+        self.reader = None
+        self.job = None
+
+    def put(self, data):
+        self.status.put(data)
+
+    def put_stats(self, values):
+        with self.stats.get_lock():
+            self.stats[:] = values
+
+    def get_stats(self, id):
+        with self.stats.get_lock():
+            values = list(self.stats)
+
+        # A pooled worker may not have reset them for this stream yet
+        if int(values[0]) != id:
+            return None
+
+        return values
+
+    def get(self, block=None, timeout=None):
+        return self.commands.get(block, timeout)
+
+    def listen(self, listener, process):
+        """
+            Passes the replies read from now on to listener.on_status,
+            from a thread that reads them until *process* is gone.
+        """
+        self.listener = listener
+
+        if self.reader is None:
+            self.reader = threading.Thread(target=self._read, args=(process,))
+            self.reader.daemon = True
+            self.reader.start()
+
+    def _read(self, process):
+        while True:
+            try:
+                status = self.status.get(True, 0.5)
+            except queue.Empty:
+                if not process.is_alive():
+                    return
+                continue
+            except (EOFError, IOError):
+                return
+
+            if type(status) is tuple and status[0] == "job":
+                self.job = status[1]
+
+            self.listener.on_status(status)
+
 class StreamThread():
-    def __init__(self, id, lsmgr, args):
+    def __init__(self, id, lsmgr, args, cache=None, pool=None):
         self.id = id
         self.args = args
         self.lsmgr = lsmgr
-        self.queue = multiprocessing.Queue()
+        self.cache = cache
+        self.sinks = set([id])
+        self.exit_reason = None
+        self.exited = threading.Event()
 
-        self.process = multiprocessing.Process(target=StreamHandler, args=(self.lsmgr, self.args, self.queue))
-        self.process.start()
+        # Outputs attached to this stream, keyed by stream ID
+        self.attached = {}
 
-        # Loop until we get a response as it will be pushing stuff 
-        # to the logger and we dont want to clobber any input.
-        while self.queue.get() is None:
-            pass
+        # How far the stream has got, reported by its handler
+        self.phase = "starting"
+        self.started = threading.Event()
+
+        # Processes started by the handler, rtmpdump and players
+        self.pids = []
+
+        if pool:
+            self.worker = pool.run(id, args)
+            self.queue = self.worker.queue
+            self.process = self.worker.process
+        else:
+            self.worker = None
+            self.queue = StreamChannel()
+
+            # Loaded here once so workers don't each load it after the fork
+            if not is_win32:
+                load_livestreamer()
+
+            self.process = reaper.start(run_stream, (self.lsmgr, self.args, self.queue))
+
+        # Replies are read in the background, so the prompt
+        # is back while the stream starts.
+        self.queue.listen(self, self.process)
+        reaper.watch(id, self, self.process)
+
+    def on_status(self, status):
+        if type(status) is tuple and status[0] == "resolved":
+            if self.cache is not None:
+                self.cache.set(status[1], status[2])
+            return
+
+        # A pooled worker may still have replies from its last
+        # stream queued, they are skipped until it takes the job.
+        if self.worker is not None and self.queue.job != self.id:
+            return
+
+        if type(status) is tuple and status[0] == "phase":
+            self.phase = status[1]
+        elif type(status) is tuple and status[0] == "pids":
+            self.pids = status[1]
+        elif status == "started":
+            self.phase = "running"
+            self.started.set()
+        elif status == "failed":
+            self.phase = "failed"
+        elif type(status) is tuple and status[0] in self.attached:
+            self.attached[status[0]].on_status(status[1])
+
+    def wait_started(self, timeout=None):
+        """
+            Waits until the stream is running or has exited, at most
+            *timeout* seconds. Returns whether it is running.
+        """
+        deadline = timeout is not None and time.time() + timeout
+
+        # Wait in steps so a keyboard interrupt is not swallowed
+        while not self.started.is_set() and self.running():
+            if deadline and time.time() >= deadline:
+                break
+            self.started.wait(0.1)
+
+        return self.started.is_set() and self.is_alive()
 
     def get_id(self):
         return self.id
 
     def kill_stream(self):
-        self.queue.put('kill')
+        self.detach(self.id)
 
     def join_stream(self):
-        self.process.join()
+        if self.sinks:
+            return
+
+        # Wait in steps so a keyboard interrupt is not swallowed
+        while self.running():
+            self.exited.wait(0.1)
+
+    def running(self):
+        if self.exited.is_set():
+            return False
+
+        if is_win32:
+            # Nothing tells us when it exits, so ask
+            if self.worker:
+                return self.worker.running(self.id)
+            return self.process.is_alive()
+
+        return True
+
+    def is_alive(self):
+        return self.id in self.sinks and self.running()
+
+    def hub_open(self):
+        return len(self.sinks) > 0 and self.running()
+
+    def get_pids(self):
+        """
+            Returns the pid of the worker playing the stream, if it has
+            its own, and those of the processes it started.
+        """
+        return self.process.pid, list(self.pids)
+
+    def attach(self, id, args):
+        """
+            Plays this stream in another output without opening it
+            again. Returns a HubSink for the new output, it starts
+            once the handler replies.
+        """
+        sink = HubSink(id, args, self)
+
+        self.attached[id] = sink
+        self.sinks.add(id)
+        self.queue.commands.put(("attach", id, args))
+
+        return sink
+
+    def detach(self, id):
+        self.sinks.discard(id)
+        self.attached.pop(id, None)
+
+        # A pooled worker may already be playing another stream
+        if not self.running():
+            return
+
+        if self.sinks:
+            self.queue.commands.put(("detach", id))
+        else:
+            self.queue.commands.put("kill")
+
+    def get_stats(self):
+        return self.queue.get_stats(self.id)
 
     def get_info(self):
         info = [self.id, self.args.url, self.args.stream]
-        if "{PORT}" in self.args.player:
+        if "{PORT}" in self.args.player and self.args.port:
             info.append(self.args.port)
         else:
             info.append("N/A")
 
         return info
 
-__all__ = ["StreamError", "Stream", "StreamProcess", "RTMPStream", "HTTPStream", "StreamHandler", "StreamThread"]
+class HubSink(StreamThread):
+    """
+        A stream that is played from the upstream of another StreamThread.
+    """
+
+    def __init__(self, id, args, owner):
+        self.id = id
+        self.args = args
+        self.owner = owner
+        self.phase = "attaching"
+        self.started = threading.Event()
+
+    def on_status(self, status):
+        if status == "started":
+            self.phase = "running"
+            self.started.set()
+        else:
+            self.phase = "failed"
+            self.owner.sinks.discard(self.id)
+            self.owner.attached.pop(self.id, None)
+
+    @property
+    def exit_reason(self):
+        return self.owner.exit_reason
+
+    def kill_stream(self):
+        self.owner.detach(self.id)
+
+    def join_stream(self):
+        self.owner.join_stream()
+
+    def running(self):
+        return self.id in self.owner.sinks and self.owner.running()
+
+    def is_alive(self):
+        return self.running()
+
+    def hub_open(self):
+        return self.owner.hub_open()
+
+    def get_pids(self):
+        return None, []
+
+    def get_stats(self):
+        return self.owner.get_stats()
+
+    def attach(self, id, args):
+        return self.owner.attach(id, args)
+
+__all__ = ["StreamError", "Stream", "StreamProcess", "RTMPStream", "HTTPStream", "StreamHandler",
+           "StreamChannel", "StreamThread", "HubSink", "new_session", "load_livestreamer", "set_session_options", "run_stream"]
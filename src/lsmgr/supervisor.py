@@ -0,0 +1,86 @@
+from .relay import is_fifo, pending_bytes
+
+import time
+import random
+
+RETRY_FACTOR = 2
+
+# Delays are picked from this fraction below the backoff up to it,
+# so streams that dropped together don't all reconnect at once.
+RETRY_JITTER = 0.25
+
+# A connection that lasted this long resets the failure count
+HEALTHY_TIME = 30
+
+class Supervisor(object):
+    """
+        Decides when a stream is reconnected. Every failed open or lost
+        connection in a row doubles the wait (with jitter, between
+        retry_min and retry_max seconds), after max_failures of them
+        the stream is given up on. The state is published with the
+        stream's stats so the manager can show it.
+    """
+
+    def __init__(self, args, stats):
+        self.max_failures = args.retry_max_failures
+        self.retry_min = args.retry_min
+        self.retry_max = args.retry_max
+        self.stall_timeout = args.stall_timeout
+        self.stats = stats
+
+        self.failures = 0
+        self.next_retry = 0
+        self.connected = 0
+
+    def opened(self):
+        self.connected = time.time()
+        self.next_retry = 0
+        self.publish()
+
+    def failed(self):
+        """
+            Counts a failed open or a lost connection. Returns the
+            seconds to wait before reconnecting, None to give up.
+        """
+        now = time.time()
+
+        if self.connected and now - self.connected >= HEALTHY_TIME:
+            self.failures = 0
+
+        self.connected = 0
+        self.failures += 1
+
+        if self.max_failures and self.failures >= self.max_failures:
+            self.next_retry = 0
+            self.publish()
+            return None
+
+        delay = min(self.retry_max, self.retry_min * RETRY_FACTOR ** (self.failures - 1))
+        delay = random.uniform(delay * (1 - RETRY_JITTER), delay)
+
+        self.next_retry = now + delay
+        self.publish()
+
+        return delay
+
+    def stalled(self, fd, now=None):
+        """
+            Returns whether the stream read from *fd* has sent nothing
+            for stall_timeout seconds. Data waiting in the pipe means
+            the output is holding it up, which is not a stall.
+        """
+        if not self.stall_timeout or not self.connected:
+            return False
+
+        now = now or time.time()
+        if now - max(self.stats.last_byte, self.connected) < self.stall_timeout:
+            return False
+
+        return not (is_fifo(fd) and pending_bytes(fd) > 0)
+
+    def publish(self):
+        self.stats.failures = self.failures
+        self.stats.next_retry = self.next_retry
+        self.stats.flush()
+
+__all__ = ["Supervisor"]
@@ -0,0 +1,143 @@
+from .compat import urllib, is_win32
+from .utils import urlopen
+
+import os
+import hmac
+import json
+import time
+import zlib
+import hashlib
+import tempfile
+import threading
+
+SWF_KEY = b"Genuine Adobe Flash Player 001"
+
+if is_win32:
+    CACHE_FILE = os.path.join(os.environ["APPDATA"], "livestreamer-manager", "swf.json")
+else:
+    CACHE_FILE = os.path.expanduser("~/.lsmgr-swf.json")
+
+# Hashes younger than this are used without asking the server
+FRESH_TIME = 3600
+
+CHUNK_SIZE = 65536
+
+# Hashes by SWF URL, loaded from CACHE_FILE on first use
+hashes = None
+lock = threading.Lock()
+
+def hash_swf(fd):
+    """
+        Returns the HMAC and uncompressed size of the SWF read from
+        *fd*. Compressed files are inflated as they are read, so only
+        a chunk of the file is held at a time.
+    """
+    header = b""
+    while len(header) < 8:
+        data = fd.read(8 - len(header))
+        if not data:
+            break
+        header += data
+
+    h = hmac.new(SWF_KEY, digestmod=hashlib.sha256)
+    decompress = None
+    size = len(header)
+
+    if header[:3] == b"CWS":
+        header = b"F" + header[1:]
+        decompress = zlib.decompressobj()
+
+    h.update(header)
+
+    while True:
+        data = fd.read(CHUNK_SIZE)
+        if not data:
+            break
+
+        if decompress:
+            data = decompress.decompress(data)
+
+        h.update(data)
+        size += len(data)
+
+    if decompress:
+        data = decompress.flush()
+        h.update(data)
+        size += len(data)
+
+    return h.hexdigest(), size
+
+def load():
+    try:
+        with open(CACHE_FILE) as f:
+            cached = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    if type(cached) is not dict:
+        return {}
+
+    return cached
+
+def save():
+    # Entries written by other processes since we loaded are kept
+    cached = load()
+    cached.update(hashes)
+
+    try:
+        fd, tmp = tempfile.mkstemp(prefix="swf", dir=os.path.dirname(CACHE_FILE))
+        with os.fdopen(fd, "w") as f:
+            json.dump(cached, f)
+
+        if is_win32 and os.path.exists(CACHE_FILE):
+            os.remove(CACHE_FILE)
+        os.rename(tmp, CACHE_FILE)
+    except (IOError, OSError):
+        pass
+
+def verify(url, timeout=15):
+    """
+        Returns the hash and size rtmpdump needs to verify the SWF
+        player at *url*. Results are cached in memory and in CACHE_FILE,
+        after FRESH_TIME the server is asked if the file has changed.
+    """
+    global hashes
+
+    with lock:
+        if hashes is None:
+            hashes = load()
+
+        entry = hashes.get(url)
+
+    if entry and time.time() - entry["checked"] < FRESH_TIME:
+        return entry["hash"], entry["size"]
+
+    req = urllib.Request(url)
+    if entry and entry.get("etag"):
+        req.add_header("If-None-Match", entry["etag"])
+    if entry and entry.get("modified"):
+        req.add_header("If-Modified-Since", entry["modified"])
+
+    try:
+        fd = urlopen(req, timeout=timeout)
+    except urllib.HTTPError as err:
+        if not (entry and err.code == 304):
+            raise
+
+        entry["checked"] = time.time()
+    else:
+        try:
+            swfhash, size = hash_swf(fd)
+        finally:
+            fd.close()
+
+        entry = dict(hash=swfhash, size=size, checked=time.time(),
+                     etag=fd.info().get("ETag"), modified=fd.info().get("Last-Modified"))
+
+    with lock:
+        hashes[url] = entry
+        save()
+
+    return entry["hash"], entry["size"]
+
+__all__ = ["CACHE_FILE", "hash_swf", "verify"]
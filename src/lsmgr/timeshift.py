@@ -0,0 +1,479 @@
+from .compat import is_py2, is_win32
+from .buffer import FLV_HEADER_SIZE, FLV_TAG_HEADER_SIZE, FLV_TAG_TYPES, FLV_VIDEO, flv_preamble
+from .players import player_command, start_player, stop_player
+from .recorder import load_fallocate
+
+import os
+import mmap
+import time
+import struct
+import threading
+
+# A timeshift file starts with a header and the stream's preamble, the
+# tags a player needs before its data, then the index and the data ring.
+MAGIC = b"LSTS"
+HEADER = struct.Struct("<4sIIQQQ")
+HEADER_SIZE = 65536
+MAX_PREAMBLE = HEADER_SIZE - HEADER.size
+
+# Each index entry is the time a point of the stream was received and
+# where it is in the stream. FLV streams are indexed at keyframes at
+# most this often, anything else this often wherever the data is.
+ENTRY = struct.Struct("<dQ")
+INDEX_INTERVAL = 0.5
+MIN_SLOTS = 4096
+SLOT_BYTES = 32768
+
+# MPEG-TS is entered where a packet starts
+TS_PACKET = 188
+
+READ_CHUNK = 65536
+
+# How often a rewound output looks for more of the stream
+FOLLOW_WAIT = 0.1
+
+# A write to a rewound player held up longer than this means it was
+# paused, it is then kept that much further behind
+HOLD_TIME = 1.0
+
+class TimeshiftError(Exception):
+    pass
+
+class TimeshiftOverrun(TimeshiftError):
+    """
+        Raised when the data asked for has been written over.
+    """
+
+def timeshift_path(directory, id):
+    return os.path.join(directory, "lsmgr-{0}-{1}.timeshift".format(os.getpid(), id))
+
+def remove_timeshift(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def read_ring(map, start, size, offset, length):
+    # The ring begins at *start* in the file and wraps every *size* bytes
+    pos = offset % size
+    first = min(length, size - pos)
+    data = map[start + pos:start + pos + first]
+
+    if first < length:
+        data += map[start:start + length - first]
+
+    return data
+
+class TimeshiftBuffer(object):
+    """
+        Keeps the last *size* bytes of a stream in a file at *path* mapped
+        into memory, with an index from the times parts of the stream were
+        received to where they are, for a TimeshiftReader in another
+        process to play the stream from some time ago or save it. The file
+        is given its full size up front and written over as a ring, so it
+        takes the same space however long the stream runs.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.slots = max(MIN_SLOTS, size // SLOT_BYTES)
+        self.start = HEADER_SIZE + self.slots * ENTRY.size
+
+        try:
+            with open(path, "w+b") as fd:
+                fd.truncate(self.start + size)
+
+                # Running out of disk space in a mapping kills the process
+                fallocate = load_fallocate()
+                if fallocate:
+                    fallocate(fd.fileno(), 0, self.start + size)
+
+                self.map = mmap.mmap(fd.fileno(), self.start + size)
+        except (IOError, OSError):
+            remove_timeshift(path)
+            raise
+
+        self.written = 0
+        self.entries = 0
+        self.preamble = 0
+        self.indexed = 0
+        self.origin = 0
+        self.align = 1
+
+        # Where the next FLV tag starts, None if not following tags
+        self.next_tag = None
+
+        self._update()
+
+    def start_stream(self, header):
+        """
+            Starts a connection of the stream, *header* being the first
+            data read from it. The connections of a stream follow one
+            another in the ring, so only the first FLV header is kept.
+        """
+        preamble = flv_preamble(header)
+        if len(preamble) > MAX_PREAMBLE:
+            preamble = preamble[:FLV_HEADER_SIZE]
+
+        self.map[HEADER.size:HEADER.size + len(preamble)] = preamble
+        self.preamble = len(preamble)
+
+        self.origin = self.written
+        self.indexed = 0
+
+        if preamble:
+            self.next_tag = self.written
+            header = header[FLV_HEADER_SIZE:]
+        else:
+            self.next_tag = None
+            self.align = header[:1] == b"\x47" and TS_PACKET or 1
+
+        self.write(header)
+
+    def write(self, data):
+        if is_py2 and isinstance(data, memoryview):
+            # mmap only takes strings on Python 2
+            data = data.tobytes()
+
+        length = len(data)
+        if length == 0:
+            return
+
+        # Only the end of a write larger than the ring is kept
+        offset = self.written + max(length - self.size, 0)
+        data = data[max(length - self.size, 0):]
+
+        pos = offset % self.size
+        first = min(len(data), self.size - pos)
+        self.map[self.start + pos:self.start + pos + first] = data[:first]
+        if first < len(data):
+            self.map[self.start:self.start + len(data) - first] = data[first:]
+
+        self.written += length
+        now = time.time()
+
+        if self.next_tag is not None:
+            self._index_tags(now)
+        elif now - self.indexed >= INDEX_INTERVAL:
+            offset += -(offset - self.origin) % self.align
+            if offset < self.written:
+                self._index(now, offset)
+
+        self._update()
+
+    def _index_tags(self, now):
+        # Enough of each tag is needed to tell a keyframe
+        while self.next_tag + FLV_TAG_HEADER_SIZE < self.written:
+            tag = bytearray(read_ring(self.map, self.start, self.size, self.next_tag,
+                                      FLV_TAG_HEADER_SIZE + 1))
+
+            kind = tag[0] & 0x1f
+            if kind not in FLV_TAG_TYPES:
+                # Lost track of the tags, indexed by time from here
+                self.next_tag = None
+                return
+
+            size = tag[1] << 16 | tag[2] << 8 | tag[3]
+            keyframe = kind == FLV_VIDEO and size and tag[FLV_TAG_HEADER_SIZE] >> 4 == 1
+            if keyframe and now - self.indexed >= INDEX_INTERVAL:
+                self._index(now, self.next_tag)
+
+            self.next_tag += FLV_TAG_HEADER_SIZE + size + 4
+
+    def _index(self, now, offset):
+        ENTRY.pack_into(self.map, HEADER_SIZE + self.entries % self.slots * ENTRY.size, now, offset)
+        self.entries += 1
+        self.indexed = now
+
+    def _update(self):
+        # Readers trust the data and entries up to what is written here
+        HEADER.pack_into(self.map, 0, MAGIC, self.slots, self.preamble, self.size,
+                         self.written, self.entries)
+
+    def close(self):
+        self.map.close()
+        remove_timeshift(self.path)
+
+class TimeshiftReader(object):
+    """
+        Reads the stream kept by a TimeshiftBuffer, in this or another
+        process, while it is being written. Positions are offsets in the
+        stream, which stay valid until the ring has gone round past them.
+    """
+
+    def __init__(self, path):
+        try:
+            with open(path, "rb") as fd:
+                self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as err:
+            raise TimeshiftError("Failed to open {0}: {1}".format(path, err))
+
+        magic, self.slots, preamble, self.size, written, entries = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.map.close()
+            raise TimeshiftError("{0} is not a timeshift file".format(path))
+
+        self.start = HEADER_SIZE + self.slots * ENTRY.size
+
+    def position(self):
+        """
+            Returns how much of the stream has been written and indexed.
+        """
+        return HEADER.unpack_from(self.map, 0)[4:]
+
+    def preamble(self):
+        length = HEADER.unpack_from(self.map, 0)[2]
+        return self.map[HEADER.size:HEADER.size + length]
+
+    def _entry(self, index):
+        return ENTRY.unpack_from(self.map, HEADER_SIZE + index % self.slots * ENTRY.size)
+
+    def _search(self, low, high, found):
+        # First entry from *low* that is *found*, which holds
+        # for every entry after it, or *high* if none is
+        while low < high:
+            middle = (low + high) // 2
+            if found(*self._entry(middle)):
+                high = middle
+            else:
+                low = middle + 1
+
+        return low
+
+    def _valid(self):
+        written, entries = self.position()
+        oldest = max(written - self.size, 0)
+
+        # The slot after the newest entry may be being written
+        low = max(entries - self.slots + 1, 0)
+        low = self._search(low, entries, lambda when, offset: offset >= oldest)
+
+        return low, entries
+
+    def seek(self, when):
+        """
+            Returns the time and offset of the indexed point to play the
+            stream from to see it as it was at *when*, the oldest one
+            still kept if *when* is older. None if none is indexed yet.
+        """
+        low, high = self._valid()
+        if low == high:
+            return None
+
+        index = self._search(low, high, lambda time, offset: time > when)
+
+        return self._entry(max(index - 1, low))
+
+    def until(self, when):
+        """
+            Returns how much of the stream had been received by *when*,
+            up to the first indexed point received after it.
+        """
+        low, high = self._valid()
+        index = self._search(low, high, lambda time, offset: time > when)
+        if index == high:
+            return self.position()[0]
+
+        return self._entry(index)[1]
+
+    def read(self, offset, length):
+        """
+            Returns up to *length* bytes of the stream from *offset*, what
+            there is of it. Raises TimeshiftOverrun if it was written over.
+        """
+        written = self.position()[0]
+        if offset < written - self.size:
+            raise TimeshiftOverrun("The stream at {0} has been written over".format(offset))
+
+        data = read_ring(self.map, self.start, self.size, offset, min(length, written - offset))
+
+        # The writer may have gone round while it was copied
+        if offset < self.position()[0] - self.size:
+            raise TimeshiftOverrun("The stream at {0} has been written over".format(offset))
+
+        return data
+
+    def save(self, when, out):
+        """
+            Writes the stream from *when* to what has been received so far
+            to the file *out*. Returns the number of bytes written.
+        """
+        found = self.seek(when)
+        if found is None:
+            raise TimeshiftError("Nothing of the stream has been kept yet")
+
+        offset = found[1]
+        end = self.position()[0]
+        preamble = self.preamble()
+        out.write(preamble)
+
+        while offset < end:
+            try:
+                data = self.read(offset, min(READ_CHUNK, end - offset))
+            except TimeshiftOverrun:
+                raise TimeshiftError("The stream was written over while it was saved, ask for less of it")
+
+            out.write(data)
+            offset += len(data)
+
+        return len(preamble) + end - found[1]
+
+    def close(self):
+        self.map.close()
+
+class TimeshiftOutput(object):
+    """
+        Plays a stream from its timeshift file *seconds* behind live, or
+        records it from then on, from a thread of the manager. The stream
+        isn't opened again. A player is sent the stream as it was received
+        so it stays as far behind, and further once it has been paused.
+        Outputs that fall behind the ring skip ahead to *seconds* behind
+        live again.
+
+        Has the interface of StreamThread so the manager can list and
+        kill it, *owner* is the stream whose file it reads.
+    """
+
+    def __init__(self, id, args, owner, reader, seconds, logger):
+        self.id = id
+        self.args = args
+        self.owner = owner
+        self.reader = reader
+        self.seconds = seconds
+        self.logger = logger
+
+        self.phase = "starting"
+        self.started = threading.Event()
+        self.stopped = threading.Event()
+        self.exit_reason = None
+        self.player = None
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        out = None
+
+        try:
+            found = self.reader.seek(time.time() - self.seconds)
+            if found is None:
+                raise TimeshiftError("Nothing of the stream has been kept yet")
+
+            if self.args.output:
+                out = open(self.args.output, "wb")
+            else:
+                # Started by the manager, which has the pipes of every stream open
+                self.player = start_player(player_command(self.args), close_fds=not is_win32)
+                out = self.player.stdin
+
+            out.write(self.reader.preamble())
+            self.phase = "running"
+            self.started.set()
+
+            self._follow(out, found)
+        except TimeshiftError as err:
+            self.logger.error("Failed to rewind stream {0}: {1}", self.owner.id, err)
+            self.phase = "failed"
+            self.exit_reason = "failed"
+        except (IOError, OSError) as err:
+            if not self.stopped.is_set():
+                self.logger.error("Error when writing to output: {0}", err)
+                self.exit_reason = self.player and "player exited" or "failed"
+        finally:
+            if out is not None and not self.player:
+                out.close()
+            if self.player:
+                stop_player(self.player)
+
+            self.reader.close()
+
+            # Killed outputs are left without a reason
+            if not self.stopped.is_set():
+                self.exit_reason = self.exit_reason or "finished"
+
+    def _follow(self, out, found):
+        # Players get each part of the stream this long after it was received
+        delay = time.time() - found[0]
+        offset = found[1]
+        paced = not self.args.output
+
+        while not self.stopped.is_set():
+            if paced:
+                end = self.reader.until(time.time() - delay)
+            else:
+                end = self.reader.position()[0]
+
+            if offset >= end:
+                if not self.owner.hub_open() and offset >= self.reader.position()[0]:
+                    return
+
+                self.stopped.wait(FOLLOW_WAIT)
+                continue
+
+            try:
+                data = self.reader.read(offset, min(READ_CHUNK, end - offset))
+            except TimeshiftOverrun:
+                found = self.reader.seek(time.time() - self.seconds)
+                if found is None:
+                    self.stopped.wait(FOLLOW_WAIT)
+                    continue
+
+                self.logger.warning("Stream {0} fell behind its timeshift buffer, skipping ahead", self.id)
+                delay = time.time() - found[0]
+                offset = found[1]
+                continue
+
+            before = time.time()
+            out.write(data)
+            out.flush()
+
+            held = time.time() - before
+            if held > HOLD_TIME:
+                delay += held
+
+            offset += len(data)
+
+    def wait_started(self, timeout=None):
+        deadline = timeout is not None and time.time() + timeout
+
+        # Wait in steps so a keyboard interrupt is not swallowed
+        while not self.started.is_set() and self.is_alive():
+            if deadline and time.time() >= deadline:
+                break
+            self.started.wait(0.1)
+
+        return self.started.is_set() and self.is_alive()
+
+    def kill_stream(self):
+        self.stopped.set()
+
+        # Unblocks a write to a player that isn't reading
+        if self.player:
+            stop_player(self.player)
+
+    def join_stream(self):
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+
+    def running(self):
+        return self.thread.is_alive()
+
+    def is_alive(self):
+        return self.running()
+
+    def hub_open(self):
+        return False
+
+    def get_pids(self):
+        return None, self.player and [self.player.pid] or []
+
+    def get_stats(self):
+        return None
+
+    def get_info(self):
+        return [self.id, self.args.url, "{0} -{1:g}s".format(self.args.stream, self.seconds), "N/A"]
+
+__all__ = ["TimeshiftBuffer", "TimeshiftReader", "TimeshiftOutput", "TimeshiftError", "TimeshiftOverrun",
+           "remove_timeshift", "timeshift_path"]
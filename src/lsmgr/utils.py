@@ -1,8 +1,7 @@
 from .compat import urllib, is_win32
+from . import httppool
 
-import hmac, hashlib, zlib, argparse, socket, getpass, os
-
-SWF_KEY = b"Genuine Adobe Flash Player 001"
+import argparse, socket, getpass, os
 
 class ArgumentParser(argparse.ArgumentParser):
     def convert_arg_line_to_args(self, line):
@@ -18,27 +17,24 @@ class ArgumentParser(argparse.ArgumentParser):
             yield "--%s" % line
 
 def urlopen(url, data=None, timeout=None, opener=None, userAgent=None):
-    try:
-        if opener is not None:
-            fd = opener.open(url, data, timeout)
-        else:
-            if type(url) is str:
-                req = urllib.Request(url)
-            else:
-                req = url
-            if userAgent is not None:
-                req.add_header("User-Agent", userAgent)
-            fd = urllib.urlopen(req, data, timeout)
+    if isinstance(url, urllib.Request):
+        req = url
+    else:
+        req = urllib.Request(url)
+    if userAgent is not None:
+        req.add_header("User-Agent", userAgent)
 
-    except IOError as err:
-        if type(err) is urllib.URLError:
-            raise
-            #raise PluginError(err.reason)
-        else:
-            raise
-            #raise PluginError(err)
+    if opener is not None:
+        return opener.open(req, data, timeout)
 
-    return fd
+    if data is None:
+        data = req.data
+
+    # Plain HTTP requests reuse kept-alive connections
+    if httppool.is_pooled(req.get_full_url()):
+        return httppool.pool.request(req.get_full_url(), data, dict(req.header_items()), timeout)
+
+    return urllib.urlopen(req, data, timeout)
 
 def urlget(url, data=None, timeout=15, opener=None):
     fd = urlopen(url, data, timeout, opener)
@@ -55,14 +51,9 @@ def urlget(url, data=None, timeout=15, opener=None):
     return data
 
 def swfverify(url):
-    swf = urlget(url)
-
-    if swf[:3] == b"CWS":
-        swf = b"F" + swf[1:8] + zlib.decompress(swf[8:])
+    from . import swf
 
-    h = hmac.new(SWF_KEY, swf, hashlib.sha256)
-
-    return h.hexdigest(), len(swf)
+    return swf.verify(url)
 
 def verifyjson(json, key):
     if not key in json:
@@ -80,10 +71,43 @@ def port(string):
         raise argparse.ArgumentTypeError(msg)
     return value
 
-def next_port(args):
-    for port in range(args.min_port, args.max_port):
-        if check_port(port):
-            return port
+def size(string):
+    units = {"k": 1024, "m": 1024 * 1024, "g": 1024 * 1024 * 1024}
+    value = string.strip().lower().rstrip("b")
+
+    try:
+        if value[-1:] in units:
+            value = int(float(value[:-1]) * units[value[-1]])
+        else:
+            value = int(value)
+    except ValueError:
+        msg = "%r is not a valid size" % string
+        raise argparse.ArgumentTypeError(msg)
+
+    if value <= 0:
+        msg = "%r must be grater than 0" % string
+        raise argparse.ArgumentTypeError(msg)
+    return value
+
+def optional_size(string):
+    # 0 turns off what the size is for
+    if string.strip() == "0":
+        return 0
+
+    return size(string)
+
+def prebuffer(string):
+    value = string.strip().lower()
+
+    if value.endswith("s"):
+        try:
+            seconds = float(value[:-1])
+        except ValueError:
+            msg = "%r is not a valid number of seconds" % string
+            raise argparse.ArgumentTypeError(msg)
+        return (None, seconds)
+
+    return (size(string), None)
 
 def check_port(port):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -99,6 +123,6 @@ def get_password(prompt="Password: "):
 
 def manager_args(parser, args):
     try:
-        return parser.parse_args(args.strip().split(" "))
+        return parser.parse_args(args.split())
     except SystemExit:
         return False
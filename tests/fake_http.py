@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+    Stands in for a web server in the tests. Serves BODY on 127.0.0.1
+    and can cut connections halfway through it, answer Range requests
+    with 206 or ignore them, redirect and answer 304. The requests and
+    connections it gets are kept so tests can look at them.
+
+        /stream          BODY, resumable with Range
+        /no-ranges       BODY without Accept-Ranges
+        /no-length       BODY without Content-Length, closed at the end
+        /ignore-ranges   BODY with Accept-Ranges, answers Range with 200
+        /redirect/N      N redirects, then /stream
+        /relative        Redirects to "stream"
+        /loop            Redirects to itself
+        /cached          304 Not Modified
+"""
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+import re
+import socket
+import threading
+
+BODY = bytes(bytearray(i % 251 for i in range(256 * 1024)))
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connected(self.connection)
+
+    def do_GET(self):
+        self.server.log(self.path, self.headers.get("Range"))
+
+        if self.path.startswith("/redirect/"):
+            left = int(self.path.rsplit("/", 1)[1])
+            self.redirect(left and "/redirect/{0}".format(left - 1) or "/stream")
+        elif self.path == "/relative":
+            self.redirect("stream")
+        elif self.path == "/loop":
+            self.redirect("/loop")
+        elif self.path == "/cached":
+            self.send_response(304)
+            self.end_headers()
+        elif self.path == "/stream":
+            self.send_body()
+        elif self.path == "/no-ranges":
+            self.send_body(ranges=False)
+        elif self.path == "/no-length":
+            self.send_body(length=False)
+        elif self.path == "/ignore-ranges":
+            self.send_body(resume=False)
+        else:
+            self.send_error(404)
+
+    def redirect(self, location):
+        self.send_response(302)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_body(self, ranges=True, length=True, resume=True):
+        start = 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range") or "")
+
+        if match and resume:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, len(BODY) - 1, len(BODY)))
+        else:
+            self.send_response(200)
+
+        body = BODY[start:]
+
+        if ranges:
+            self.send_header("Accept-Ranges", "bytes")
+
+        if length:
+            self.send_header("Content-Length", str(len(body)))
+        else:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+
+        self.end_headers()
+
+        cut = self.server.next_cut()
+        if cut is None:
+            self.wfile.write(body)
+            return
+
+        # Lose the connection after *cut* bytes of the body
+        self.wfile.write(body[:cut])
+        self.wfile.flush()
+        self.close_connection = True
+        self.connection.shutdown(socket.SHUT_RDWR)
+
+class FakeHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+        Serves on a port of its own from a thread until stopped. Bodies
+        are cut after the byte counts in *cuts*, one per body sent.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+
+        self.lock = threading.Lock()
+        self.requests = []
+        self.connections = []
+        self.cuts = []
+
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle_error(self, request, client_address):
+        # Connections are cut on purpose
+        pass
+
+    def url(self, path):
+        return "http://127.0.0.1:{0}{1}".format(self.server_address[1], path)
+
+    def connected(self, sock):
+        with self.lock:
+            self.connections.append(sock)
+
+    def log(self, path, range):
+        with self.lock:
+            self.requests.append((path, range))
+
+    def next_cut(self):
+        with self.lock:
+            if self.cuts:
+                return self.cuts.pop(0)
+
+    def drop_connections(self):
+        # Like a server closing idle keep-alive connections
+        with self.lock:
+            for sock in self.connections:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def stop(self):
+        self.shutdown()
+        self.drop_connections()
+        self.server_close()
@@ -0,0 +1,166 @@
+"""
+    Checks the connection pool and resumed HTTP streams against the
+    server in fake_http.py.
+
+        $ PYTHONPATH=src python -m unittest discover tests
+"""
+
+import time
+import unittest
+
+from fake_http import FakeHTTPServer, BODY
+
+from lsmgr.compat import urllib
+from lsmgr.httppool import ConnectionPool, ResumableResponse, MAX_CONNECTIONS, RESUME_ATTEMPTS
+
+class HTTPTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeHTTPServer()
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def read_all(self, fd):
+        chunks = []
+        while True:
+            data = fd.read(8192)
+            if not data:
+                return b"".join(chunks)
+            chunks.append(data)
+
+    def ranges(self):
+        return [range for path, range in self.server.requests]
+
+class ResumableResponseTest(HTTPTestCase):
+    def test_resumes_from_offset(self):
+        self.server.cuts = [1000, 50000]
+
+        fd = ResumableResponse(self.pool, self.server.url("/stream"))
+        self.assertTrue(fd.resumable)
+        self.assertEqual(self.read_all(fd), BODY)
+        self.assertEqual(self.ranges(), [None, "bytes=1000-", "bytes=51000-"])
+
+    def test_attempts_reset_by_data(self):
+        self.server.cuts = [100] + [0] * (RESUME_ATTEMPTS - 1) + [100]
+
+        fd = ResumableResponse(self.pool, self.server.url("/stream"))
+        self.assertEqual(self.read_all(fd), BODY)
+
+    def test_gives_up_without_data(self):
+        self.server.cuts = [100] + [0] * RESUME_ATTEMPTS
+
+        fd = ResumableResponse(self.pool, self.server.url("/stream"))
+        self.assertRaises(IOError, self.read_all, fd)
+        self.assertEqual(len(self.server.requests), RESUME_ATTEMPTS + 1)
+
+    def test_needs_accept_ranges(self):
+        self.server.cuts = [1000]
+
+        fd = ResumableResponse(self.pool, self.server.url("/no-ranges"))
+        self.assertFalse(fd.resumable)
+        self.assertRaises(IOError, self.read_all, fd)
+        self.assertEqual(self.ranges(), [None])
+
+    def test_needs_content_length(self):
+        self.server.cuts = [1000]
+
+        fd = ResumableResponse(self.pool, self.server.url("/no-length"))
+        self.assertFalse(fd.resumable)
+        self.assertEqual(fd.length, None)
+
+        # Without a length the end of the connection is the end of the body
+        self.assertEqual(self.read_all(fd), BODY[:1000])
+        self.assertEqual(self.ranges(), [None])
+
+    def test_range_ignored(self):
+        self.server.cuts = [1000]
+
+        fd = ResumableResponse(self.pool, self.server.url("/ignore-ranges"))
+        self.assertTrue(fd.resumable)
+        self.assertRaises(IOError, self.read_all, fd)
+        self.assertEqual(self.ranges(), [None, "bytes=1000-"])
+
+class RedirectTest(HTTPTestCase):
+    def test_follows_redirects(self):
+        fd = self.pool.request(self.server.url("/redirect/3"))
+        self.assertEqual(fd.getcode(), 200)
+        self.assertEqual(fd.geturl(), self.server.url("/stream"))
+        self.assertEqual(self.read_all(fd), BODY)
+
+        # Redirects are read to the end so the connection is used again
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_relative_redirect(self):
+        fd = self.pool.request(self.server.url("/relative"))
+        self.assertEqual(fd.geturl(), self.server.url("/stream"))
+        self.assertEqual(self.read_all(fd), BODY)
+
+    def test_redirect_loop(self):
+        self.assertRaises(urllib.URLError, self.pool.request, self.server.url("/loop"))
+
+    def test_not_modified(self):
+        try:
+            self.pool.request(self.server.url("/cached"))
+        except urllib.HTTPError as err:
+            self.assertEqual(err.code, 304)
+        else:
+            self.fail("304 was not raised")
+
+class ConnectionPoolTest(HTTPTestCase):
+    def request(self, path):
+        fd = self.pool.request(self.server.url(path))
+        self.assertEqual(self.read_all(fd), BODY)
+
+    def idle(self):
+        return sum(len(idle) for idle in self.pool.idle.values())
+
+    def test_reuses_connection(self):
+        self.request("/stream")
+        self.request("/stream")
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_evicts_idle(self):
+        self.pool.configure(MAX_CONNECTIONS, 0.2)
+
+        self.request("/stream")
+        time.sleep(0.3)
+        self.request("/stream")
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertEqual(self.idle(), 1)
+
+    def test_keeps_max_connections(self):
+        self.pool.configure(1, 60)
+
+        first = self.pool.request(self.server.url("/stream"))
+        second = self.pool.request(self.server.url("/stream"))
+        self.read_all(first)
+        self.read_all(second)
+        self.assertEqual(self.idle(), 1)
+
+    def test_reconnects_when_idle_closed(self):
+        self.request("/stream")
+        self.server.drop_connections()
+        self.request("/stream")
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_partly_read_not_reused(self):
+        fd = self.pool.request(self.server.url("/stream"))
+        fd.read(10)
+        fd.close()
+        self.assertEqual(self.idle(), 0)
+
+    def test_cut_not_reused(self):
+        self.server.cuts = [1000]
+
+        fd = self.pool.request(self.server.url("/stream"))
+        try:
+            self.read_all(fd)
+        except IOError:
+            pass
+        fd.close()
+        self.assertEqual(self.idle(), 0)
+
+if __name__ == "__main__":
+    unittest.main()